@@ -11,8 +11,134 @@ from typing import Dict, Callable, Tuple
 
 name_to_fns_map: Dict[str, Tuple[Callable, Callable]] = {}
 
+TASK_TIMEOUT_SEC = 600
+"""Seconds after which an awaited task is revoked"""
+
+TASK_CLAIM_SEC = 10
+"""Seconds after which the claim of a task call expires, unless the task is dispatched (see `dispatch_task`)"""
+
 def dummy(*args, **kwargs): pass
 
+async def get_task_result(async_result, timeout: float=TASK_TIMEOUT_SEC, revoke: bool=True):
+    """Await a dispatched celery task.
+
+    Completion is pushed via the result backend, if possible (see `ResultListener`). Otherwise, the state of the
+    task is polled.
+
+    Args:
+        async_result: AsyncResult of the task
+        timeout: seconds
+        revoke: if set, the task is revoked on timeout. Only the caller, which dispatched the task, should revoke it
+
+    Returns:
+        result of the task
+
+    Raises:
+        TimeoutError: if the task took more than timeout to complete
+        Exception: the exception raised by the task"""
+    from redis.exceptions import RedisError
+    from .results import get_listener
+    listener = get_listener(async_result.app)
+    if listener is not None:
+        try:
+            meta = await listener.wait(async_result.id, timeout)
+        except TimeoutError:
+            if revoke:
+                async_result.revoke()
+            raise
+        except (RedisError, OSError) as e:
+            logger.warning(f"Cannot listen for result of {async_result.id}, polling instead: {str(e)}")
+        else:
+            if meta["status"] == "SUCCESS":
+                return meta["result"]
+            # on failure, the result is the exception raised
+            if isinstance(meta["result"], BaseException):
+                raise meta["result"]
+            raise Exception("unknown exception")
+
+    wait=0.1
+    timestamp=time.time()
+    while True:
+        if async_result.status == "SUCCESS":
+            return async_result.get()
+        if async_result.status == "FAILURE":
+            # on failure, getting the result will raise the exception
+            async_result.get()
+            raise Exception("unknown exception")
+        if (time.time() - timestamp) > timeout:
+            if revoke:
+                async_result.revoke()
+            raise TimeoutError
+        await asyncio.sleep(wait)
+        wait = min(wait + wait, 1) # increase sleep duration, but at most 1 sec
+
+async def dispatch_task(task, args, kwargs):
+    """Dispatch a celery task, and await its result.
+
+    If `TASK_DEDUP` is set, and a task with the same name and arguments is in flight (dispatched by any server
+    process or replica), it is attached to instead (see `ResultListener.claim`). The claim expires after
+    `TASK_CLAIM_SEC`, unless extended once the task is dispatched: if the claimant died before dispatching, the
+    attached callers dispatch (or attach) anew.
+
+    Args:
+        task: celery task
+        args: positional arguments
+        kwargs: keyword arguments
+
+    Returns:
+        result of the task
+
+    Raises:
+        TimeoutError: see `get_task_result`
+        Exception: the exception raised by the task"""
+    from uuid import uuid4
+    from redis.exceptions import RedisError
+    from api.siibra_api_config import TASK_DEDUP
+    from .results import get_listener, get_inflight_key, task_dedup
+    listener = get_listener(task.app) if TASK_DEDUP else None
+    if listener is None:
+        return await get_task_result(task.apply_async(args, kwargs))
+
+    key = get_inflight_key(task.name, args, kwargs)
+    task_id = uuid4().hex
+    try:
+        existing_id = await listener.claim(key, task_id, TASK_CLAIM_SEC)
+    except (RedisError, OSError) as e:
+        logger.warning(f"Cannot claim {key}, dispatching unclaimed: {str(e)}")
+        task_dedup.labels("failed").inc()
+        return await get_task_result(task.apply_async(args, kwargs))
+
+    if existing_id is not None:
+        task_dedup.labels("attached").inc()
+        async_result = task.AsyncResult(existing_id)
+        try:
+            return await get_task_result(async_result, TASK_CLAIM_SEC, revoke=False)
+        except TimeoutError:
+            pass
+        try:
+            dispatched = await listener.get_claim(key) == existing_id
+        except (RedisError, OSError) as e:
+            logger.warning(f"Cannot check claim of {key}: {str(e)}")
+            dispatched = True
+        if dispatched:
+            return await get_task_result(async_result, TASK_TIMEOUT_SEC - TASK_CLAIM_SEC, revoke=False)
+        task_dedup.labels("abandoned").inc()
+        return await dispatch_task(task, args, kwargs)
+
+    task_dedup.labels("claimed").inc()
+    try:
+        async_result = task.apply_async(args, kwargs, task_id=task_id)
+        try:
+            await listener.extend(key, task_id, TASK_TIMEOUT_SEC)
+        except (RedisError, OSError) as e:
+            logger.warning(f"Cannot extend claim of {key}: {str(e)}")
+        return await get_task_result(async_result)
+    finally:
+        try:
+            await listener.release(key, task_id)
+        except (RedisError, OSError) as e:
+            logger.warning(f"Cannot release {key}: {str(e)}")
+
 def data_decorator(role: ROLE_TYPE):
     """data decorator
 
@@ -47,6 +173,10 @@ def data_decorator(role: ROLE_TYPE):
 def router_decorator(role: ROLE_TYPE, *, func, queue_as_async: bool=False, **kwargs):
     """Sync Router Decorator
 
+    Sync route handlers are run in a worker thread (see starlette.concurrency.run_in_threadpool). In the server role,
+    they may only queue tasks (`queue_as_async`): awaiting a task would block the thread until the task completes.
+    Routes awaiting tasks use `async_router_decorator` instead.
+
     Args:
         role: role of this process
         func: function to be queued, or called, based on role
@@ -54,6 +184,7 @@ def router_decorator(role: ROLE_TYPE, *, func, queue_as_async: bool=False, **kwa
     
     Raises:
         FaultyRoleException: if role is set to `all` and `queue_as_async` is set
+        FaultyRoleException: if role is set to `server` and `queue_as_async` is not set
         FaultyRoleException: if role is set to other than `all` or `server`
     """
     def outer(fn):
@@ -69,6 +200,9 @@ def router_decorator(role: ROLE_TYPE, *, func, queue_as_async: bool=False, **kwa
                 raise FaultyRoleException(f"If role is set to all, cannot queue_as_async")
             return_func = func
         if role == "server":
+            if not queue_as_async:
+                raise FaultyRoleException(f"{fn.__name__}: sync route handlers cannot await tasks in the server role, use async_router_decorator")
+
             def sync_get_result(*args, **kwargs):
                 if isinstance(func, partial):
                     func.func.s(*func.args, **func.keywords)
@@ -77,13 +211,10 @@ def router_decorator(role: ROLE_TYPE, *, func, queue_as_async: bool=False, **kwa
                     kwargs={**kwargs, **func.keywords}
                 else:
                     _func=func
-                
                 async_result = _func.apply_async(args, kwargs)
-                if queue_as_async:
-                    return async_result.id
-                else:
-                    return async_result.get()
+                return async_result.id
             return_func = sync_get_result
+
         if return_func is None:
             raise FaultyRoleException(f"router_decorator can only be used in roles: all, server, but you selected {role}")
         
@@ -101,7 +232,7 @@ def async_router_decorator(role: ROLE_TYPE, *, func):
         func: function to be queued, or called, based on role
     Raises:
         AssertionError: if wrapped function is not async
-        TimeoutError: if the async process took more than 600sec to complete
+        TimeoutError: if the async process took more than TASK_TIMEOUT_SEC to complete
         FaultyRoleException: if role is set to other than `all` or `server`
     """
     def outer(fn):
@@ -114,10 +245,15 @@ def async_router_decorator(role: ROLE_TYPE, *, func):
 
         return_func = None
         if role == "all":
+            from starlette.concurrency import run_in_threadpool
+
+            # data handlers are computed in process, in a worker thread, so that the event loop is not blocked
             async def async_get_direct_result(*args, **kwargs):
-                return func(*args, **kwargs)
+                return await run_in_threadpool(func, *args, **kwargs)
             return_func = async_get_direct_result
         if role == "server":
+            from .results import dispatch_limiter
+
             async def async_get_result(*args, **kwargs):
                 if isinstance(func, partial):
                     func.func.s(*func.args, **func.keywords)
@@ -127,21 +263,8 @@ def async_router_decorator(role: ROLE_TYPE, *, func):
                 else:
                     _func=func
                 
-                async_result = _func.apply_async(args, kwargs)
-                wait=0.1
-                timestamp=time.time()
-                while True:
-                    if async_result.status == "SUCCESS":
-                        return async_result.get()
-                    if async_result.status == "FAILURE":
-                        # on failure, getting the result will raise the exception
-                        async_result.get()
-                        raise Exception("unknown exception")
-                    if (time.time() - timestamp) > 600:
-                        async_result.revoke()
-                        raise TimeoutError
-                    await asyncio.sleep(wait)
-                    wait = min(wait + wait, 1) # increase sleep duration, but at most 1 sec
+                async with dispatch_limiter.slot():
+                    return await dispatch_task(_func, args, kwargs)
             return_func = async_get_result
 
         if return_func is None:
@@ -0,0 +1,20 @@
+"""Lanes of the tasks of `api`, with their own queues and recorded durations. See `new_api.common.lane_router`.
+
+If `TASK_LANES` is set, tasks are routed into a lane of their queue (e.g. `{QUEUE_PREFIX}.volumes-slow`), by the
+recorded duration of their data handler. Data handlers pinned by operators (`TASK_LANE_CRITICAL`) are routed into the
+`critical` lane.
+"""
+
+from api.common.logger import logger
+from api.siibra_api_config import (
+    QUEUE_PREFIX, REDIS_TIMEOUT_SEC, TASK_LANES, TASK_LANE_FAST_SEC, TASK_LANE_SLOW_SEC, TASK_LANE_CRITICAL,
+)
+from new_api.common.lane_router import LANES, make_router
+
+router = make_router(QUEUE_PREFIX, TASK_LANES, TASK_LANE_CRITICAL, TASK_LANE_FAST_SEC, TASK_LANE_SLOW_SEC, REDIS_TIMEOUT_SEC, logger)
+"""Lane router of `api`"""
+
+route_task = router.route_task
+record_durations = router.record_durations
+lane_counters = router.lane_counters
+DURATIONS_KEY = router.durations_key
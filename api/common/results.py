@@ -0,0 +1,306 @@
+"""Push based completion of celery tasks.
+
+The redis result backend publishes the result (meta) of a task on the channel named after its result key, whenever
+it is stored. Rather than polling the state of each task, a single listener per process subscribes to the channels of
+pending tasks, and resolves their futures.
+
+Identical tasks in flight are deduplicated via the result backend, too (see `ResultListener.claim`).
+"""
+
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from prometheus_client import Counter, Gauge
+from typing import Any, Dict, Optional
+import asyncio
+import json
+import time
+from api.common.logger import logger
+from api.siibra_api_config import REDIS_POOL_SIZE, REDIS_TIMEOUT_SEC, TASK_MAX_IN_FLIGHT, QUEUE_PREFIX
+
+RESULT_RECHECK_SEC = 5
+"""Interval of reading the stored result of a pending task, in case its notification was missed (e.g. whilst reconnecting)"""
+
+LISTEN_RETRY_SEC = 1
+"""Delay before listening again, after the pub/sub connection failed"""
+
+INFLIGHT_KEY_PREFIX = "siibra-api-task-inflight-"
+"""Prefix of keys holding the id of a task in flight, see `get_inflight_key`"""
+
+_release_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_extend_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def get_inflight_key(task_name: str, args, kwargs) -> str:
+    """Get the key of a task call, identical for identical calls (across processes and replicas of this version).
+
+    Args:
+        task_name: name of the celery task
+        args: positional arguments
+        kwargs: keyword arguments
+
+    Returns:
+        key"""
+    arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+    digest = blake2b(f"{task_name}{arguments}".encode("utf-8"), digest_size=16).hexdigest()
+    return f"{INFLIGHT_KEY_PREFIX}{QUEUE_PREFIX}:{task_name}:{digest}"
+
+class ResultListener:
+    """Listen for the completion of celery tasks, via the pub/sub of the redis result backend."""
+
+    def __init__(self, backend, url: str):
+        """
+        Args:
+            backend: celery redis result backend, to name channels and to decode results
+            url: redis url of the result backend
+        """
+        from redis.asyncio import Redis, BlockingConnectionPool
+        self.backend = backend
+        # the pub/sub holds one connection of the pool, the others are used to read stored results
+        self._client = Redis(connection_pool=BlockingConnectionPool.from_url(url, max_connections=REDIS_POOL_SIZE, timeout=REDIS_TIMEOUT_SEC))
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._futures: Dict[bytes, asyncio.Future] = {}
+        self._waiters: Dict[bytes, int] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self.loop = asyncio.get_running_loop()
+
+    def _decode_ready(self, payload: Optional[bytes]) -> Optional[Dict[str, Any]]:
+        """Decode payload into result meta, if the task is ready (i.e. succeeded, failed or revoked)"""
+        from celery import states
+        if payload is None:
+            return None
+        meta = self.backend.decode_result(payload)
+        return meta if meta.get("status") in states.READY_STATES else None
+
+    async def _listen(self):
+        from redis.exceptions import RedisError
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=RESULT_RECHECK_SEC)
+                if message is None or message["type"] != "message":
+                    continue
+                future = self._futures.get(message["channel"])
+                if future is None or future.done():
+                    continue
+                meta = self._decode_ready(message["data"])
+                if meta is not None:
+                    future.set_result(meta)
+            except asyncio.CancelledError:
+                raise
+            except (RedisError, OSError) as e:
+                logger.warning(f"Listening for task results failed, retrying in {LISTEN_RETRY_SEC}s: {str(e)}")
+                await asyncio.sleep(LISTEN_RETRY_SEC)
+            except Exception as e:
+                logger.warning(f"Cannot handle task result notification: {str(e)}")
+
+    async def wait(self, task_id: str, timeout: float) -> Dict[str, Any]:
+        """Wait for a task to be ready.
+
+        The stored result is read once subscribed (the task may have completed before), and every
+        `RESULT_RECHECK_SEC` seconds (the notification may have been missed).
+
+        Args:
+            task_id: id of the task
+            timeout: seconds
+
+        Returns:
+            result meta, with `status` and `result` (the return value, or the exception raised)
+
+        Raises:
+            TimeoutError: if the task is not ready within timeout"""
+        key = self.backend.get_key_for_task(task_id)
+        # waiters of the same task (see `claim`) share its future and subscription
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = self.loop.create_future()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            if self._waiters[key] == 1:
+                await self._pubsub.subscribe(key)
+            if self._listener is None or self._listener.done():
+                self._listener = asyncio.create_task(self._listen())
+            deadline = time.monotonic() + timeout
+            while True:
+                meta = self._decode_ready(await self._client.get(key))
+                if meta is not None:
+                    return meta
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), min(RESULT_RECHECK_SEC, remaining))
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                self._waiters.pop(key)
+                self._futures.pop(key, None)
+                try:
+                    await self._pubsub.unsubscribe(key)
+                except Exception as e:
+                    logger.warning(f"Cannot unsubscribe from {key}: {str(e)}")
+
+    async def claim(self, key: str, task_id: str, ttl: float) -> Optional[str]:
+        """Claim key (see `get_inflight_key`) for a task about to be dispatched.
+
+        Args:
+            key: key of the task call
+            task_id: id of the task to be dispatched
+            ttl: seconds after which the claim expires, regardless if `release` is called
+
+        Returns:
+            id of the identical task in flight, to attach to. None if claimed (i.e. the task should be dispatched)"""
+        if await self._client.set(key, task_id, nx=True, px=int(ttl * 1000)):
+            return None
+        existing = await self._client.get(key)
+        # released in between, dispatch unclaimed
+        return None if existing is None else existing.decode("utf-8")
+
+    async def extend(self, key: str, task_id: str, ttl: float) -> bool:
+        """Extend the claim of key, if it is still held by task_id, e.g. once the task is dispatched.
+
+        Args:
+            key: key of the task call
+            task_id: id passed to `claim`
+            ttl: seconds after which the claim expires, from now
+
+        Returns:
+            if the claim is still held"""
+        return bool(await self._client.eval(_extend_script, 1, key, task_id, int(ttl * 1000)))
+
+    async def get_claim(self, key: str) -> Optional[str]:
+        """Get the id of the task holding the claim of key, or None if it is not claimed"""
+        existing = await self._client.get(key)
+        return None if existing is None else existing.decode("utf-8")
+
+    async def release(self, key: str, task_id: str):
+        """Release the claim of key, if it is still held by task_id
+
+        Args:
+            key: key of the task call
+            task_id: id passed to `claim`"""
+        await self._client.eval(_release_script, 1, key, task_id)
+
+    async def close(self):
+        """Stop listening, and disconnect"""
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await self._pubsub.reset()
+        await self._client.connection_pool.disconnect()
+
+_listener: Optional[ResultListener] = None
+
+def get_listener(app) -> Optional[ResultListener]:
+    """Get the result listener of this process (event loop).
+
+    Args:
+        app: celery app
+
+    Returns:
+        ResultListener, or None if the result backend is not redis (then, poll the state of tasks)"""
+    global _listener
+    url = app.conf.result_backend
+    if not isinstance(url, str) or not url.startswith(("redis://", "rediss://")):
+        return None
+    if _listener is None or _listener.loop is not asyncio.get_running_loop():
+        _listener = ResultListener(app.backend, url)
+    return _listener
+
+task_dispatch = Counter("task_dispatch", "Tasks dispatched and awaited by route handlers (dispatched, queued, succeeded, failed, timeout)", ("counter",))
+"""Counters are `dispatched`, `queued` (waited for a slot), `succeeded`, `failed` and `timeout`"""
+
+task_dispatch_seconds = Counter("task_dispatch_seconds", "Total seconds tasks were in flight")
+
+task_dispatch_tasks = Gauge("task_dispatch_tasks", "Tasks in flight, and callers waiting for a slot, of all live processes", ("state",), multiprocess_mode="livesum")
+"""States are `in_flight` and `waiting`"""
+
+task_dedup = Counter("task_dedup", "Deduplication of identical tasks in flight (claimed, attached, abandoned, failed)", ("counter",))
+"""Counters are `claimed` (task dispatched), `attached` (to an identical task in flight), `abandoned` (claimed, but not dispatched in time, e.g. as the claimant died) and `failed` (dispatched unclaimed, as claiming failed)"""
+
+class DispatchLimiter:
+    """Bound the number of tasks awaited at a time (in flight), per process. Further callers wait for a slot.
+
+    Besides the counters of the instance, `task_dispatch`, `task_dispatch_seconds` and `task_dispatch_tasks` are updated."""
+
+    def __init__(self, limit: int):
+        """
+        Args:
+            limit: maximum number of tasks in flight
+        """
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.seconds = 0.0
+        """total seconds tasks were in flight"""
+        self.counters: Dict[str, int] = defaultdict(int)
+        """counter -> count. Counters are `dispatched`, `queued` (waited for a slot), `succeeded`, `failed` and `timeout`"""
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(max(1, self.limit))
+            self._loop = loop
+        return self._semaphore
+
+    def _count(self, counter: str):
+        self.counters[counter] += 1
+        task_dispatch.labels(counter).inc()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the duration of the block, i.e. whilst dispatching and awaiting a task"""
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            self._count("queued")
+        self.waiting += 1
+        task_dispatch_tasks.labels("waiting").inc()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            task_dispatch_tasks.labels("waiting").dec()
+        self.in_flight += 1
+        task_dispatch_tasks.labels("in_flight").inc()
+        self._count("dispatched")
+        start = time.monotonic()
+        try:
+            yield
+        except TimeoutError:
+            self._count("timeout")
+            raise
+        except Exception:
+            self._count("failed")
+            raise
+        else:
+            self._count("succeeded")
+        finally:
+            elapsed = time.monotonic() - start
+            self.seconds += elapsed
+            task_dispatch_seconds.inc(elapsed)
+            self.in_flight -= 1
+            task_dispatch_tasks.labels("in_flight").dec()
+            semaphore.release()
+
+dispatch_limiter = DispatchLimiter(TASK_MAX_IN_FLIGHT)
+"""Limiter of the tasks awaited by route handlers (see `async_router_decorator`)"""
+
+async def terminate():
+    """On terminate call"""
+    global _listener
+    if _listener is not None:
+        await _listener.close()
+        _listener = None
@@ -0,0 +1,68 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from typing import List, Optional
+import hmac
+from api.siibra_api_config import ADMIN_TOKEN
+from api.server.cache import get_instance as get_cache_instance, get_redis_nodes as get_cache_nodes
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.fingerprint import get_manifest
+from api.server.cache.introspect import sample_keys, merge_samples, summarize, purge_prefix
+
+def verify_admin_token(authorization: Optional[str]=Header(None)):
+    """Verify the bearer token of admin requests, against `ADMIN_TOKEN`.
+
+    Raises:
+        HTTPException: 404 if admin endpoints are disabled, or if the token is missing or does not match (so that
+            admin endpoints cannot be told apart from nonexistent ones)"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(404, "Not Found")
+
+router = APIRouter(dependencies=[Depends(verify_admin_token)])
+"""HTTP admin routes router. Not versioned, and not part of the openapi schema."""
+
+def get_redis_nodes() -> List[CacheGzipRedis]:
+    """Get the available redis nodes of the response cache
+
+    Raises:
+        HTTPException: 503 if no node is available"""
+    nodes = [node for node in get_cache_nodes() if node.is_connected]
+    if not nodes:
+        raise HTTPException(503, "Redis is not available")
+    return nodes
+
+@router.get("/cache/stats")
+async def get_cache_stats(request: Request, sample: int=Query(10000, gt=0, le=1000000), top: int=Query(20, gt=0, le=1000)):
+    """HTTP get statistics of the response cache, from a sample of the keyspace (of each node, see `CACHE_NODES`).
+
+    Keys are grouped by route template. Counts and bytes are of the sample, `scale` extrapolates them to all keys."""
+    nodes = get_redis_nodes()
+    routes = {fingerprint: route for route, fingerprint in get_manifest(request.app).items()}
+    samples = [await sample_keys(node, routes, max(1, sample // len(nodes))) for node in nodes]
+
+    # number of keys per node, None if the node is not available
+    node_sizes = {node.name: None for node in get_cache_nodes()}
+    for node, node_sample in zip(nodes, samples):
+        node_sizes[node.name] = node_sample.dbsize
+    return {
+        **summarize(merge_samples(samples), top),
+        "nodes": node_sizes,
+    }
+
+@router.post("/cache/purge")
+async def purge_cache(prefix: Optional[str]=None, tag: List[str]=Query([])):
+    """HTTP purge cached responses, by path prefix (e.g. `/v3_0/parcellations`, of any fingerprint) and/or by tag (e.g. `parcellation:<id>`, see `get_tags`)."""
+    if not prefix and not tag:
+        raise HTTPException(400, "prefix or tag required")
+    nodes = get_redis_nodes()
+    result = {}
+    if prefix:
+        keys = [key for node in nodes for key in await purge_prefix(node, prefix)]
+        # the in process (and shared memory) tiers would otherwise keep serving them
+        await get_cache_instance().evict(keys)
+        result["prefix"] = { "deleted": len(keys) }
+    if tag:
+        keys = await get_cache_instance().invalidate_tags(tag)
+        result["tag"] = { "deleted": len(keys) }
+    return result
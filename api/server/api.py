@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request, Response, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -8,25 +8,41 @@ from fastapi_versioning import VersionedFastAPI
 from pathlib import Path
 from contextlib import asynccontextmanager
 
+from typing import Set, List, Tuple, AsyncIterator, Optional
+import asyncio
 import time
 import json
 
-from .util import add_lazy_path
+from .util import add_lazy_path, internal_request
 
 add_lazy_path()
 
 from .const import DOCUMENTATION_URL, INPUT_FORMAT, OUTPUT_FORMAT, cache_header, __version__
-from .cache import get_instance as get_cache_instance, terminate, on_startup
+from .cache import get_instance as get_cache_instance, terminate, on_startup, CacheGzipRedis, single_flight
+from .cache.codec import decompress, GZIP_MAGIC
+from .cache.policy import get_policy, DEFAULT_POLICY, NEGATIVE_STATUS_CODES
+from .cache.key import get_cache_key
+from .cache.tags import get_request_tags
+from .cache.fingerprint import get_route_template
+from .cache.stats import route_requests, bypass_requests, negative_responses, UNMATCHED_ROUTE
+from .cache.etag import compute_etag, etag_header, etag_matches
+from .cache.meta import CacheMeta, get_cached_status_code
+from .cache.stream import CacheTee
+from .cache.spill import SpilledFile, on_startup as spill_on_startup, on_terminate as spill_on_terminate
+from .cache.warmup import WARMUP_HEADER, on_startup as warmup_on_startup
 from .core import prefixed_routers as core_prefixed_routers
 from .volumes import prefixed_routers as volume_prefixed_routers
 from .compounds import prefixed_routers as compound_prefixed_routers
 from .features import router as feature_router
 from .volcabularies import router as vocabularies_router
+from .admin import router as admin_router
+from .batch import BatchRequestModel, BATCH_MEDIA_TYPE, stream_batch
 from .metrics import prom_metrics_resp, on_startup as metrics_on_startup, on_terminate as metrics_on_terminate
-from .code_snippet import get_sourcecode
+from .code_snippet import get_sourcecode, lookup_handler_fn
 
 from ..common import general_logger, access_logger, NotFound, SapiBaseException, name_to_fns_map
-from ..siibra_api_config import GIT_HASH
+from ..common.results import terminate as results_terminate
+from ..siibra_api_config import GIT_HASH, CACHE_MAX_BODY_BYTES, CACHE_LOCK_WAIT_SEC
 
 siibra_version_header = "x-siibra-api-version"
 
@@ -109,7 +125,7 @@ origins = ["*"]
 siibra_api.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_methods=["GET"],
+    allow_methods=["GET", "POST"],
     expose_headers=[siibra_version_header]
 )
 
@@ -119,10 +135,52 @@ siibra_api.add_middleware(
 # See: https://github.com/encode/starlette/issues/479 and https://github.com/xgui3783/starlette-middleware-demo
 
 async def read_bytes(generator) -> bytes:
-    body = b""
-    async for data in generator:
-        body += data
-    return body
+    return b"".join([data async for data in generator])
+
+async def read_ahead(body_iterator: AsyncIterator[bytes]) -> Tuple[List[bytes], bool]:
+    """Read (up to) the first two chunks of a response body.
+
+    Responses rendered in one piece (e.g. `JSONResponse`) are sent as a single chunk.
+    
+    Args:
+        body_iterator: response body
+    
+    Returns:
+        chunks read, and if the body is complete"""
+    chunks = []
+    async for chunk in body_iterator:
+        chunks.append(chunk)
+        if len(chunks) == 2:
+            return chunks, False
+    return chunks, True
+
+
+_refreshing_keys: Set[str] = set()
+_background_tasks: Set[asyncio.Task] = set()
+
+def schedule_refresh(request: Request, cache_key: str):
+    """Recompute a (stale) cached response in the background, by issuing the same request in process, bypassing cache read.
+    
+    Args:
+        request: Request, of which the response is to be recomputed
+        cache_key: cache key of the response"""
+    if cache_key in _refreshing_keys:
+        return
+    _refreshing_keys.add(cache_key)
+
+    async def refresh():
+        try:
+            status_code, _, _ = await internal_request(request.app, request.scope, {"x-bypass-fastapi-cache": "true"})
+            if status_code >= 400:
+                general_logger.warning(f"Refreshing {cache_key} failed with status {status_code}")
+        except Exception as e:
+            general_logger.warning(f"Refreshing {cache_key} failed: {str(e)}")
+        finally:
+            _refreshing_keys.discard(cache_key)
+
+    task = asyncio.create_task(refresh())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
 
 do_not_cache_list = [
@@ -130,6 +188,7 @@ do_not_cache_list = [
     "openapi.json",
     "atlas_download",
     "/about",
+    "/admin",
 ]
 
 do_no_cache_query_list = [
@@ -143,14 +202,29 @@ do_not_logs = (
     "/about"
 )
 
+def get_url_bypass_reason(path: str, query: str) -> Optional[str]:
+    """Get the reason to bypass the cache, by url alone (see `do_not_cache_list` and `do_no_cache_query_list`).
+
+    Args:
+        path: url path
+        query: url query string
+
+    Returns:
+        `path:<keyword>`, `query:<keyword>`, or None if the url may be cached"""
+    for keyword in do_not_cache_list:
+        if keyword in path:
+            return f"path:{keyword}"
+    for keyword in do_no_cache_query_list:
+        if keyword in query:
+            return f"query:{keyword}"
+    return None
+
 
 @siibra_api.middleware("http")
 async def middleware_cache_response(request: Request, call_next):
     """Cache requests to redis, to improve response time."""
     cache_instance = get_cache_instance()
 
-    cache_key = f"[{__version__}] {request.url.path}{str(request.url.query)}"
-
     auth_set = request.headers.get("Authorization") is not None
 
     accept_header = request.headers.get("Accept")
@@ -161,13 +235,18 @@ async def middleware_cache_response(request: Request, call_next):
     # - if auth token is set
     # - if any part of request.url.path matches with do_not_cache_list
     # - if any keyword appears in do_no_cache_query_list
-    bypass_cache_set = (
-        request.method.upper() != "GET"
-        or auth_set
-        or query_code_flag
-        or any (keyword in request.url.path for keyword in do_not_cache_list)
-        or any (keyword in request.url.query for keyword in do_no_cache_query_list)
-    )
+    # the reason is counted per route (see `bypass_requests`), e.g. to tune do_no_cache_query_list
+    def get_bypass_reason() -> Optional[str]:
+        if request.method.upper() != "GET":
+            return "method"
+        if auth_set:
+            return "auth"
+        if query_code_flag:
+            return "code"
+        return get_url_bypass_reason(request.url.path, request.url.query)
+
+    bypass_reason = get_bypass_reason()
+    bypass_cache_set = bypass_reason is not None
 
     # bypass cache read if:
     # - bypass cache set
@@ -178,6 +257,16 @@ async def middleware_cache_response(request: Request, call_next):
         or bypass_cache_set
     )
 
+    matched = lookup_handler_fn(request.app, request.scope)
+    route_template = get_route_template(request.app, matched[0]) if matched else UNMATCHED_ROUTE
+
+    def count(counter: str):
+        route_requests.labels(route_template, counter).inc()
+
+    if bypass_cache_read:
+        bypass_requests.labels(route_template, bypass_reason or "header").inc()
+        count("bypass")
+
     # starlette seems to normalize header to lower case
     # so .get("origin") also works if the request has "Origin: http://..."
 
@@ -190,82 +279,225 @@ async def middleware_cache_response(request: Request, call_next):
         siibra_version_header: __version__,
     }
 
-    cached_value = cache_instance.get_value(cache_key) if not bypass_cache_read else None
-
     status_code_key = "status_code"
 
-    if cached_value:
-        loaded_value = json.loads(cached_value)
-        if loaded_value.get("error"):
-            status_code = loaded_value.get(status_code_key, 500)
-        else:
-            status_code = 200
+    policy = DEFAULT_POLICY if bypass_cache_set else get_policy(matched)
+    cache_key = None if bypass_cache_set else get_cache_key(request, matched, policy)
+    cache_tags = [] if bypass_cache_set else get_request_tags(request, matched)
+
+    # if client accepts gzip, serve the stored gzip bytes as is
+    accept_gzip = "gzip" in (request.headers.get("accept-encoding") or "")
+
+    is_get = request.method.upper() == "GET"
+    if_none_match = request.headers.get("if-none-match")
+
+    async def cached_response_args(cached_value, compressed: bool=False, cache_status: str="hit", meta: CacheMeta=None):
+        # spilled values are served from the shared volume, unless they need to be inspected
+        if isinstance(cached_value, SpilledFile) and (meta is None or (meta.status_code == 200 and meta.etag is None)):
+            cached_value = await cached_value.read()
+        # values stored with codecs other than gzip are returned decompressed
+        compressed = compressed and (isinstance(cached_value, SpilledFile) or CacheGzipRedis.getbytes(cached_value[:2]) == GZIP_MAGIC)
+        # entries cached without metadata are always json
+        if meta is None:
+            if compressed:
+                status_code = get_cached_status_code(CacheGzipRedis.peek(cached_value))
+            else:
+                status_code = get_cached_status_code(CacheGzipRedis.getbytes(cached_value[:64]))
+            meta = CacheMeta(status_code=status_code)
+        status_code = meta.status_code
+        etag = meta.etag
+        if status_code in NEGATIVE_STATUS_CODES and cache_status == "hit":
+            negative_responses.labels("hits").inc()
+            count("negative_hit")
+        if status_code == 200 and etag is None:
+            etag = compute_etag((await decompress(cached_value)) if compressed else cached_value)
+        return cached_value, status_code, {
+            "content-type": meta.content_type or "application/json",
+            **({ "content-encoding": "gzip" } if compressed else {}),
+            "vary": "Accept-Encoding",
+            **({ "etag": etag_header(etag, compressed) } if status_code == 200 else {}),
+            cache_header: cache_status,
+            **extra_headers,
+        }
+
+    def respond(content, status_code, headers):
+        # the etag of a streamed body is only known once it completes, i.e. after the headers are sent. It is
+        # committed with the entry, for subsequent requests
+        if isinstance(content, CacheTee):
+            return StreamingResponse(content, status_code=status_code, headers=headers)
+        if is_get and status_code == 200 and etag_matches(if_none_match, headers.get("etag")):
+            return Response(
+                status_code=304,
+                headers={
+                    key: value
+                    for key, value in headers.items()
+                    if key.lower() not in ("content-type", "content-encoding", "content-length")
+                }
+            )
+        if isinstance(content, SpilledFile):
+            return FileResponse(content.path, status_code=status_code, headers=headers)
         return Response(
-            cached_value,
+            content,
             status_code=status_code,
-            headers={
-                "content-type": "application/json",
-                cache_header: "hit",
-                **extra_headers,
-            }
+            headers=headers
         )
 
-    
-    try:
-        response = await call_next(request)
-        status_code = 200
-        response_content_type = response.headers.get("content-type")
-        response_headers = response.headers
-        content = await read_bytes(response.body_iterator)
+    # answer conditional requests from the metadata, without fetching the value
+    if if_none_match and not bypass_cache_read:
+        meta, staleness = await cache_instance.get_meta(cache_key, stale_window=policy.stale_window)
+        if (
+            meta is not None
+            and meta.status_code == 200
+            and etag_matches(if_none_match, meta.etag)
+            and (staleness is None or staleness <= policy.stale_while_revalidate)
+        ):
+            if staleness is not None:
+                schedule_refresh(request, cache_key)
+            count("hit" if staleness is None else "stale")
+            return respond(None, 200, {
+                "vary": "Accept-Encoding",
+                "etag": etag_header(meta.etag, accept_gzip),
+                cache_header: "hit" if staleness is None else "stale",
+                **extra_headers,
+            })
+
+    # error responses are stored without stale window, i.e. they are fresh for as long as they exist
+    def is_fresh(cached_value, staleness, meta: CacheMeta):
+        return cached_value and (staleness is None or (meta is not None and meta.status_code in NEGATIVE_STATUS_CODES))
+
+    cached_value, staleness, cached_meta = (
+        await cache_instance.get_entry(cache_key, compressed=accept_gzip, stale_window=policy.stale_window)
+        if not bypass_cache_read
+        else (None, None, None)
+    )
 
-        if response.status_code == 404:
+    if is_fresh(cached_value, staleness, cached_meta):
+        count("hit")
+        return respond(*await cached_response_args(cached_value, accept_gzip, meta=cached_meta))
+
+    # stale while revalidate
+    if cached_value and staleness <= policy.stale_while_revalidate:
+        schedule_refresh(request, cache_key)
+        count("stale")
+        return respond(*await cached_response_args(cached_value, accept_gzip, "stale", cached_meta))
+
+    # conditions when do not cache
+    # - server errors (content_type is unset)
+    # - file downloads
+    def should_cache(content_type, headers) -> bool:
+        return (
+            (not bypass_cache_set)
+            and content_type is not None
+            and "content-disposition" not in headers
+        )
+
+    async def compute_response():
+        try:
+            response = await call_next(request)
+            status_code = 200
+            response_content_type = response.headers.get("content-type")
+            response_headers = response.headers
+
+            if response.status_code < 400:
+                # responses to other methods (e.g. results of batch requests) are not cached, forward them as they are produced
+                if not is_get:
+                    return CacheTee([], response.body_iterator), response.status_code, response_headers
+
+                chunks, complete = await read_ahead(response.body_iterator)
+
+                # streamed body: forward chunks to the client as they are produced
+                # the entry is committed once the stream completes
+                if not complete:
+                    async def commit(compressed: bytes, etag: str):
+                        meta = CacheMeta(status_code=status_code, content_type=response_content_type, etag=etag, created=time.time())
+                        await cache_instance.set_value(cache_key, compressed, ttl=policy.ttl, stale_window=policy.stale_window, meta=meta, compressed=True, tags=cache_tags)
+                        count("set")
+                    tee = CacheTee(chunks, response.body_iterator, commit if should_cache(response_content_type, response_headers) else None)
+                    return tee, status_code, response_headers
+                content = b"".join(chunks)
+            else:
+                content = await read_bytes(response.body_iterator)
+
+            if response.status_code >= 400:
+                status_code = response.status_code
+                # only deterministic errors are cached
+                response_content_type = "application/json" if status_code in NEGATIVE_STATUS_CODES else None
+                content = json.dumps({
+                    "error": True,
+                    status_code_key: status_code,
+                    "message": content.decode()
+                }).encode("utf-8")
+                response_headers = extra_headers
+            
+        except NotFound as e:
             status_code = 404
             response_content_type = "application/json"
             content = json.dumps({
                 "error": True,
                 status_code_key: status_code,
-                "message": content.decode()
+                "message": str(e)
             }).encode("utf-8")
             response_headers = extra_headers
-
-        elif response.status_code >= 400:
-            status_code = response.status_code
+        except Exception as e:
+            status_code = 500
             response_content_type = None
             content = json.dumps({
                 "error": True,
                 status_code_key: status_code,
-                "message": content.decode()
+                "message": str(e)
             }).encode("utf-8")
             response_headers = extra_headers
-        
-    except NotFound as e:
-        status_code = 404
-        response_content_type = "application/json"
-        content = json.dumps({
-            "error": True,
-            status_code_key: status_code,
-            "message": str(e)
-        }).encode("utf-8")
-        response_headers = extra_headers
-    except Exception as e:
-        status_code = 500
-        response_content_type = None
-        content = json.dumps({
-            "error": True,
-            status_code_key: status_code,
-            "message": str(e)
-        }).encode("utf-8")
-        response_headers = extra_headers
-        
+            
+
+        etag = compute_etag(content) if is_get and status_code == 200 else None
+        if etag:
+            response_headers = {**response_headers, "etag": etag_header(etag)}
+
+        if not should_cache(response_content_type, response_headers) or len(content) > CACHE_MAX_BODY_BYTES:
+            if status_code >= 400 and not bypass_cache_set:
+                negative_responses.labels("skipped").inc()
+            return content, status_code, response_headers
+
+        meta = CacheMeta(status_code=status_code, content_type=response_content_type, etag=etag, created=time.time())
+        if status_code not in NEGATIVE_STATUS_CODES:
+            await cache_instance.set_value(cache_key, content, ttl=policy.ttl, stale_window=policy.stale_window, meta=meta, tags=cache_tags)
+            count("set")
+        elif policy.negative_ttl:
+            await cache_instance.set_value(cache_key, content, ttl=policy.negative_ttl, meta=meta, tags=cache_tags)
+            negative_responses.labels("stores").inc()
+            count("set")
+        else:
+            negative_responses.labels("skipped").inc()
+        return content, status_code, response_headers
+
+    async def lookup_response():
+        cached_value, staleness, meta = await cache_instance.get_entry(cache_key, stale_window=policy.stale_window)
+        return (await cached_response_args(cached_value, meta=meta)) if is_fresh(cached_value, staleness, meta) else None
+
+    if not bypass_cache_read:
+        count("miss")
+
+    # coalesce concurrent misses of the same key, so that only one of them is computed
+    if bypass_cache_set:
+        content, status_code, response_headers = await compute_response()
+    else:
+        # the lock is held until a streamed response is committed
+        content, status_code, response_headers = await single_flight.run(
+            cache_key, compute_response, lookup_response, store=cache_instance,
+            pending=lambda result: result[0].done() if isinstance(result[0], CacheTee) else None,
+        )
 
-    # conditions when do not cache
-    if (not bypass_cache_set) and response_content_type == "application/json":
-        cache_instance.set_value(cache_key, content)
-    return Response(
-        content,
-        status_code=status_code,
-        headers=response_headers
-    )
+        # coalesced with a streamed response, which can only be consumed once
+        if isinstance(content, CacheTee) and not content.claim():
+            await content.wait(CACHE_LOCK_WAIT_SEC)
+            content, status_code, response_headers = (await lookup_response()) or (await compute_response())
+
+    # stale if error
+    if status_code >= 500 and cached_value and staleness is not None and staleness <= policy.stale_if_error:
+        general_logger.warning(f"Serving stale response of {cache_key}, recomputing failed with {status_code}")
+        content, status_code, response_headers = await cached_response_args(cached_value, accept_gzip, "stale", cached_meta)
+
+    return respond(content, status_code, response_headers)
 
 
 
@@ -290,11 +522,17 @@ async def middleware_add_version_header(request: Request, call_next):
     response.headers[siibra_version_header] = __version__
     return response
 
+hit_cache_log = {
+    "hit": "cache_hit",
+    "stale": "cache_stale",
+}
+
 @siibra_api.middleware("http")
 async def middleware_access_log(request: Request, call_next):
     """Access log middleware"""
     
-    if request.url.path in do_not_logs:
+    # warmup requests do not count towards the popularity of urls
+    if request.url.path in do_not_logs or request.headers.get(WARMUP_HEADER):
         return await call_next(request)
     
     start_time = time.time()
@@ -304,7 +542,7 @@ async def middleware_access_log(request: Request, call_next):
         access_logger.info(f"{request.method.upper()} {str(request.url)}", extra={
             "resp_status": str(resp.status_code),
             "process_time_ms": str(round(process_time)),
-            "hit_cache": "cache_hit" if resp.headers.get(cache_header) == "hit" else "cache_miss"
+            "hit_cache": hit_cache_log.get(resp.headers.get(cache_header), "cache_miss")
         })
         return resp
     
@@ -385,6 +623,15 @@ def get_metrics():
     return prom_metrics_resp()
 
 
+siibra_api.include_router(admin_router, prefix="/admin", include_in_schema=False)
+
+
+@siibra_api.post("/batch", include_in_schema=False)
+async def post_batch(request: Request, batch: BatchRequestModel):
+    """Issue a batch of GET requests (see `api.server.batch`). Results are streamed as newline delimited json, one line per request, as they complete."""
+    return StreamingResponse(stream_batch(request, batch.requests, get_url_bypass_reason), media_type=BATCH_MEDIA_TYPE)
+
+
 @siibra_api.get("/ready", include_in_schema=False)
 def get_ready():
     """Ready probe
@@ -395,15 +642,19 @@ def get_ready():
 
 # TODO lifespan not working properly. Fix and use lifespan in future
 @siibra_api.on_event("shutdown")
-def shutdown():
-    terminate()
+async def shutdown():
+    await terminate()
+    await results_terminate()
+    spill_on_terminate()
     metrics_on_terminate()
     
 
 @siibra_api.on_event("startup")
-def startup():
+async def startup():
     on_startup()
+    spill_on_startup()
     metrics_on_startup()
+    await warmup_on_startup(siibra_api, get_cache_instance(), get_url_bypass_reason)
 
 
 import logging
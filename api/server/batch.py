@@ -0,0 +1,266 @@
+"""Batch of GET requests against the routes of siibra-api (sub-requests), answered in a single response.
+
+Sub-requests, which may be served from the response cache, are looked up at once (see `CacheTiered.get_entries`), i.e.
+with a single pipelined round trip per redis node, and fresh hits are answered right away. The others are issued in
+process (see `internal_request`), concurrently. They traverse all middlewares as if they came from the network: misses
+are coalesced, computed by the workers (the tasks of all sub-requests being in flight at once) and cached.
+
+Results are streamed as newline delimited json, one line per sub-request (see `BatchItem`), as they complete.
+
+Sub-requests are restricted to the versioned API (e.g. `/v3_0/...`, see `get_api_prefixes`). Credentials of the batch
+request (e.g. `Authorization`) are forwarded only to routes declaring them.
+"""
+
+from collections import defaultdict
+from fastapi import Request
+from prometheus_client import Counter
+from pydantic import BaseModel, Field
+from starlette.routing import BaseRoute, Mount
+from starlette.types import Scope
+from typing import Any, AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+import asyncio
+import json
+import re
+import time
+from api.siibra_api_config import BATCH_MAX_REQUESTS, BATCH_CONCURRENCY
+from api.common import access_logger
+from api.server.const import cache_header
+from api.server.util import internal_request
+from api.server.code_snippet import lookup_handler_fn
+from api.server.cache import get_instance as get_cache_instance
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.meta import CacheMeta, get_cached_status_code
+from api.server.cache.policy import CachePolicy, get_policy, NEGATIVE_STATUS_CODES
+from api.server.cache.key import get_cache_key
+from api.server.cache.fingerprint import get_route_template
+from api.server.cache.stats import route_requests, negative_responses
+from api.server.cache.warmup import WARMUP_HEADER
+
+BATCH_MEDIA_TYPE = "application/x-ndjson"
+"""Media type of batch responses"""
+
+_scope_keys = ("type", "asgi", "http_version", "scheme", "server", "client", "root_path")
+
+# headers of the batch request, which are not forwarded to sub-requests
+# sub-request bodies are embedded decompressed, so their encoding is not negotiated
+_batch_headers = (b"content-type", b"content-length", b"accept-encoding", b"if-none-match")
+
+# headers of the batch request, which are forwarded only to routes declaring them (see `needs_credentials`)
+_credential_headers = (b"authorization", b"proxy-authorization", b"cookie")
+
+_api_mount_re = re.compile(r"^/v\d+_\d+$")
+
+batch_requests = Counter("batch", "Batch requests (batches, requests, hits, fetched), see POST /batch", ("counter",))
+"""Counters are `batches`, `requests` (sub-requests), `hits` (served by the bulk lookup) and `fetched` (issued in process)"""
+
+class BatchRequestModel(BaseModel):
+    """Body of a batch request"""
+    requests: List[str] = Field(..., min_items=1, max_items=BATCH_MAX_REQUESTS, description="path and query of GET requests, e.g. `/v3_0/spaces?page=1`")
+
+class BatchItem(NamedTuple):
+    """Result of a sub-request, as streamed"""
+    index: int
+    """index of the sub-request in the batch"""
+    url: str
+    status: int
+    cache: Optional[str]
+    """`hit` or `stale`, if served from the response cache (see `cache_header`)"""
+    body: Any
+    """json body of the response. None, if the response is not json (issue the request on its own, to get it)"""
+
+    def dumps(self) -> bytes:
+        """Serialize as a line of newline delimited json"""
+        return (json.dumps(self._asdict()) + "\n").encode("utf-8")
+
+def get_error_body(status_code: int, message: str):
+    """Get the body of an error, as serialized by the cache middleware"""
+    return {"error": True, "status_code": status_code, "message": message}
+
+def parse_body(content: bytes, content_type: Optional[str]):
+    """Parse the body of a response, if it is json. Returns None otherwise."""
+    if "json" not in (content_type or ""):
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+def get_api_prefixes(app) -> Tuple[str, ...]:
+    """Get the paths of the versioned API mounts of app (e.g. `/v3_0`, see `VersionedFastAPI`)"""
+    return tuple(route.path for route in app.routes if isinstance(route, Mount) and _api_mount_re.match(route.path))
+
+def needs_credentials(route: BaseRoute) -> bool:
+    """If the route (or any of its dependencies) declares credentials, i.e. a security scheme, an `Authorization` header or cookies"""
+    dependants = [getattr(route, "dependant", None)]
+    while dependants:
+        dependant = dependants.pop()
+        if dependant is None:
+            continue
+        if dependant.security_requirements or dependant.cookie_params:
+            return True
+        if any(param.alias.lower() in ("authorization", "proxy-authorization") for param in dependant.header_params):
+            return True
+        dependants.extend(dependant.dependencies)
+    return False
+
+def get_sub_scope(app, scope: Scope, url: str) -> Scope:
+    """Get the scope of a sub-request, on behalf of the batch request of scope. Headers are forwarded, except
+    credentials (see `_credential_headers`), unless the matched route declares them (see `needs_credentials`).
+
+    Args:
+        app: FastAPI app
+        scope: scope of the batch request
+        url: path and query, e.g. `/v3_0/spaces?page=1`
+
+    Returns:
+        scope
+
+    Raises:
+        ValueError: if url is not a (percent encoded) absolute path of the versioned API (see `get_api_prefixes`)"""
+    path, _, query = url.partition("?")
+    if not path.startswith("/") or path.startswith("//"):
+        raise ValueError(f"{url} is not an absolute path")
+    try:
+        raw_path, query_string = path.encode("ascii"), query.encode("ascii")
+    except UnicodeEncodeError:
+        raise ValueError(f"{url} is not percent encoded")
+    decoded_path = unquote(path)
+    if not any(decoded_path.startswith(prefix + "/") for prefix in get_api_prefixes(app)):
+        raise ValueError(f"{url} is not a path of the versioned API")
+    sub_scope = {
+        **{key: scope[key] for key in _scope_keys if key in scope},
+        "method": "GET",
+        "path": decoded_path,
+        "raw_path": raw_path,
+        "query_string": query_string,
+        "headers": [(key, value) for key, value in scope.get("headers", []) if key.lower() not in _batch_headers],
+    }
+    matched = lookup_handler_fn(app, sub_scope)
+    if not (matched and needs_credentials(matched[0])):
+        sub_scope["headers"] = [(key, value) for key, value in sub_scope["headers"] if key.lower() not in _credential_headers]
+    return sub_scope
+
+def get_cache_lookup(app, scope: Scope, bypass_reason: Callable[[str, str], Optional[str]]=None) -> Optional[Tuple[str, CachePolicy, str]]:
+    """Get how to look up the cached response of a sub-request, as the cache middleware would.
+
+    Args:
+        app: FastAPI app
+        scope: scope of the sub-request
+        bypass_reason: get the reason to bypass the cache of a url (path, query), see `get_url_bypass_reason`
+
+    Returns:
+        cache key, policy and route template. None if the sub-request is to be issued (e.g. it bypasses the cache, or matches no route)"""
+    request = Request(scope)
+    if (
+        request.headers.get("authorization")
+        or request.headers.get("x-bypass-fastapi-cache")
+        or request.headers.get("cache-control") == "no-cache"
+        or request.headers.get("accept") == "text/x-sapi-python"
+    ):
+        return None
+    if bypass_reason is not None and bypass_reason(request.url.path, request.url.query):
+        return None
+    matched = lookup_handler_fn(app, scope)
+    if not matched:
+        return None
+    policy = get_policy(matched)
+    return get_cache_key(request, matched, policy), policy, get_route_template(app, matched[0])
+
+def get_cached_item(index: int, url: str, value, meta: Optional[CacheMeta]) -> BatchItem:
+    """Get the result of a sub-request, from its cached (decompressed) value"""
+    content = CacheGzipRedis.getbytes(value)
+    # entries cached without metadata are always json
+    if meta is None:
+        meta = CacheMeta(status_code=get_cached_status_code(content[:64]))
+    return BatchItem(index, url, meta.status_code, "hit", parse_body(content, meta.content_type))
+
+async def fetch_item(app, index: int, url: str, scope: Scope) -> BatchItem:
+    """Issue a sub-request in process (see `internal_request`)"""
+    try:
+        status_code, headers, content = await internal_request(app, scope)
+    except Exception as e:
+        return BatchItem(index, url, 500, None, get_error_body(500, str(e)))
+    headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in headers}
+    # errors are serialized as json by the cache middleware, without content type
+    content_type = headers.get("content-type") or ("application/json" if status_code >= 400 else None)
+    return BatchItem(index, url, status_code, headers.get(cache_header), parse_body(content, content_type))
+
+async def stream_batch(request: Request, urls: List[str], bypass_reason: Callable[[str, str], Optional[str]]=None, concurrency: int=BATCH_CONCURRENCY) -> AsyncIterator[bytes]:
+    """Answer the sub-requests of a batch request.
+
+    Args:
+        request: batch request
+        urls: path and query of the sub-requests
+        bypass_reason: see `get_cache_lookup`
+        concurrency: maximum number of sub-requests issued at a time
+
+    Yields:
+        result of each sub-request (see `BatchItem.dumps`), in the order they complete"""
+    app = request.app
+    batch_requests.labels("batches").inc()
+    batch_requests.labels("requests").inc(len(urls))
+
+    scopes: Dict[int, Scope] = {}
+    lookups: Dict[int, Tuple[str, CachePolicy, str]] = {}
+    for index, url in enumerate(urls):
+        try:
+            scopes[index] = get_sub_scope(app, request.scope, url)
+        except ValueError as e:
+            yield BatchItem(index, url, 400, None, get_error_body(400, str(e))).dumps()
+            continue
+        lookup = get_cache_lookup(app, scopes[index], bypass_reason)
+        if lookup is not None:
+            lookups[index] = lookup
+
+    # the stale window differs by policy, look up the keys of each window at once
+    start = time.time()
+    window_idxs: Dict[float, List[int]] = defaultdict(list)
+    for index, (_, policy, _) in lookups.items():
+        window_idxs[policy.stale_window].append(index)
+    windows = list(window_idxs)
+    cache_instance = get_cache_instance()
+    results = await asyncio.gather(*[
+        cache_instance.get_entries([lookups[index][0] for index in window_idxs[window]], stale_window=window)
+        for window in windows
+    ])
+    lookup_ms = str(round((time.time() - start) * 1000))
+    log_hits = not request.headers.get(WARMUP_HEADER)
+
+    # fresh hits are answered right away. Stale entries are served (and refreshed) by the cache middleware
+    # error responses are stored without stale window, i.e. they are fresh for as long as they exist
+    for window, entries in zip(windows, results):
+        for index, (value, staleness, meta) in zip(window_idxs[window], entries):
+            if not value or not (staleness is None or (meta is not None and meta.status_code in NEGATIVE_STATUS_CODES)):
+                continue
+            item = get_cached_item(index, urls[index], value, meta)
+            template = lookups[index][2]
+            route_requests.labels(template, "hit").inc()
+            if item.status in NEGATIVE_STATUS_CODES:
+                negative_responses.labels("hits").inc()
+                route_requests.labels(template, "negative_hit").inc()
+            batch_requests.labels("hits").inc()
+            # logged as if requested on its own, so that it counts towards the popularity of its url (see `plan_warmup`)
+            if log_hits:
+                access_logger.info(f"GET {str(Request(scopes[index]).url)}", extra={
+                    "resp_status": str(item.status),
+                    "process_time_ms": lookup_ms,
+                    "hit_cache": "cache_hit",
+                })
+            scopes.pop(index)
+            yield item.dumps()
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    async def fetch(index: int, scope: Scope) -> BatchItem:
+        async with semaphore:
+            batch_requests.labels("fetched").inc()
+            return await fetch_item(app, index, urls[index], scope)
+
+    tasks = [asyncio.create_task(fetch(index, scope)) for index, scope in scopes.items()]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            yield (await completed).dumps()
+    finally:
+        # e.g. the client disconnected
+        for task in tasks:
+            task.cancel()
@@ -1,26 +1,50 @@
+from typing import List, Union
 from .redis import CacheGzipRedis, terminate as redis_terminate, on_startup as redis_on_startup
+from .memory import CacheLruMemory
+from .shared import CacheSharedMemory
+from .sharded import CacheShardedRedis
+from .tiered import CacheTiered
+from .singleflight import SingleFlight
+from api.siibra_api_config import (
+    MEMORY_CACHE_SIZE_BYTES, MEMORY_CACHE_TTL_SEC, IS_CI, CACHE_LOCK_TTL_SEC, CACHE_LOCK_WAIT_SEC,
+    SHARED_CACHE_SIZE_BYTES, SHARED_CACHE_PATH, SHARED_CACHE_TTL_SEC, CACHE_NODES, CACHE_NODE_VNODES,
+)
+from api.common import general_logger
 
-class DummyCache:
-    """Dummystore to be used if no store is available."""
-    def get_value(self, *args):
-        return None
-    def set_value(self, *args):
-        return None
+single_flight = SingleFlight(CACHE_LOCK_TTL_SEC, CACHE_LOCK_WAIT_SEC)
+"""Coalesce concurrent cache misses"""
 
-def get_instance():
-    """Get the store singleton"""
+_redis: Union[CacheGzipRedis, CacheShardedRedis] = CacheShardedRedis(CACHE_NODES, CACHE_NODE_VNODES) if CACHE_NODES else CacheGzipRedis()
+
+_tiers = [("redis", _redis)]
+if SHARED_CACHE_SIZE_BYTES > 0 and not IS_CI:
     try:
-        redis_cache = CacheGzipRedis()
-        if redis_cache is None or not redis_cache.is_connected:
-            raise Exception(f"Nonetype redis cache")
-        return redis_cache
-    except Exception as e:
-        return DummyCache()
+        _tiers.insert(0, ("shared", CacheSharedMemory(SHARED_CACHE_PATH, SHARED_CACHE_SIZE_BYTES, SHARED_CACHE_TTL_SEC)))
+    except OSError as e:
+        general_logger.warning(f"Cannot map shared cache {SHARED_CACHE_PATH}, continuing without: {str(e)}")
+if MEMORY_CACHE_SIZE_BYTES > 0 and not IS_CI:
+    _tiers.insert(0, ("memory", CacheLruMemory(MEMORY_CACHE_SIZE_BYTES, MEMORY_CACHE_TTL_SEC)))
+
+_tiered_cache = CacheTiered(_tiers)
+
+def get_instance() -> CacheTiered:
+    """Get the store singleton. If redis is not available, lookups are treated as misses."""
+    return _tiered_cache
+
+def get_redis_nodes() -> List[CacheGzipRedis]:
+    """Get the redis nodes of the store (see `CACHE_NODES`), e.g. to scan the keyspace"""
+    return list(_redis.nodes) if isinstance(_redis, CacheShardedRedis) else [_redis]
 
 def on_startup():
     """On startup call"""
-    redis_on_startup()
+    if isinstance(_redis, CacheShardedRedis):
+        _redis.on_startup()
+    else:
+        redis_on_startup()
 
-def terminate():
+async def terminate():
     """On terminate call"""
-    redis_terminate()
+    if isinstance(_redis, CacheShardedRedis):
+        await _redis.terminate()
+    else:
+        await redis_terminate()
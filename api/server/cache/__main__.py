@@ -0,0 +1,165 @@
+"""Maintenance commands of the response cache.
+
+Running any command imports `api.server`, i.e. the app. Run them with `SIIBRA_API_ROLE=server`: in the (default) `all`
+role, importing the app loads the data handlers in process, and fetches the siibra configuration.
+
+```sh
+# route fingerprints of this version, e.g. stored on each release
+SIIBRA_API_ROLE=server python -m api.server.cache manifest > manifest-0.3.35.json
+
+# routes, whose cache entries are not carried over between two versions
+SIIBRA_API_ROLE=server python -m api.server.cache diff manifest-0.3.34.json manifest-0.3.35.json
+
+# drop the cached responses depending on an atlas concept, e.g. after its configuration is updated
+SIIBRA_API_ROLE=server python -m api.server.cache invalidate parcellation:minds/core/parcellationatlas/v1.0.0/94c1125b-b87e-45e4-901c-00daee7f2579-290
+
+# delete spilled responses (see CACHE_SPILL_DIR) not written for longer than a day, e.g. after lowering time to live
+SIIBRA_API_ROLE=server python -m api.server.cache sweep-spill --max-age 86400
+
+# warm a new deployment with the 500 most valuable requests of the last day (from the access logs in LOGGER_DIR)
+SIIBRA_API_ROLE=server python -m api.server.cache warmup --base-url http://siibra-api-next:5000 --top 500
+
+# opt in to zstd: train a dictionary (none is shipped) from responses cached in redis (or from sample files), then
+# set SIIBRA_API_CACHE_ZSTD_MAX_BYTES=65536
+SIIBRA_API_ROLE=server python -m api.server.cache train-dictionary --samples 10000
+```
+"""
+
+from pathlib import Path
+from typing import List
+import argparse
+import asyncio
+import json
+
+def manifest(args):
+    from api.server import api as siibra_api
+    from .fingerprint import get_manifest
+    print(json.dumps(get_manifest(siibra_api), indent=2, sort_keys=True))
+
+def diff(args):
+    from .fingerprint import diff_manifests
+    old = json.loads(Path(args.old).read_text())
+    new = json.loads(Path(args.new).read_text())
+    for status, route in diff_manifests(old, new):
+        print(f"{status:8} {route}")
+
+def invalidate(args):
+    from . import get_instance, on_startup, terminate
+
+    async def run():
+        on_startup()
+        try:
+            return await get_instance().invalidate_tags(args.tags)
+        finally:
+            await terminate()
+
+    keys = asyncio.run(run())
+    for key in keys:
+        print(key)
+    print(f"Invalidated {len(keys)} keys tagged with {', '.join(args.tags)}")
+
+def sweep_spill(args):
+    from api.siibra_api_config import CACHE_SPILL_DIR
+    from .spill import sweep
+    deleted = sweep(args.max_age)
+    print(f"Deleted {deleted} spilled responses from {CACHE_SPILL_DIR}")
+
+def warmup(args):
+    from datetime import datetime, timedelta
+    from api.server.api import siibra_api, get_url_bypass_reason
+    from .warmup import get_access_log_paths, read_access_logs, plan_warmup, warm, in_process_fetch, remote_fetch, format_report
+    from . import on_startup, terminate
+
+    paths = [Path(f) for f in args.logs] if args.logs else get_access_log_paths()
+    if not paths:
+        raise SystemExit("No access logs (is LOGGER_DIR set?)")
+    since = datetime.now() - timedelta(seconds=args.window)
+    plan = plan_warmup(read_access_logs(paths, since), siibra_api, args.top, get_url_bypass_reason)
+
+    print(f"{plan.requests} requests logged since {since:%Y-%m-%d %H:%M}, {plan.cacheable} may be cached")
+    for stats in plan.templates[:20]:
+        print(f"{stats.requests:8} x {stats.latency_ms:8.0f}ms  {stats.template}")
+    if args.dry_run:
+        for url in plan.urls:
+            print(f"{plan.url_requests[url]:8}  {url}")
+        return
+
+    async def run():
+        if args.base_url:
+            return await warm(plan, remote_fetch(args.base_url, args.request_timeout), args.concurrency, args.timeout)
+        on_startup()
+        try:
+            return await warm(plan, in_process_fetch(siibra_api), args.concurrency, args.timeout)
+        finally:
+            await terminate()
+
+    print(format_report(asyncio.run(run())))
+
+def train_dictionary(args):
+    from .codec import zstandard, sample_redis
+
+    if zstandard is None:
+        raise SystemExit("zstandard is not installed")
+
+    if args.files:
+        samples = [Path(f).read_bytes() for f in args.files]
+    else:
+        samples = asyncio.run(sample_redis(args.samples))
+
+    # dictionaries are useful for small payloads only
+    samples = [sample for sample in samples if len(sample) <= args.max_bytes]
+    if not samples:
+        raise SystemExit("No samples")
+
+    dictionary = zstandard.train_dictionary(args.size, samples)
+    Path(args.out).write_bytes(dictionary.as_bytes())
+    print(f"Trained dictionary {dictionary.dict_id()} ({len(dictionary.as_bytes())} bytes) from {len(samples)} samples, written to {args.out}")
+
+def main(argv: List[str]=None):
+    from .codec import DEFAULT_DICT_PATH, DICT_SAMPLE_MAX_BYTES
+    from .tags import TAG_PARAMS
+    from api.siibra_api_config import CACHE_SPILL_MAX_AGE_SEC, CACHE_WARMUP_TOP, CACHE_WARMUP_CONCURRENCY, CACHE_WARMUP_WINDOW_SEC
+
+    parser = argparse.ArgumentParser(prog="python -m api.server.cache", description="Maintenance commands of the response cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    manifest_parser = subparsers.add_parser("manifest", help="print the route fingerprints of this version (as json)")
+    manifest_parser.set_defaults(run=manifest)
+
+    diff_parser = subparsers.add_parser("diff", help="list routes, whose fingerprint changed between two manifests")
+    diff_parser.add_argument("old", help="path to manifest")
+    diff_parser.add_argument("new", help="path to manifest")
+    diff_parser.set_defaults(run=diff)
+
+    invalidate_parser = subparsers.add_parser("invalidate", help="delete cached responses depending on atlas concepts")
+    invalidate_parser.add_argument("tags", nargs="+", help=f"tags, in the form of <kind>:<id>, where kind is one of {', '.join(sorted(set(TAG_PARAMS.values())))}")
+    invalidate_parser.set_defaults(run=invalidate)
+
+    sweep_parser = subparsers.add_parser("sweep-spill", help="delete spilled responses, which have not been written for a while")
+    sweep_parser.add_argument("--max-age", type=float, default=CACHE_SPILL_MAX_AGE_SEC, help="seconds since the response was last written")
+    sweep_parser.set_defaults(run=sweep_spill)
+
+    warmup_parser = subparsers.add_parser("warmup", help="issue the most valuable requests of the access logs (by popularity and latency)")
+    warmup_parser.add_argument("logs", nargs="*", help="access logs. If not provided, those in LOGGER_DIR")
+    warmup_parser.add_argument("--base-url", help="url of the deployment to warm. If not provided, requests are issued in process")
+    warmup_parser.add_argument("--top", type=int, default=CACHE_WARMUP_TOP, help="number of requests to issue")
+    warmup_parser.add_argument("--concurrency", type=int, default=CACHE_WARMUP_CONCURRENCY, help="maximum number of concurrent requests")
+    warmup_parser.add_argument("--window", type=float, default=CACHE_WARMUP_WINDOW_SEC, help="seconds of access logs to consider")
+    warmup_parser.add_argument("--timeout", type=float, help="seconds, after which no further requests are issued")
+    warmup_parser.add_argument("--request-timeout", type=float, default=600, help="seconds to wait for each response (with --base-url)")
+    warmup_parser.add_argument("--dry-run", action="store_true", help="print the planned requests, without issuing them")
+    warmup_parser.set_defaults(run=warmup)
+
+    train_parser = subparsers.add_parser("train-dictionary", help="train a zstd dictionary from sample responses (none is shipped, zstd is opt-in, see CACHE_ZSTD_MAX_BYTES)")
+    train_parser.add_argument("files", nargs="*", help="sample responses. If not provided, sampled from redis")
+    train_parser.add_argument("--out", default=str(DEFAULT_DICT_PATH), help="output path of the dictionary")
+    train_parser.add_argument("--size", type=int, default=112640, help="size of the dictionary in bytes")
+    train_parser.add_argument("--samples", type=int, default=10000, help="maximum number of samples read from redis")
+    train_parser.add_argument("--max-bytes", type=int, default=DICT_SAMPLE_MAX_BYTES, help="maximum size of samples")
+    train_parser.set_defaults(run=train_dictionary)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+import asyncio
+import gzip
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from api.siibra_api_config import CACHE_ZSTD_MAX_BYTES, CACHE_ZSTD_DICT
+from api.common import general_logger
+from .stats import entry_bytes, codec_seconds
+
+GZIP_MAGIC = b"\x1f\x8b"
+"""Leading bytes of gzip stream"""
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+"""Leading bytes of zstd frame"""
+
+OFFLOAD_BYTES = 64 * 1024
+"""Values larger than this are (de)compressed in a thread pool, rather than on the event loop"""
+
+DEFAULT_DICT_PATH = Path(__file__).parent / "responses.zdict"
+"""Path the zstd dictionary is read from, unless `CACHE_ZSTD_DICT` is set. No dictionary is shipped: zstd is opt-in (see
+`CACHE_ZSTD_MAX_BYTES`), with a dictionary trained by operators (see `python -m api.server.cache train-dictionary`)."""
+
+GZIP_LEVELS = ((1024 * 1024, 9), (None, 6))
+"""(max payload size, level) of gzip. Large payloads are compressed faster, at a slightly lower ratio."""
+
+ZSTD_LEVELS = ((4 * 1024, 19), (None, 9))
+"""(max payload size, level) of zstd"""
+
+DICT_SAMPLE_MAX_BYTES = 64 * 1024
+"""Responses up to this size are sampled to train a zstd dictionary. Set `CACHE_ZSTD_MAX_BYTES` accordingly, when opting in to zstd with the dictionary."""
+
+_codec_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-codec")
+
+class CodecError(Exception):
+    """Stored value cannot be decompressed (e.g. unknown codec, or unknown dictionary)"""
+
+async def run_codec(fn: Callable[[bytes], Union[str, bytes]], value: Union[str, bytes]) -> Union[str, bytes]:
+    """Run a (de)compression function. Large values are offloaded to a thread pool (zlib and zstd release the GIL).
+
+    Args:
+        fn: function to run
+        value: value to be (de)compressed
+
+    Returns:
+        return value of fn"""
+    if len(value) < OFFLOAD_BYTES:
+        return fn(value)
+    return await asyncio.get_running_loop().run_in_executor(_codec_executor, fn, value)
+
+def _level(levels: Iterable[Tuple[Optional[int], int]], size: int) -> int:
+    for max_size, level in levels:
+        if max_size is None or size <= max_size:
+            return level
+
+class Codec:
+    """Compression codec of stored values. Stored values carry their codec as leading (magic) bytes."""
+
+    name: str
+    magic: bytes
+    levels: Tuple[Tuple[Optional[int], int], ...]
+
+    def level(self, size: int) -> int:
+        """Compression level of a payload of `size` bytes"""
+        return _level(self.levels, size)
+
+    def compress(self, value: bytes, level: int) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, value: bytes) -> bytes:
+        raise NotImplementedError
+
+class GzipCodec(Codec):
+    """gzip. Clients accepting gzip are served stored gzip bytes as is."""
+
+    name = "gzip"
+    magic = GZIP_MAGIC
+    levels = GZIP_LEVELS
+
+    def compress(self, value: bytes, level: int) -> bytes:
+        return gzip.compress(value, compresslevel=level)
+
+    def decompress(self, value: bytes) -> bytes:
+        return gzip.decompress(value)
+
+class ZstdCodec(Codec):
+    """zstd, optionally with a dictionary trained on sample responses. Requires `zstandard`.
+
+    Frames carry the id of the dictionary they were compressed with. Frames compressed with an unknown dictionary cannot be decompressed."""
+
+    name = "zstd"
+    magic = ZSTD_MAGIC
+    levels = ZSTD_LEVELS
+
+    def __init__(self, dict_data: Optional[bytes]=None):
+        """
+        Args:
+            dict_data: content of the dictionary file
+        """
+        self.dictionary = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+        # compressors are not thread safe, and run_codec may run in several threads
+        self._local = threading.local()
+
+    @property
+    def dict_id(self) -> int:
+        return self.dictionary.dict_id() if self.dictionary else 0
+
+    def _compressor(self, level: int):
+        compressors = self._local.__dict__.setdefault("compressors", {})
+        if level not in compressors:
+            compressors[level] = zstandard.ZstdCompressor(level=level, dict_data=self.dictionary)
+        return compressors[level]
+
+    def _decompressor(self, dict_id: int):
+        decompressors = self._local.__dict__.setdefault("decompressors", {})
+        if dict_id not in decompressors:
+            if dict_id not in (0, self.dict_id):
+                raise CodecError(f"Unknown zstd dictionary {dict_id}")
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=self.dictionary if dict_id else None)
+        return decompressors[dict_id]
+
+    def compress(self, value: bytes, level: int) -> bytes:
+        return self._compressor(level).compress(value)
+
+    def decompress(self, value: bytes) -> bytes:
+        try:
+            dict_id = zstandard.get_frame_parameters(value).dict_id
+            return self._decompressor(dict_id).decompress(value)
+        except zstandard.ZstdError as e:
+            raise CodecError(str(e)) from e
+
+def _load_zstd() -> Optional[ZstdCodec]:
+    if zstandard is None:
+        return None
+    dict_path = Path(CACHE_ZSTD_DICT) if CACHE_ZSTD_DICT else DEFAULT_DICT_PATH
+    try:
+        return ZstdCodec(dict_path.read_bytes())
+    except FileNotFoundError:
+        if CACHE_ZSTD_DICT:
+            general_logger.warning(f"zstd dictionary {CACHE_ZSTD_DICT} not found, compressing without dictionary")
+        return ZstdCodec()
+
+gzip_codec = GzipCodec()
+zstd_codec = _load_zstd()
+"""None if zstandard is not installed"""
+
+_codecs: List[Codec] = [codec for codec in (gzip_codec, zstd_codec) if codec is not None]
+
+def get_codec(value: bytes) -> Optional[Codec]:
+    """Identify the codec of a stored value, by its leading bytes.
+
+    Args:
+        value: stored value
+
+    Returns:
+        Codec, or None if the value is not compressed (or compressed with a codec not available)"""
+    for codec in _codecs:
+        if value.startswith(codec.magic):
+            return codec
+    return None
+
+def select_codec(size: int) -> Codec:
+    """Choose the codec by payload size. Small payloads (up to `CACHE_ZSTD_MAX_BYTES`) are compressed with zstd (if available),
+    on which a dictionary is most effective. Larger payloads are gzipped, so that they can be served to clients as is.
+
+    Args:
+        size: payload size in bytes
+
+    Returns:
+        Codec"""
+    if zstd_codec is not None and size <= CACHE_ZSTD_MAX_BYTES:
+        return zstd_codec
+    return gzip_codec
+
+async def compress(value: bytes, codec: Codec=None) -> bytes:
+    """Compress value, see `run_codec`
+
+    Args:
+        value: bytes
+        codec: if not provided, chosen by size (see `select_codec`)
+
+    Returns:
+        compressed value"""
+    codec = codec or select_codec(len(value))
+    with codec_seconds.labels("encode", codec.name).time():
+        compressed = await run_codec(partial(codec.compress, level=codec.level(len(value))), value)
+    entry_bytes.labels("identity").observe(len(value))
+    entry_bytes.labels(codec.name).observe(len(compressed))
+    return compressed
+
+async def decompress(value: bytes) -> bytes:
+    """Decompress value with its codec, see `run_codec`
+
+    Args:
+        value: compressed value
+
+    Returns:
+        decompressed value
+
+    Raises:
+        CodecError: codec of value is unknown (or not available)"""
+    codec = get_codec(value)
+    if codec is None:
+        raise CodecError(f"Unknown codec {value[:4]!r}")
+    with codec_seconds.labels("decode", codec.name).time():
+        return await run_codec(codec.decompress, value)
+
+async def sample_redis(limit: int) -> List[bytes]:
+    """Sample (decompressed) cached responses from redis, e.g. to train a zstd dictionary.
+
+    Only keys of cached responses are scanned (see `RESPONSE_KEY_MATCH`), as the redis may be shared with celery. Values
+    are read as stored, i.e. legacy entries are not migrated. Spilled and legacy (base64) entries are not sampled.
+
+    Args:
+        limit: maximum number of samples
+
+    Returns:
+        list of samples"""
+    from redis.exceptions import ResponseError
+    from . import get_redis_nodes, on_startup, terminate
+    from .redis import CacheGzipRedis, LOCK_KEY_PREFIX, RESPONSE_KEY_MATCH
+    from .meta import META_KEY_PREFIX
+    from .tags import TAG_KEY_PREFIX
+    from .spill import is_pointer
+    on_startup()
+    samples = []
+    try:
+        for store in get_redis_nodes():
+            async for key in store._r.scan_iter(match=RESPONSE_KEY_MATCH, count=1000):
+                key = CacheGzipRedis.getstr(key)
+                if key.startswith((META_KEY_PREFIX, LOCK_KEY_PREFIX, TAG_KEY_PREFIX)):
+                    continue
+                try:
+                    stored = await store._r.get(key)
+                except ResponseError:
+                    # not a string, e.g. WRONGTYPE
+                    continue
+                if not stored or is_pointer(stored) or get_codec(stored) is None:
+                    continue
+                try:
+                    samples.append(await decompress(stored))
+                except CodecError:
+                    continue
+                if len(samples) >= limit:
+                    return samples
+    finally:
+        await terminate()
+    return samples
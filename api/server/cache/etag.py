@@ -0,0 +1,57 @@
+from hashlib import blake2b
+from typing import Union, Optional
+
+GZIP_ETAG_SUFFIX = "-gzip"
+"""Suffix of the entity tag of the gzip encoded representation"""
+
+def etag_hash():
+    """Get a hash object, to compute the content hash of a response body incrementally (see `compute_etag`)"""
+    return blake2b(digest_size=16)
+
+def compute_etag(content: Union[str, bytes]) -> str:
+    """Compute content hash of a (uncompressed) response body
+
+    Args:
+        content: response body
+
+    Returns:
+        hex digest of the content hash"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    content_hash = etag_hash()
+    content_hash.update(content)
+    return content_hash.hexdigest()
+
+def etag_header(etag: str, compressed: bool=False) -> str:
+    """Format content hash as strong entity tag. The gzip encoded representation gets a distinct tag.
+
+    Args:
+        etag: content hash, as returned by `compute_etag`
+        compressed: if the body is sent gzip encoded
+
+    Returns:
+        value of the ETag header"""
+    return f'"{etag}{GZIP_ETAG_SUFFIX if compressed else ""}"'
+
+def _normalize(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    if tag.endswith(GZIP_ETAG_SUFFIX):
+        tag = tag[:-len(GZIP_ETAG_SUFFIX)]
+    return tag
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Check if the If-None-Match header matches the entity tag, regardless of content encoding (weak comparison).
+
+    Args:
+        if_none_match: value of If-None-Match header
+        etag: content hash (as returned by `compute_etag`), or value of ETag header
+
+    Returns:
+        if the client already holds the content"""
+    if not if_none_match or not etag:
+        return False
+    etag = _normalize(etag)
+    return any(_normalize(tag) == etag for tag in if_none_match.split(","))
@@ -0,0 +1,234 @@
+from functools import partial, lru_cache
+from hashlib import blake2b
+from importlib import metadata
+from importlib.util import resolve_name
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import ast
+import inspect
+import re
+import sys
+import warnings
+from starlette.routing import BaseRoute, Mount
+from api.siibra_api_config import SIIBRA_USE_CONFIGURATION, CACHE_SALT, get_config_dir_short_hash
+from api.common import name_to_fns_map
+
+_api_dir = Path(__file__).parent.parent.parent
+_new_api_dir = _api_dir.parent / "new_api"
+
+CACHE_FORMAT_VERSION = 1
+"""Version of the format of cached responses, e.g. of their encoding, metadata, error bodies or keys. Bump it whenever
+the stored format changes, so that entries written by previous versions are no longer read."""
+
+SERIALIZATION_DIRS = (_api_dir / "serialization", _api_dir / "models", _new_api_dir / "v3" / "serialization", _new_api_dir / "v3" / "models")
+"""Source directories shaping (the serialization of) all responses. Serializers are looked up by type, rather than imported by data handlers"""
+
+DATA_HANDLER_PACKAGES = ("api.common.data_handlers", "new_api.data_handlers")
+"""Packages of data handlers. Modules of these packages imported by the module of a handler are part of its fingerprint"""
+
+SIIBRA_REQUIREMENTS = _api_dir.parent / "requirements" / "siibra.txt"
+"""siibra version is read from the requirements of workers"""
+
+def _hash(*parts: str) -> str:
+    digest = blake2b(digest_size=8)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _siibra_version() -> str:
+    if SIIBRA_REQUIREMENTS.is_file():
+        match = re.search(r"^siibra\s*==\s*(\S+)", SIIBRA_REQUIREMENTS.read_text(), re.MULTILINE)
+        if match:
+            return match.group(1)
+    try:
+        return metadata.version("siibra")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+class _StripDocstrings(ast.NodeTransformer):
+    def visit_Expr(self, node: ast.Expr):
+        if isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            return None
+        return node
+
+def _code(source: str) -> str:
+    """Normalize source to its syntax tree, without docstrings. Comments, docstrings and formatting do not change it."""
+    with warnings.catch_warnings():
+        # e.g. invalid escape sequences, reported on import already
+        warnings.simplefilter("ignore")
+        tree = ast.parse(source)
+    return ast.dump(_StripDocstrings().visit(tree))
+
+def _sources_hash(sources: Iterable[Path]) -> str:
+    return _hash(*[
+        f"{path.relative_to(_api_dir.parent)}:{_code(path.read_text())}"
+        for source in sources
+        if source.exists()
+        for path in ([source] if source.is_file() else sorted(source.rglob("*.py")))
+    ])
+
+@lru_cache(maxsize=None)
+def _module_code(name: str) -> Optional[str]:
+    try:
+        return _code(inspect.getsource(sys.modules[name]))
+    except (KeyError, OSError, TypeError, SyntaxError):
+        return None
+
+def _module_dependencies(name: str) -> List[str]:
+    """Get the modules of data handler packages (see `DATA_HANDLER_PACKAGES`), which module name imports (at module level, or in functions)"""
+    module = sys.modules.get(name)
+    try:
+        tree = ast.parse(inspect.getsource(module))
+    except (OSError, TypeError, SyntaxError):
+        return []
+    dependencies = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            candidates = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = resolve_name("." * node.level + (node.module or ""), module.__package__) if node.level else node.module
+            # names imported from a package may be modules
+            candidates = [base, *[f"{base}.{alias.name}" for alias in node.names]]
+        else:
+            continue
+        dependencies.update(
+            candidate for candidate in candidates
+            if candidate != name and candidate in sys.modules and candidate.startswith(DATA_HANDLER_PACKAGES)
+        )
+    return sorted(dependencies)
+
+def _source(fn: Callable) -> str:
+    """Get the inputs of a handler: its name, the (normalized) source of its module, and of the modules of data handler
+    packages its module imports (e.g. helpers)."""
+    if isinstance(fn, partial):
+        return _source(fn.func) + repr(fn.args) + repr(sorted(fn.keywords.items()))
+    fn = inspect.unwrap(fn)
+    name = getattr(fn, "__module__", None)
+    code = name and _module_code(name)
+    if code is None:
+        code = getattr(fn, "__code__", None)
+        # memory addresses differ between processes
+        return code.co_code.hex() if code else re.sub(r" at 0x[0-9a-f]+", "", repr(fn))
+    return _hash(
+        f"{name}.{getattr(fn, '__qualname__', getattr(fn, '__name__', ''))}",
+        code,
+        *[f"{dependency}:{_module_code(dependency)}" for dependency in _module_dependencies(name)],
+    )
+
+_global_inputs: Dict[str, str] = {}
+
+def get_global_inputs() -> Dict[str, str]:
+    """Get (memoized) inputs shaping all responses.
+
+    Returns:
+        siibra version, hash of the siibra configuration, hash of serialization source, `CACHE_FORMAT_VERSION`, `CACHE_SALT`"""
+    if not _global_inputs:
+        _global_inputs.update({
+            "siibra": _siibra_version(),
+            "configuration": (SIIBRA_USE_CONFIGURATION and (get_config_dir_short_hash(SIIBRA_USE_CONFIGURATION) or SIIBRA_USE_CONFIGURATION)) or "",
+            "serialization": _sources_hash(SERIALIZATION_DIRS),
+            "format": str(CACHE_FORMAT_VERSION),
+            "salt": CACHE_SALT,
+        })
+    return _global_inputs
+
+@lru_cache(maxsize=1024)
+def get_handler_fingerprint(*fns: Callable) -> str:
+    """Get (memoized) fingerprint of handlers (e.g. route handler, and its data handler), and the global inputs (see `get_global_inputs`).
+
+    Handlers are fingerprinted by their module (see `_source`), so that changes of the helpers they call change the
+    fingerprint, too.
+
+    Args:
+        fns: handlers
+
+    Returns:
+        fingerprint"""
+    return _hash(*[f"{key}:{value}" for key, value in sorted(get_global_inputs().items())], *[_source(fn) for fn in fns])
+
+_route_fingerprints: Dict[int, Optional[str]] = {}
+
+def get_route_fingerprint(route: BaseRoute) -> Optional[str]:
+    """Get (memoized) fingerprint of a route: its path, its route handler, its data handler (see `router_decorator`), their modules and the global inputs.
+
+    Unchanged routes thus keep their fingerprint (and their cache entries) across releases.
+
+    Args:
+        route: route, usually `APIRoute`
+
+    Returns:
+        fingerprint, or None if the route has no handler"""
+    if id(route) in _route_fingerprints:
+        return _route_fingerprints[id(route)]
+    endpoint = getattr(route, "endpoint", None)
+    fingerprint = None
+    if endpoint is not None:
+        _, data_handler = name_to_fns_map.get(endpoint.__name__, (None, None))
+        fingerprint = _hash(
+            getattr(route, "path", ""),
+            ",".join(sorted(getattr(route, "methods", None) or ())),
+            get_handler_fingerprint(*[fn for fn in (endpoint, data_handler) if fn is not None]),
+        )
+    _route_fingerprints[id(route)] = fingerprint
+    return fingerprint
+
+def _walk_routes(routes: List[BaseRoute], prefix: str=""):
+    for route in routes:
+        if isinstance(route, Mount):
+            yield from _walk_routes(route.routes, prefix + route.path)
+            continue
+        yield prefix, route
+
+_route_templates: Dict[int, str] = {}
+
+def get_route_template(app, route: BaseRoute) -> str:
+    """Get (memoized) path template of a route, including the path of the mounts it is nested in (e.g. `/v3_0`).
+
+    Args:
+        app: FastAPI app
+        route: route of app
+
+    Returns:
+        path template, e.g. `/v3_0/parcellations/{parcellation_id:lazy_path}`"""
+    if id(route) not in _route_templates:
+        for prefix, app_route in _walk_routes(app.routes):
+            _route_templates[id(app_route)] = prefix + getattr(app_route, "path", "")
+        _route_templates.setdefault(id(route), getattr(route, "path", ""))
+    return _route_templates[id(route)]
+
+def get_manifest(app) -> Dict[str, str]:
+    """Get the fingerprints of all routes of app.
+
+    Args:
+        app: FastAPI app
+
+    Returns:
+        route (methods and path) -> fingerprint"""
+    manifest = {}
+    for prefix, route in _walk_routes(app.routes):
+        fingerprint = get_route_fingerprint(route)
+        if fingerprint is None:
+            continue
+        methods = ",".join(sorted(getattr(route, "methods", None) or ()))
+        manifest[f"{methods} {prefix}{route.path}"] = fingerprint
+    return manifest
+
+def diff_manifests(old: Dict[str, str], new: Dict[str, str]) -> List[Tuple[str, str]]:
+    """Compare two manifests.
+
+    Args:
+        old: manifest, as returned by `get_manifest`
+        new: manifest, as returned by `get_manifest`
+
+    Returns:
+        list of (status, route), where status is one of `changed`, `added`, `removed`"""
+    result = []
+    for route in sorted(set(old) | set(new)):
+        if route not in old:
+            result.append(("added", route))
+        elif route not in new:
+            result.append(("removed", route))
+        elif old[route] != new[route]:
+            result.append(("changed", route))
+    return result
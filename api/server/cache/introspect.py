@@ -0,0 +1,252 @@
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+import heapq
+import re
+import time
+from redis.exceptions import ResponseError
+from api.siibra_api_config import __version__
+from .redis import CacheGzipRedis, LOCK_KEY_PREFIX, INVALIDATE_BATCH_SIZE
+from .meta import META_KEY_PREFIX, CacheMeta
+from .spill import is_pointer, unlink_spilled
+from .tags import TAG_KEY_PREFIX
+from .unpaginated import UNPAGINATED_KEY_PREFIX
+
+SCAN_COUNT = 1000
+"""COUNT hint of each SCAN call. Each call returns about as many keys, and blocks redis only briefly."""
+
+AGE_BUCKETS = (
+    ("1h", 60 * 60),
+    ("1d", 24 * 60 * 60),
+    ("1w", 7 * 24 * 60 * 60),
+    ("older", None),
+)
+"""(label, maximum age in seconds) of the age distribution of cached responses"""
+
+SIDECAR_PREFIXES = (META_KEY_PREFIX, LOCK_KEY_PREFIX, TAG_KEY_PREFIX)
+
+CACHE_KEY_MATCH = "\\[*"
+"""SCAN MATCH pattern of the keys of the response cache, which are all prefixed with `[` (e.g. `[<fingerprint>] `,
+`[meta] `, `[tag] `). Keys of celery (broker, result backend), which may share the redis, are not matched."""
+
+_key_re = re.compile(r"^\[([^\]]+)\] (.*)$", re.DOTALL)
+_glob_special_re = re.compile(r"([*?\[\]\\])")
+
+class KeyInfo(NamedTuple):
+    """Sampled key"""
+
+    key: str
+    group: str
+    """route template (see `get_key_group`)"""
+    bytes: int
+    """memory used by the key (and its metadata), as reported by MEMORY USAGE"""
+    hotness: Optional[float]
+    """access frequency (OBJECT FREQ, if redis evicts by LFU), otherwise negated idle time (OBJECT IDLETIME) in seconds"""
+    age: Optional[float]
+    """seconds since the value was cached, None if unknown"""
+
+class KeySample(NamedTuple):
+    """Sample of the keyspace"""
+
+    keys: List[KeyInfo]
+    scanned: int
+    """number of keys scanned (estimated from the number of SCAN calls, unless the whole keyspace was scanned), including metadata and keys not of the cache"""
+    dbsize: int
+    """total number of keys in redis"""
+    hotness: str
+    """measure of hotness, `freq` or `idletime`"""
+
+def get_key_group(key: str, routes: Dict[str, str]) -> str:
+    """Get the group (route template) of a key.
+
+    Args:
+        key: cache key
+        routes: route fingerprint -> route template (e.g. `GET /v3_0/parcellations/{parcellation_id:lazy_path}`)
+
+    Returns:
+        route template, `[unpaginated] <route handler>`, the prefix of sidecar keys (e.g. `[meta]`), or
+        `[<prefix>] (unknown route)` if the key is prefixed with an unknown fingerprint (e.g. of a previous release)"""
+    for prefix in SIDECAR_PREFIXES:
+        if key.startswith(prefix):
+            return prefix.strip()
+    match = _key_re.match(key)
+    if match is None:
+        return "(other)"
+    fingerprint, remainder = match.groups()
+    if remainder.startswith(UNPAGINATED_KEY_PREFIX):
+        return UNPAGINATED_KEY_PREFIX + remainder[len(UNPAGINATED_KEY_PREFIX):].split("[", 1)[0]
+    if fingerprint in routes:
+        return routes[fingerprint]
+    if fingerprint == __version__:
+        return f"[{fingerprint}] (unmatched)"
+    return f"[{fingerprint}] (unknown route)"
+
+def get_age_bucket(age: Optional[float]) -> str:
+    """Get the label of the age distribution bucket, see `AGE_BUCKETS`"""
+    if age is None:
+        return "unknown"
+    for label, max_age in AGE_BUCKETS:
+        if max_age is None or age <= max_age:
+            return label
+
+async def _hotness_command(store: CacheGzipRedis, key: str) -> str:
+    """OBJECT FREQ is only available, if redis evicts by LFU"""
+    try:
+        await store._r.object("freq", key)
+        return "freq"
+    except ResponseError:
+        return "idletime"
+
+async def sample_keys(store: CacheGzipRedis, routes: Dict[str, str], max_keys: int) -> KeySample:
+    """Sample the keys of the cache incrementally with SCAN (never KEYS), and inspect each sampled key in a pipeline.
+
+    Args:
+        store: redis store
+        routes: route fingerprint -> route template (see `get_key_group`)
+        max_keys: maximum number of keys sampled
+
+    Returns:
+        KeySample"""
+    dbsize = await store._r.dbsize()
+    scanned = 0
+    sampled: List[KeyInfo] = []
+    hotness_command = None
+    batch: List[str] = []
+
+    async def inspect_batch():
+        nonlocal hotness_command
+        if hotness_command is None:
+            hotness_command = await _hotness_command(store, batch[0])
+        pipe = store._r.pipeline(transaction=False)
+        for key in batch:
+            pipe.memory_usage(key)
+            pipe.object(hotness_command, key)
+            pipe.memory_usage(META_KEY_PREFIX + key)
+            pipe.get(META_KEY_PREFIX + key)
+        replies = await pipe.execute(raise_on_error=False)
+        now = time.time()
+        for idx, key in enumerate(batch):
+            usage, hotness, meta_usage, meta = replies[idx * 4:(idx + 1) * 4]
+            if usage is None or isinstance(usage, Exception):
+                # expired meanwhile
+                continue
+            hotness = None if isinstance(hotness, Exception) or hotness is None else float(hotness)
+            if hotness is not None and hotness_command == "idletime":
+                hotness = -hotness
+            meta = None if isinstance(meta, Exception) else CacheMeta.loads(meta)
+            sampled.append(KeyInfo(
+                key=key,
+                group=get_key_group(key, routes),
+                bytes=usage + (meta_usage if isinstance(meta_usage, int) else 0),
+                hotness=hotness,
+                age=(now - meta.created) if meta and meta.created else None,
+            ))
+        batch.clear()
+
+    # each SCAN call visits about SCAN_COUNT keys, of which only those of the cache are returned
+    cursor = 0
+    complete = False
+    while not complete and len(sampled) + len(batch) < max_keys:
+        cursor, keys = await store._r.scan(cursor, match=CACHE_KEY_MATCH, count=SCAN_COUNT)
+        scanned += SCAN_COUNT
+        complete = int(cursor) == 0
+        for key in keys:
+            key = CacheGzipRedis.getstr(key)
+            # metadata is accounted for with its value
+            if key.startswith(META_KEY_PREFIX):
+                continue
+            batch.append(key)
+            if len(batch) >= SCAN_COUNT:
+                await inspect_batch()
+            if len(sampled) + len(batch) >= max_keys:
+                break
+    if batch:
+        await inspect_batch()
+    scanned = dbsize if complete else min(scanned, dbsize)
+    return KeySample(keys=sampled, scanned=scanned, dbsize=dbsize, hotness=hotness_command or "freq")
+
+def merge_samples(samples: List[KeySample]) -> KeySample:
+    """Merge samples of several nodes (see `CacheShardedRedis`)"""
+    return KeySample(
+        keys=[info for sample in samples for info in sample.keys],
+        scanned=sum(sample.scanned for sample in samples),
+        dbsize=sum(sample.dbsize for sample in samples),
+        hotness=samples[0].hotness if samples else "freq",
+    )
+
+def summarize(sample: KeySample, top: int) -> Dict:
+    """Summarize sampled keys.
+
+    Args:
+        sample: see `sample_keys`
+        top: number of largest/hottest keys listed
+
+    Returns:
+        report. Counts are of the sample. `scale` extrapolates them to the whole keyspace"""
+    groups: Dict[str, Dict[str, int]] = defaultdict(lambda: {"keys": 0, "bytes": 0})
+    ages: Dict[str, int] = defaultdict(int)
+    sampled = sample.keys
+    for info in sampled:
+        groups[info.group]["keys"] += 1
+        groups[info.group]["bytes"] += info.bytes
+        if not info.key.startswith(SIDECAR_PREFIXES):
+            ages[get_age_bucket(info.age)] += 1
+
+    def describe(info: KeyInfo):
+        return {"key": info.key, "group": info.group, "bytes": info.bytes, "hotness": info.hotness}
+
+    return {
+        "dbsize": sample.dbsize,
+        "sampled": len(sampled),
+        "scale": (sample.dbsize / sample.scanned) if sample.scanned else 0,
+        "bytes": sum(info.bytes for info in sampled),
+        "hotness": sample.hotness,
+        "routes": dict(sorted(groups.items(), key=lambda item: -item[1]["bytes"])),
+        "ages": {label: ages[label] for label, _ in (*AGE_BUCKETS, ("unknown", None)) if label in ages},
+        "largest": [describe(info) for info in heapq.nlargest(top, sampled, key=lambda info: info.bytes)],
+        "hottest": [describe(info) for info in heapq.nlargest(top, [info for info in sampled if info.hotness is not None], key=lambda info: info.hotness)],
+    }
+
+def escape_glob(value: str) -> str:
+    """Escape glob-style special characters, for use in SCAN MATCH"""
+    return _glob_special_re.sub(r"\\\1", value)
+
+async def purge_prefix(store: CacheGzipRedis, prefix: str) -> List[str]:
+    """Delete cached responses (and their metadata), whose path starts with prefix, regardless of their fingerprint.
+
+    Keys are found with SCAN, and deleted with UNLINK (memory is reclaimed in the background). Files of spilled
+    values are deleted too, as in `CacheGzipRedis.invalidate_tags`. The keys returned are to be evicted from the other
+    tiers, too (see `CacheTiered.evict`).
+
+    Args:
+        store: redis store
+        prefix: path prefix, e.g. `/v3_0/parcellations`, or `[unpaginated] <route handler>`
+
+    Returns:
+        keys of the responses deleted"""
+    deleted: List[str] = []
+    batch: List[str] = []
+
+    async def unlink_batch():
+        keys = [key for key in batch if not key.startswith(META_KEY_PREFIX)]
+        # read the pointers of the values and delete them atomically, as `CacheGzipRedis.invalidate_tags` does
+        pipe = store._r.pipeline(transaction=True)
+        if keys:
+            pipe.mget(keys)
+        pipe.unlink(*batch)
+        stored = (await pipe.execute())[0] if keys else []
+        pointers = [value for value in stored if value and is_pointer(value)]
+        if pointers:
+            await unlink_spilled(pointers)
+        deleted.extend(keys)
+        batch.clear()
+
+    async for key in store._r.scan_iter(match=f"\\[*] {escape_glob(prefix)}*", count=SCAN_COUNT):
+        key = CacheGzipRedis.getstr(key)
+        if key.startswith((LOCK_KEY_PREFIX, TAG_KEY_PREFIX)):
+            continue
+        batch.append(key)
+        if len(batch) >= INVALIDATE_BATCH_SIZE:
+            await unlink_batch()
+    if batch:
+        await unlink_batch()
+    return deleted
@@ -0,0 +1,122 @@
+from typing import Optional, Tuple, Dict, List, NamedTuple
+from urllib.parse import parse_qsl, urlencode, quote
+from fastapi.dependencies.models import Dependant
+from starlette.requests import Request
+from starlette.routing import BaseRoute
+from starlette.types import Scope
+from api.siibra_api_config import __version__
+from .policy import CachePolicy, DEFAULT_POLICY
+from .fingerprint import get_route_fingerprint
+
+_true_values = ("1", "true", "on", "yes")
+_false_values = ("0", "false", "off", "no")
+
+class QueryParamSpec(NamedTuple):
+    """Query parameters declared by a route"""
+
+    defaults: Dict[str, str]
+    """Declared query parameters, and their default values (normalized, None if there is no default)"""
+
+    booleans: Tuple[str, ...]
+    """Declared query parameters of type bool"""
+
+    passthrough: bool
+    """If the handler reads the request directly (and thus may forward query parameters as is)"""
+
+_specs: Dict[int, QueryParamSpec] = {}
+
+# dependencies reading the request only to hold it in context (the pagination dependency, declaring `page` and `size`)
+_context_only_modules = ("fastapi_pagination",)
+
+def _normalize_bool(value: str) -> str:
+    lowered = value.lower()
+    if lowered in _true_values:
+        return "true"
+    if lowered in _false_values:
+        return "false"
+    return value
+
+def _walk(dependant: Dependant):
+    yield dependant
+    for dep in dependant.dependencies:
+        yield from _walk(dep)
+
+def _reads_request(dependant: Dependant) -> bool:
+    if dependant.request_param_name is None:
+        return False
+    module = getattr(dependant.call, "__module__", None) or ""
+    return not module.startswith(_context_only_modules)
+
+def get_query_param_spec(route: BaseRoute) -> Optional[QueryParamSpec]:
+    """Get (memoized) query parameters declared by the route.
+
+    Args:
+        route: route, usually `APIRoute`
+
+    Returns:
+        QueryParamSpec, or None if route does not declare its parameters"""
+    if id(route) in _specs:
+        return _specs[id(route)]
+    dependant: Dependant = getattr(route, "dependant", None)
+    if dependant is None:
+        return None
+    defaults = {}
+    booleans = []
+    passthrough = False
+    for dep in _walk(dependant):
+        passthrough = passthrough or _reads_request(dep)
+        for param in dep.query_params:
+            default = None
+            if not param.required and param.default is not None:
+                default = str(getattr(param.default, "value", param.default))
+            if param.type_ is bool:
+                booleans.append(param.alias)
+                default = default and _normalize_bool(default)
+            defaults[param.alias] = default
+    spec = QueryParamSpec(defaults=defaults, booleans=tuple(booleans), passthrough=passthrough)
+    _specs[id(route)] = spec
+    return spec
+
+def get_cache_key(request: Request, matched: Optional[Tuple[BaseRoute, Scope]]=None, policy: CachePolicy=DEFAULT_POLICY) -> str:
+    """Build the canonical cache key of a request, so that requests yielding the same content share the same key.
+
+    - path is percent decoded, then consistently re-encoded (e.g. `juelich%2Fiav` and `juelich/iav` are equivalent)
+    - query parameters are decoded, aliases are replaced with their canonical names (see `cache_policy`), and sorted by name
+    - query parameters ignored by the route policy are dropped
+    - unless the handler reads the request directly, query parameters not declared by the route, or set to their
+    declared default, are dropped, and boolean values are normalized
+    - the key is prefixed with the fingerprint of the route (see `get_route_fingerprint`), rather than the siibra-api
+    version, so that entries of unchanged routes survive releases. Requests not matching any route are prefixed with the version
+
+    Args:
+        request: Request
+        matched: route and child scope matching the request, as returned by `lookup_handler_fn`
+        policy: caching policy of the route
+
+    Returns:
+        cache key"""
+    path = quote(request.scope.get("root_path", "") + request.scope["path"], safe="/")
+
+    route = matched[0] if matched else None
+    spec = get_query_param_spec(route) if route is not None else None
+    aliases = policy.param_aliases or {}
+
+    params: List[Tuple[str, str]] = []
+    for name, value in parse_qsl(request.scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True):
+        name = aliases.get(name, name)
+        if name in policy.ignore_params:
+            continue
+        if spec is not None and not spec.passthrough:
+            if name not in spec.defaults:
+                continue
+            if name in spec.booleans:
+                value = _normalize_bool(value)
+            if spec.defaults[name] == value:
+                continue
+        params.append((name, value))
+
+    # stable sort: order of repeated parameters is preserved
+    params.sort(key=lambda param: param[0])
+    query = urlencode(params, quote_via=quote)
+    prefix = (get_route_fingerprint(route) if route is not None else None) or __version__
+    return f"[{prefix}] {path}" + (f"?{query}" if query else "")
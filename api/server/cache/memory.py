@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Union, Optional, Tuple, Dict
+import time
+from .stats import store_events, memory_bytes
+
+class CacheLruMemory:
+    """In process LRU store. Bounded by the total number of bytes held, each entry expires after its own TTL.
+
+    Values are held as decoded bytes, so that a hit does not incur network or decompression cost."""
+
+    def __init__(self, max_bytes: int, ttl: float, max_item_bytes: int=None):
+        """
+        Args:
+            max_bytes: upper bound of the total size of the stored values
+            ttl: default time to live (in seconds) of an entry
+            max_item_bytes: values larger than this will not be stored. Defaults to 1/8 of max_bytes
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes or (max_bytes // 8)
+
+        self._store: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = Lock()
+        self._size = 0
+
+        self.evictions = 0
+        """Number of entries removed to make space for newer entries"""
+        self.expirations = 0
+        """Number of entries removed due to TTL"""
+
+    @property
+    def size(self) -> int:
+        """Total number of bytes currently held"""
+        return self._size
+
+    def __len__(self):
+        return len(self._store)
+
+    def _pop(self, key: str):
+        _, value = self._store.pop(key)
+        self._size -= len(value)
+        memory_bytes.dec(len(value))
+
+    def get_value(self, key: str) -> Optional[bytes]:
+        """Get stored value according to key
+
+        Args:
+            key: str
+
+        Returns:
+            stored value, or None if key is absent or expired"""
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            expire_at, value = entry
+            if expire_at < time.monotonic():
+                self._pop(key)
+                self.expirations += 1
+                store_events.labels("memory", "expirations").inc()
+                return None
+            self._store.move_to_end(key)
+            return value
+
+    def set_value(self, key: str, value: Union[str, bytes], ttl: float=None) -> bool:
+        """Store value according to key. Least recently used entries are evicted until the value fits.
+
+        Args:
+            key: str
+            value: value to be stored
+            ttl: time to live (in seconds) of this entry. Capped at (and defaults to) the ttl of the store
+
+        Returns:
+            if the value was stored"""
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) > self.max_item_bytes:
+            return False
+        expire_at = time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        with self._lock:
+            if key in self._store:
+                self._pop(key)
+            while self._store and self._size + len(value) > self.max_bytes:
+                _, (_, evicted_value) = self._store.popitem(last=False)
+                self._size -= len(evicted_value)
+                memory_bytes.dec(len(evicted_value))
+                self.evictions += 1
+                store_events.labels("memory", "evictions").inc()
+            self._store[key] = (expire_at, value)
+            self._size += len(value)
+            memory_bytes.inc(len(value))
+        return True
+
+    def delete(self, key: str):
+        """Remove key, if present"""
+        with self._lock:
+            if key in self._store:
+                self._pop(key)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._store.clear()
+            memory_bytes.dec(self._size)
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of this store"""
+        return {
+            "entries": len(self._store),
+            "bytes": self._size,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
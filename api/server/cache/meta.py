@@ -0,0 +1,60 @@
+from typing import NamedTuple, Optional, Union
+import json
+import re
+
+META_KEY_PREFIX = "[meta] "
+"""Prefix of keys holding the metadata of the value stored under the unprefixed key"""
+
+class CacheMeta(NamedTuple):
+    """Metadata of a cached response, stored alongside (and with the same TTL as) the value.
+
+    Allows hits to be served (and conditional requests to be answered) without inspecting the value."""
+
+    status_code: int = 200
+    """HTTP status code of the response"""
+
+    content_type: Optional[str] = "application/json"
+    """Content type of the (uncompressed) response body"""
+
+    etag: Optional[str] = None
+    """Content hash of the (uncompressed) response body, see `compute_etag`"""
+
+    created: float = 0
+    """Unix timestamp of when the response was computed"""
+
+    def dumps(self) -> str:
+        """Serialize metadata"""
+        return json.dumps(self._asdict())
+
+    @staticmethod
+    def loads(value: Optional[Union[str, bytes]]) -> Optional["CacheMeta"]:
+        """Deserialize metadata
+
+        Args:
+            value: serialized metadata, as returned by `dumps`
+
+        Returns:
+            CacheMeta, or None if value is absent or malformed"""
+        if not value:
+            return None
+        try:
+            return CacheMeta(**json.loads(value))
+        except (ValueError, TypeError):
+            return None
+
+_cached_status_code_re = re.compile(rb'^{"error": true, "status_code": (\d{3})')
+
+def get_cached_status_code(head: bytes) -> int:
+    """Get the status code of a cached value (stored without metadata), from its first few bytes.
+
+    Cached errors are serialized with `error` and `status_code` as the leading keys.
+    
+    Args:
+        head: leading bytes of the cached value
+    
+    Returns:
+        status code"""
+    if not head.startswith(b'{"error": true'):
+        return 200
+    match = _cached_status_code_re.match(head)
+    return int(match.group(1)) if match else 500
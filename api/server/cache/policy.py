@@ -0,0 +1,79 @@
+from typing import NamedTuple, Optional, Callable, Tuple, Dict, Iterable
+from starlette.routing import BaseRoute
+from starlette.types import Scope
+from api.siibra_api_config import CACHE_DEFAULT_TTL_SEC, CACHE_DEFAULT_SWR_SEC, CACHE_DEFAULT_SIE_SEC, CACHE_NEGATIVE_TTL_SEC
+
+NEGATIVE_STATUS_CODES = (400, 404)
+"""Status codes of deterministic error responses, which are cached (briefly, see `CachePolicy.negative_ttl`). Other errors are never cached."""
+
+class CachePolicy(NamedTuple):
+    """Caching policy of a route"""
+
+    ttl: Optional[float] = CACHE_DEFAULT_TTL_SEC
+    """Seconds for which a cached response is fresh. If None, cached response never expires."""
+
+    stale_while_revalidate: float = CACHE_DEFAULT_SWR_SEC
+    """Seconds after ttl, during which the stale response is served, whilst it is recomputed in the background."""
+
+    stale_if_error: float = CACHE_DEFAULT_SIE_SEC
+    """Seconds after ttl, during which the stale response is served, if recomputing fails."""
+
+    ignore_params: Tuple[str, ...] = ()
+    """Query parameters which do not affect the response, and are thus omitted from the cache key."""
+
+    param_aliases: Optional[Dict[str, str]] = None
+    """Query parameter aliases, mapped to their canonical names in the cache key."""
+
+    negative_ttl: Optional[float] = CACHE_NEGATIVE_TTL_SEC
+    """Seconds for which deterministic error responses (see `NEGATIVE_STATUS_CODES`) are cached. If 0 or None, they are not cached."""
+
+    @property
+    def stale_window(self) -> float:
+        """Seconds after ttl, for which a stale response is retained."""
+        if self.ttl is None:
+            return 0
+        return max(self.stale_while_revalidate, self.stale_if_error)
+
+DEFAULT_POLICY = CachePolicy()
+
+ONE_WEEK_SEC = 7 * 24 * 60 * 60
+"""Convenience constant, for routes whose responses rarely change (e.g. atlases, spaces)"""
+
+POLICY_ATTR = "__sapi_cache_policy__"
+
+def cache_policy(ttl: Optional[float]=CACHE_DEFAULT_TTL_SEC, stale_while_revalidate: float=CACHE_DEFAULT_SWR_SEC, stale_if_error: float=CACHE_DEFAULT_SIE_SEC, ignore_params: Iterable[str]=(), param_aliases: Dict[str, str]=None, negative_ttl: Optional[float]=CACHE_NEGATIVE_TTL_SEC):
+    """Declare the caching policy of a route. Should be used directly below `@router.get`/`@version`.
+
+    Args:
+        ttl: seconds for which a cached response is fresh. If None, cached response never expires.
+        stale_while_revalidate: seconds after ttl, during which the stale response is served, whilst it is recomputed
+        stale_if_error: seconds after ttl, during which the stale response is served, if recomputing fails
+        ignore_params: query parameters which do not affect the response
+        param_aliases: alias -> canonical name of query parameters
+        negative_ttl: seconds for which deterministic error responses (e.g. 404 for unknown ids) are cached
+    """
+    policy = CachePolicy(
+        ttl=ttl,
+        stale_while_revalidate=stale_while_revalidate,
+        stale_if_error=stale_if_error,
+        ignore_params=tuple(ignore_params),
+        param_aliases=param_aliases,
+        negative_ttl=negative_ttl,
+    )
+    def outer(fn: Callable):
+        setattr(fn, POLICY_ATTR, policy)
+        return fn
+    return outer
+
+def get_policy(matched: Optional[Tuple[BaseRoute, Scope]]) -> CachePolicy:
+    """Get the caching policy of the route handling a request.
+
+    Args:
+        matched: route and child scope matching the request, as returned by `lookup_handler_fn`
+
+    Returns:
+        CachePolicy declared on the route, or the default policy"""
+    if not matched:
+        return DEFAULT_POLICY
+    route, _ = matched
+    return getattr(getattr(route, "endpoint", None), POLICY_ATTR, DEFAULT_POLICY)
@@ -13,12 +13,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from redis import Redis
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.exceptions import RedisError
+from functools import wraps
 import base64
 import gzip
-from typing import Union
-from api.common.timer import RepeatTimer
-from api.siibra_api_config import REDIS_HOST, REDIS_PASSWORD, REDIS_PORT, IS_CI
+import time
+import zlib
+from uuid import uuid4
+from urllib.parse import urlparse
+from typing import Union, Optional, Tuple, Iterable, List
+from .meta import META_KEY_PREFIX, CacheMeta
+from .tags import TAG_KEY_PREFIX
+from .stats import redis_seconds
+from .codec import GZIP_MAGIC, OFFLOAD_BYTES, CodecError, run_codec, compress, decompress, gzip_codec, get_codec
+from .spill import SpilledFile, is_pointer, spill, open_spilled, unlink_spilled
+from api.common import general_logger
+from api.siibra_api_config import (
+    REDIS_HOST, REDIS_PASSWORD, REDIS_PORT, IS_CI, CACHE_STORE_BINARY,
+    REDIS_POOL_SIZE, REDIS_TIMEOUT_SEC, REDIS_RETRY_SEC, CACHE_SPILL_BYTES,
+)
 
 _host = REDIS_HOST
 _password = REDIS_PASSWORD
@@ -27,19 +41,118 @@ _port = REDIS_PORT
 _is_ci = IS_CI
 """Do not use cache if IS_CI set via config"""
 
+_store_binary = CACHE_STORE_BINARY
+"""Store raw gzip bytes, rather than gzip then b64 encoded string"""
+
+_spill_bytes = CACHE_SPILL_BYTES
+"""Spill gzip bytes larger than this to the shared volume (see `spill`), if `_store_binary` is set"""
+
+LOCK_KEY_PREFIX = "[lock] "
+"""Prefix of keys used as locks"""
+
+RESPONSE_KEY_MATCH = "\\[*] /*"
+"""SCAN MATCH pattern of the keys of cached responses (`[<fingerprint>] /<path>`), and of their sidecar keys (e.g. metadata).
+Keys of celery (broker, result backend), which may share the redis, are not matched."""
+
+NO_LOCK = ""
+"""Token returned by acquire_lock, if locking is not possible"""
+
+INVALIDATE_BATCH_SIZE = 500
+"""Number of keys deleted per DEL command, when invalidating by tag"""
+
+HEALTH_CHECK_INTERVAL_SEC = 30
+"""Pooled connections idle for longer than this are checked (PING) before reuse"""
+
+# the set of a tag expires no earlier than the keys it holds: extended (never shortened), or made persistent
+_tag_script = """
+local pttl = redis.call("pttl", KEYS[1])
+redis.call("sadd", KEYS[1], ARGV[1])
+local px = tonumber(ARGV[2])
+if px == 0 then
+    return redis.call("persist", KEYS[1])
+end
+if pttl == -2 or (pttl >= 0 and pttl < px) then
+    return redis.call("pexpire", KEYS[1], px)
+end
+return 0
+"""
+
+_refresh_lock_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_release_lock_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+def _fallback(default):
+    """If redis is not available, or the call fails, return default (i.e. treat as cache miss).
+
+    Failed calls mark redis (the node called) as unavailable for `REDIS_RETRY_SEC` seconds. The latency of calls is recorded in `redis_seconds`."""
+    def outer(fn):
+        @wraps(fn)
+        async def inner(self: "CacheGzipRedis", *args, **kwargs):
+            if _is_ci or not self.is_connected:
+                return default
+            try:
+                with redis_seconds.labels(fn.__name__).time():
+                    return await fn(self, *args, **kwargs)
+            except (RedisError, OSError) as e:
+                self.mark_unavailable(e)
+                return default
+        return inner
+    return outer
+
 class CacheGzipRedis:
-    """GzipRedis. This store gzip then b64 encode the gzipped result."""
+    """GzipRedis. This store compresses the value, with the codec chosen by its size (see `select_codec`).
+    Depending on `CACHE_STORE_BINARY`, the compressed bytes are either stored as is, or gzipped then b64 encoded (legacy).
+    All formats can be read. Large values are spilled to the shared volume, with only a pointer stored (see `CACHE_SPILL_BYTES`).
+
+    Unless a url is provided, instances share the same (per process), bounded connection pool, created in `on_startup`.
+    Otherwise, the instance is a node (see `CacheShardedRedis`), with its own pool, created in `connect`."""
 
     _r: Redis = None
-    _is_connected = False
-    _timer: RepeatTimer = None
+    _retry_at: float = 0
+
+    def __init__(self, url: str=None):
+        """
+        Args:
+            url: redis url of the node (e.g. `redis://:password@host:6379/0`). If not provided, `REDIS_HOST` is used
+        """
+        self.url = url
+        parsed = urlparse(url) if url else None
+        self.name = f"{parsed.hostname}:{parsed.port or 6379}{parsed.path if parsed.path not in ('', '/') else ''}" if parsed else "redis"
+        """Name of the node, without credentials"""
 
     # read only property
     @property
     def is_connected(self):
-        return self._is_connected
+        return self._r is not None and time.monotonic() >= self._retry_at
+
+    def mark_unavailable(self, e: Exception):
+        """Bypass redis (this node) for `REDIS_RETRY_SEC` seconds, after a failed call"""
+        if time.monotonic() >= self._retry_at:
+            general_logger.warning(f"Redis {self.name} unavailable, bypassing for {REDIS_RETRY_SEC}s: {str(e)}")
+        self._retry_at = time.monotonic() + REDIS_RETRY_SEC
+
+    def connect(self):
+        """Create the connection pool of this node. Only applicable, if url is provided"""
+        self._r = create_client(self.url)
 
-    def get_value(self, key: str) -> str:
+    async def disconnect(self):
+        """Disconnect the connection pool of this node"""
+        if "_r" in self.__dict__ and self._r is not None:
+            await self._r.connection_pool.disconnect()
+            self._r = None
+
+    @_fallback(None)
+    async def get_value(self, key: str) -> str:
         """Get stored value acording to key
         
         Args:
@@ -47,24 +160,178 @@ class CacheGzipRedis:
         
         Returns:
             stored value"""
-        if _is_ci or not self.is_connected:
-            return None
-        bz64str = self._r.get(key)
+        return await self._decode_stored(key, await self._r.get(key))
+    
+    @_fallback(None)
+    async def get_compressed(self, key: str) -> Optional[bytes]:
+        """Get stored value according to key, as gzip bytes, without decompressing.
 
-        if bz64str is None:
-            return None
+        Values stored with a codec clients cannot decode (e.g. zstd with dictionary) are returned decompressed.
+        Use `GZIP_MAGIC` to tell them apart. Spilled values are returned as `SpilledFile`.
+
+        Args:
+            key: str
+        
+        Returns:
+            gzipped (or decompressed) stored value"""
+        return await self._compress_stored(key, await self._r.get(key))
+
+    @_fallback((None, None, None))
+    async def get_entry(self, key: str, compressed: bool=False) -> Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]:
+        """Get stored value, its remaining time to live and its metadata, in a single round trip.
+
+        Args:
+            key: str
+            compressed: if set, return the value as gzip bytes (see `get_compressed`)
+        
+        Returns:
+            stored value, remaining time to live in seconds (None if the key does not expire), metadata (None if absent)"""
+        pipe = self._r.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        pipe.get(META_KEY_PREFIX + key)
+        stored, pttl, meta = await pipe.execute()
+        value = await (self._compress_stored(key, stored) if compressed else self._decode_stored(key, stored))
+        return value, CacheGzipRedis.ttl_sec(pttl), CacheMeta.loads(meta)
+
+    @_fallback(None)
+    async def get_entries(self, keys: List[str], compressed: bool=False) -> Optional[List[Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]]]:
+        """Get several entries (see `get_entry`), in a single round trip.
+
+        Args:
+            keys: list of str
+            compressed: if set, return the values as gzip bytes (see `get_compressed`)
+
+        Returns:
+            entry per key, or None if redis is not available"""
+        pipe = self._r.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+            pipe.get(META_KEY_PREFIX + key)
+        replies = await pipe.execute()
+        entries = []
+        for idx, key in enumerate(keys):
+            stored, pttl, meta = replies[idx * 3:idx * 3 + 3]
+            value = await (self._compress_stored(key, stored) if compressed else self._decode_stored(key, stored))
+            entries.append((value, CacheGzipRedis.ttl_sec(pttl), CacheMeta.loads(meta)))
+        return entries
+
+    @_fallback((None, None))
+    async def get_meta(self, key: str) -> Tuple[Optional[CacheMeta], Optional[float]]:
+        """Get metadata of the stored value, and its remaining time to live, without fetching the value.
+
+        Args:
+            key: str
         
-        bz64str = CacheGzipRedis.getstr(bz64str)
+        Returns:
+            metadata (None if absent), remaining time to live in seconds (None if the key does not expire)"""
+        pipe = self._r.pipeline(transaction=False)
+        pipe.get(META_KEY_PREFIX + key)
+        pipe.pttl(META_KEY_PREFIX + key)
+        meta, pttl = await pipe.execute()
+        return CacheMeta.loads(meta), CacheGzipRedis.ttl_sec(pttl)
+
+    @staticmethod
+    def ttl_sec(pttl: Optional[int]) -> Optional[float]:
+        """Convert redis PTTL reply to seconds. Negative replies (no expiry, or key absent) are converted to None."""
+        return pttl / 1000 if pttl is not None and pttl >= 0 else None
+
+    async def _decode_stored(self, key: str, stored: Optional[bytes]) -> Optional[Union[str, bytes]]:
+        """Decompress stored value. Values which are not valid utf-8 (e.g. images) are returned as bytes."""
+        if stored is None:
+            return None
+
+        if is_pointer(stored):
+            spilled = await open_spilled(stored)
+            if spilled is None:
+                return None
+            try:
+                stored = await spilled.read()
+            except OSError as e:
+                general_logger.warning(f"Cannot read spilled {key}: {str(e)}")
+                return None
+
+        if get_codec(stored) is not None:
+            try:
+                decompressed = await decompress(stored)
+            except CodecError as e:
+                general_logger.warning(f"Cannot decompress {key}: {str(e)}")
+                return None
+            try:
+                return decompressed.decode("utf-8")
+            except UnicodeDecodeError:
+                return decompressed
+
+        bz64str = CacheGzipRedis.getstr(stored)
         # if cached value 
         if bz64str[0] == "{" and bz64str[-1] == "}":
-            self.set_value(key, bz64str)
+            await self._migrate(key, bz64str)
             return bz64str
         try:
-            return CacheGzipRedis.decode(bz64str)
-        except:
-            print(f"decoding key value error {key}, {bz64str}")
+            decoded = await run_codec(CacheGzipRedis.decode, bz64str)
+            if _store_binary:
+                await self._r.set(key, base64.b64decode(bz64str), keepttl=True)
+            return decoded
+        except RedisError:
+            raise
+        except Exception as e:
+            general_logger.warning(f"Cannot decode {key}: {str(e)}")
             return bz64str
-    
+
+    async def _compress_stored(self, key: str, stored: Optional[bytes]) -> Optional[Union[bytes, SpilledFile]]:
+        """Legacy (b64 encoded) entries are rewritten as raw gzip bytes, if `CACHE_STORE_BINARY` is set.
+        Spilled values are returned as `SpilledFile`, without reading them."""
+        if stored is None:
+            return None
+
+        if is_pointer(stored):
+            return await open_spilled(stored)
+        
+        if stored.startswith(GZIP_MAGIC):
+            return stored
+
+        if get_codec(stored) is not None:
+            try:
+                return await decompress(stored)
+            except CodecError as e:
+                general_logger.warning(f"Cannot decompress {key}: {str(e)}")
+                return None
+        
+        if stored.startswith(b"{") and stored.endswith(b"}"):
+            bz = await compress(stored, gzip_codec)
+        else:
+            try:
+                bz = base64.b64decode(stored)
+            except Exception as e:
+                general_logger.warning(f"Cannot decode {key}: {str(e)}")
+                return None
+            if not bz.startswith(GZIP_MAGIC):
+                return None
+        if _store_binary:
+            await self._r.set(key, bz, keepttl=True)
+        return bz
+
+    async def _migrate(self, key: str, value: str):
+        """Rewrite legacy, uncompressed entry"""
+        if _store_binary:
+            compressed_value = await compress(CacheGzipRedis.getbytes(value))
+        else:
+            compressed_value = await run_codec(CacheGzipRedis.encode, value)
+        await self._r.set(key, compressed_value, keepttl=True)
+
+    @staticmethod
+    def peek(val: bytes, length: int=64) -> bytes:
+        """Decompress only the first few bytes of gzip bytes
+        
+        Args:
+            val: gzipped bytes
+            length: maximum number of decompressed bytes to return
+        
+        Returns:
+            the first `length` bytes of the decompressed value"""
+        return zlib.decompressobj(wbits=31).decompress(val, length)
+
     @staticmethod
     def getstr(val: Union[str, bytes]) -> str:
         """Convert str|bytes into str
@@ -133,28 +400,142 @@ class CacheGzipRedis:
         bz64str = bz64.decode("utf-8")
         return bz64str
         
-    def set_value(self, key, value):
-        if _is_ci or not self.is_connected:
-            return None
+    @_fallback(None)
+    async def set_value(self, key: str, value: Union[str, bytes], ttl: float=None, meta: CacheMeta=None, compressed: bool=False, tags: Iterable[str]=()):
+        """Store value according to key
         
-        compressed_value = CacheGzipRedis.encode(value)
-        return self._r.set(key, compressed_value)
+        Args:
+            key: str
+            value: value to be stored
+            ttl: seconds after which the key expires. If not provided, the key does not expire
+            meta: metadata of the value. If provided, stored alongside the value, with the same ttl
+            compressed: if set, value is already gzip bytes (e.g. produced by `CacheWriter`)
+            tags: atlas concepts the value depends on (see `get_tags`). key is added to the set of each tag, which expires no earlier than key"""
+        if compressed:
+            compressed_value = value if _store_binary else base64.b64encode(value).decode("utf-8")
+        elif _store_binary:
+            compressed_value = await compress(CacheGzipRedis.getbytes(value))
+        else:
+            compressed_value = await run_codec(CacheGzipRedis.encode, value)
+        if _store_binary and _spill_bytes and len(compressed_value) > _spill_bytes and compressed_value.startswith(GZIP_MAGIC):
+            try:
+                compressed_value = await spill(compressed_value)
+            except OSError as e:
+                general_logger.warning(f"Cannot spill {key}, storing in redis: {str(e)}")
+        px = int(ttl * 1000) if ttl else None
+        pipe = self._r.pipeline(transaction=False)
+        pipe.set(key, compressed_value, px=px)
+        if meta:
+            pipe.set(META_KEY_PREFIX + key, meta.dumps(), px=px)
+        else:
+            pipe.delete(META_KEY_PREFIX + key)
+        for tag in tags:
+            pipe.eval(_tag_script, 1, TAG_KEY_PREFIX + tag, key, px or 0)
+        return (await pipe.execute())[0]
 
+    @_fallback([])
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        """Delete all values (and their metadata) tagged with any of tags, without scanning the keyspace.
 
-def on_startup():
-    """On startup call"""
-    CacheGzipRedis._r = Redis(host=_host, port=_port, password=_password)
-    def _heartbeat():
-        try:
-            CacheGzipRedis._r.ping()
-            CacheGzipRedis._is_connected = True
-        except Exception:
-            CacheGzipRedis._is_connected = False
+        The sets of tags are read and deleted atomically, so that values stored meanwhile are tagged anew.
+        Keys, which have expired since they were tagged, are included. Files of spilled values are deleted too (keys
+        holding an identical value, i.e. sharing the file, then miss).
+
+        Args:
+            tags: tags, e.g. `parcellation:<id>`
 
-    CacheGzipRedis._timer = RepeatTimer(5, _heartbeat)
-    CacheGzipRedis._timer.start()
+        Returns:
+            list of keys invalidated"""
+        tag_keys = [TAG_KEY_PREFIX + tag for tag in tags]
+        if not tag_keys:
+            return []
+        pipe = self._r.pipeline(transaction=True)
+        pipe.sunion(*tag_keys)
+        pipe.delete(*tag_keys)
+        members, _ = await pipe.execute()
+        keys = sorted(CacheGzipRedis.getstr(member) for member in members)
+        for idx in range(0, len(keys), INVALIDATE_BATCH_SIZE):
+            batch = keys[idx:idx + INVALIDATE_BATCH_SIZE]
+            pipe = self._r.pipeline(transaction=True)
+            pipe.mget(batch)
+            pipe.delete(*batch, *[META_KEY_PREFIX + key for key in batch])
+            stored, _ = await pipe.execute()
+            pointers = [value for value in stored if value and is_pointer(value)]
+            if pointers:
+                await unlink_spilled(pointers)
+        return keys
+
+    @_fallback(NO_LOCK)
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """Acquire a short lived lock associated with key.
+
+        Args:
+            key: str
+            ttl: seconds after which the lock is released, regardless if `release_lock` is called
+        
+        Returns:
+            token to be used to release the lock. `None` if the lock is held by someone else.
+            If redis is not available, locking is not possible, and `NO_LOCK` is returned."""
+        token = uuid4().hex
+        acquired = await self._r.set(LOCK_KEY_PREFIX + key, token, nx=True, px=int(ttl * 1000))
+        return token if acquired else None
+
+    @_fallback(False)
+    async def refresh_lock(self, key: str, token: str, ttl: float) -> bool:
+        """Extend the expiry of the lock, if it is still held by token.
+
+        Args:
+            key: str
+            token: token returned by `acquire_lock`
+            ttl: seconds after which the lock is released, from now
+
+        Returns:
+            if the lock is still held"""
+        if token == NO_LOCK:
+            return False
+        return bool(await self._r.eval(_refresh_lock_script, 1, LOCK_KEY_PREFIX + key, token, int(ttl * 1000)))
+
+    @_fallback(None)
+    async def release_lock(self, key: str, token: str):
+        """Release the lock, if it is still held by token.
+
+        Args:
+            key: str
+            token: token returned by `acquire_lock`"""
+        if token == NO_LOCK:
+            return
+        await self._r.eval(_release_lock_script, 1, LOCK_KEY_PREFIX + key, token)
+
+
+def create_client(url: str=None) -> Redis:
+    """Create a redis client, with its own bounded connection pool.
+
+    Connections are established lazily, and health checked (PING) before reuse, if idle for longer than `HEALTH_CHECK_INTERVAL_SEC`.
+
+    Args:
+        url: redis url. If not provided, `REDIS_HOST`, `REDIS_PORT` and `REDIS_PASSWORD` are used
+
+    Returns:
+        Redis"""
+    pool_kwargs = dict(
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_TIMEOUT_SEC,
+        socket_timeout=REDIS_TIMEOUT_SEC,
+        socket_connect_timeout=REDIS_TIMEOUT_SEC,
+        health_check_interval=HEALTH_CHECK_INTERVAL_SEC,
+    )
+    if url:
+        pool = BlockingConnectionPool.from_url(url, **pool_kwargs)
+    else:
+        pool = BlockingConnectionPool(host=_host, port=_port, password=_password, **pool_kwargs)
+    return Redis(connection_pool=pool)
+
+def on_startup():
+    """On startup call. Create the connection pool shared by all instances (without url) in this process."""
+    CacheGzipRedis._r = create_client()
 
-def terminate():
+async def terminate():
     """On terminate call"""
-    if CacheGzipRedis._timer is not None:
-        CacheGzipRedis._timer.cancel()
+    if CacheGzipRedis._r is not None:
+        await CacheGzipRedis._r.connection_pool.disconnect()
+        CacheGzipRedis._r = None
@@ -0,0 +1,129 @@
+from bisect import bisect
+from collections import defaultdict
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import asyncio
+from .redis import CacheGzipRedis, NO_LOCK
+from .meta import CacheMeta
+
+class HashRing:
+    """Consistent hash ring. Each node is placed on the ring at `vnodes` points (virtual nodes), so that keys are
+    spread evenly, and adding or removing a node only moves about 1/n of the keys."""
+
+    def __init__(self, names: List[str], vnodes: int):
+        """
+        Args:
+            names: names of the nodes
+            vnodes: number of virtual nodes per node
+        """
+        points = sorted(
+            (HashRing.hash(f"{name}#{idx}"), node_idx)
+            for node_idx, name in enumerate(names)
+            for idx in range(vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._nodes = [node_idx for _, node_idx in points]
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def get_node(self, key: str) -> int:
+        """Get the node owning key, i.e. the first node clockwise of the hash of key
+
+        Args:
+            key: str
+
+        Returns:
+            index of the node"""
+        idx = bisect(self._points, HashRing.hash(key)) % len(self._points)
+        return self._nodes[idx]
+
+class CacheShardedRedis:
+    """Spread keys across several redis nodes (see `CACHE_NODES`), by consistent hashing (see `HashRing`).
+
+    A key, its metadata, its lock and its tags are held by the same node. If a node is unavailable, lookups of its
+    keys are treated as misses (see `CacheGzipRedis.mark_unavailable`), whilst the other nodes keep serving."""
+
+    def __init__(self, urls: List[str], vnodes: int):
+        """
+        Args:
+            urls: redis urls of the nodes (e.g. `redis://cache-0:6379`)
+            vnodes: number of virtual nodes per node
+        """
+        self.nodes = [CacheGzipRedis(url) for url in urls]
+        self._ring = HashRing([node.name for node in self.nodes], vnodes)
+
+    @property
+    def is_connected(self):
+        return any(node.is_connected for node in self.nodes)
+
+    def get_node(self, key: str) -> CacheGzipRedis:
+        """Get the node holding key"""
+        return self.nodes[self._ring.get_node(key)]
+
+    async def get_value(self, key: str) -> Optional[Union[str, bytes]]:
+        """See `CacheGzipRedis.get_value`"""
+        return await self.get_node(key).get_value(key)
+
+    async def get_compressed(self, key: str) -> Optional[bytes]:
+        """See `CacheGzipRedis.get_compressed`"""
+        return await self.get_node(key).get_compressed(key)
+
+    async def get_entry(self, key: str, compressed: bool=False) -> Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]:
+        """See `CacheGzipRedis.get_entry`"""
+        return await self.get_node(key).get_entry(key, compressed=compressed)
+
+    async def get_entries(self, keys: List[str], compressed: bool=False) -> List[Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]]:
+        """See `CacheGzipRedis.get_entries`. Keys are looked up with a single round trip per node, concurrently.
+        Keys of unavailable nodes are treated as misses."""
+        node_keys: Dict[int, List[str]] = defaultdict(list)
+        for key in keys:
+            node_keys[self._ring.get_node(key)].append(key)
+        node_idxs = list(node_keys)
+        results = await asyncio.gather(*[self.nodes[idx].get_entries(node_keys[idx], compressed=compressed) for idx in node_idxs])
+        entries = {}
+        for idx, node_entries in zip(node_idxs, results):
+            for key, entry in zip(node_keys[idx], node_entries or []):
+                entries[key] = entry
+        return [entries.get(key, (None, None, None)) for key in keys]
+
+    async def get_meta(self, key: str) -> Tuple[Optional[CacheMeta], Optional[float]]:
+        """See `CacheGzipRedis.get_meta`"""
+        return await self.get_node(key).get_meta(key)
+
+    async def set_value(self, key: str, value: Union[str, bytes], ttl: float=None, meta: CacheMeta=None, compressed: bool=False, tags: Iterable[str]=()):
+        """See `CacheGzipRedis.set_value`. Tags are recorded on the node holding key."""
+        return await self.get_node(key).set_value(key, value, ttl=ttl, meta=meta, compressed=compressed, tags=tags)
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        """Invalidate values tagged with any of tags, on all nodes. See `CacheGzipRedis.invalidate_tags`"""
+        tags = list(tags)
+        results = await asyncio.gather(*[node.invalidate_tags(tags) for node in self.nodes])
+        return sorted(key for keys in results for key in keys)
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """See `CacheGzipRedis.acquire_lock`"""
+        return await self.get_node(key).acquire_lock(key, ttl)
+
+    async def refresh_lock(self, key: str, token: str, ttl: float) -> bool:
+        """See `CacheGzipRedis.refresh_lock`"""
+        if token == NO_LOCK:
+            return False
+        return await self.get_node(key).refresh_lock(key, token, ttl)
+
+    async def release_lock(self, key: str, token: str):
+        """See `CacheGzipRedis.release_lock`"""
+        if token == NO_LOCK:
+            return
+        return await self.get_node(key).release_lock(key, token)
+
+    def on_startup(self):
+        """Create the connection pools of all nodes"""
+        for node in self.nodes:
+            node.connect()
+
+    async def terminate(self):
+        """Disconnect the connection pools of all nodes"""
+        for node in self.nodes:
+            await node.disconnect()
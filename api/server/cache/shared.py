@@ -0,0 +1,277 @@
+from hashlib import blake2b
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+import fcntl
+import mmap
+import os
+import struct
+import time
+from .stats import store_events
+
+MAGIC = b"SAPISHM1"
+"""Leading bytes of the segment. The segment is re-initialized, if it was created with a different layout"""
+
+SIZE_CLASSES = (1024, 8 * 1024, 64 * 1024, 512 * 1024)
+"""Capacity (bytes) of the slots of each size class. Each class gets an equal share of the segment"""
+
+WAYS = 4
+"""Number of slots per bucket. A key can only be stored in one bucket (per class), evicting the oldest of its slots"""
+
+READ_RETRIES = 3
+"""Number of attempts to read a slot, which is concurrently written. Afterwards, the read is treated as a miss"""
+
+_header = struct.Struct("<8sIIQ")
+"""magic, number of size classes, ways, segment size"""
+
+_class_header = struct.Struct("<QQQ")
+"""slot capacity, number of buckets, offset of the first slot"""
+
+_slot = struct.Struct("<Q16sddI4x")
+"""sequence, key hash, expire at, written at, value length"""
+
+_seq = struct.Struct("<Q")
+
+_EMPTY_HASH = bytes(16)
+
+class _SizeClass:
+    def __init__(self, capacity: int, buckets: int, offset: int):
+        self.capacity = capacity
+        self.buckets = buckets
+        self.offset = offset
+        self.slot_bytes = _slot.size + capacity
+
+    def slot_offsets(self, key_hash: bytes) -> List[int]:
+        bucket = int.from_bytes(key_hash[:8], "little") % self.buckets
+        start = self.offset + bucket * WAYS * self.slot_bytes
+        return [start + way * self.slot_bytes for way in range(WAYS)]
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.buckets * WAYS * self.slot_bytes
+
+class CacheSharedMemory:
+    """Store shared by all processes on a host (e.g. uvicorn workers of a pod), backed by a memory mapped file
+    (e.g. in `/dev/shm`).
+
+    The segment is divided into size classes (see `SIZE_CLASSES`), each a set associative table of fixed size slots.
+    A value is stored in the smallest class it fits in. Values larger than the largest class are not stored.
+    Once a bucket is full, its oldest slot is evicted, so the segment never grows.
+
+    Reads are lock free: each slot is guarded by a sequence number (seqlock), which is odd whilst the slot is written.
+    A reader retries, if the sequence number changed whilst reading. Writers of a bucket are serialized with a
+    (per bucket) record lock on the file, and a lock within the process."""
+
+    def __init__(self, path: str, max_bytes: int, ttl: float):
+        """
+        Args:
+            path: path of the backing file. Created (and initialized) by the first process
+            max_bytes: size of the segment
+            ttl: default time to live (in seconds) of an entry
+        """
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+
+        self.evictions = 0
+        """Number of entries (of this process) removed to make space for newer entries"""
+        self.expirations = 0
+        """Number of expired entries found"""
+        self.retries = 0
+        """Number of reads retried, due to a concurrent write"""
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                layout = self._layout(max_bytes)
+                size = layout[-1].end
+                header = self._header_bytes(layout, size)
+                if os.fstat(self._fd).st_size != size or os.pread(self._fd, len(header), 0) != header:
+                    os.ftruncate(self._fd, 0)
+                    os.ftruncate(self._fd, size)
+                    os.pwrite(self._fd, header, 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._mm = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._classes = layout
+
+    @staticmethod
+    def _layout(max_bytes: int) -> List[_SizeClass]:
+        offset = _header.size + len(SIZE_CLASSES) * _class_header.size
+        share = max(0, max_bytes - offset) // len(SIZE_CLASSES)
+        classes = []
+        for capacity in SIZE_CLASSES:
+            buckets = max(1, share // ((_slot.size + capacity) * WAYS))
+            size_class = _SizeClass(capacity, buckets, offset)
+            classes.append(size_class)
+            offset = size_class.end
+        return classes
+
+    @staticmethod
+    def _header_bytes(layout: List[_SizeClass], size: int) -> bytes:
+        return _header.pack(MAGIC, len(layout), WAYS, size) + b"".join(
+            _class_header.pack(size_class.capacity, size_class.buckets, size_class.offset)
+            for size_class in layout
+        )
+
+    @property
+    def max_item_bytes(self) -> int:
+        return SIZE_CLASSES[-1]
+
+    @staticmethod
+    def hash_key(key: str) -> bytes:
+        return blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def _read_slot(self, size_class: _SizeClass, offset: int, key_hash: bytes) -> Tuple[bool, Optional[float], Optional[bytes]]:
+        """Read slot, if it holds key_hash.
+
+        Returns:
+            if the read was consistent, expire at, value (None if the slot does not hold key_hash)"""
+        mm = self._mm
+        seq, slot_hash, expire_at, _, length = _slot.unpack_from(mm, offset)
+        if seq & 1:
+            return False, None, None
+        if slot_hash != key_hash:
+            return True, None, None
+        # length may be torn, if the slot is concurrently written
+        value = mm[offset + _slot.size:offset + _slot.size + min(length, size_class.capacity)]
+        return _seq.unpack_from(mm, offset)[0] == seq, expire_at, value
+
+    def get_value(self, key: str) -> Optional[bytes]:
+        """Get stored value according to key, without locking
+
+        Args:
+            key: str
+
+        Returns:
+            stored value, or None if key is absent or expired"""
+        key_hash = self.hash_key(key)
+        now = time.time()
+        for size_class in self._classes:
+            for offset in size_class.slot_offsets(key_hash):
+                for _ in range(READ_RETRIES):
+                    consistent, expire_at, value = self._read_slot(size_class, offset, key_hash)
+                    if consistent:
+                        break
+                    self.retries += 1
+                    store_events.labels("shared", "retries").inc()
+                else:
+                    return None
+                if value is None:
+                    continue
+                if expire_at < now:
+                    self.expirations += 1
+                    store_events.labels("shared", "expirations").inc()
+                    return None
+                return value
+        return None
+
+    def _write_slot(self, offset: int, key_hash: bytes, expire_at: float, value: bytes):
+        mm = self._mm
+        seq = _seq.unpack_from(mm, offset)[0]
+        _seq.pack_into(mm, offset, seq + 1)
+        _slot.pack_into(mm, offset, seq + 1, key_hash, expire_at, time.time(), len(value))
+        mm[offset + _slot.size:offset + _slot.size + len(value)] = value
+        _seq.pack_into(mm, offset, seq + 2)
+
+    def _lock_bucket(self, offsets: List[int], op: int):
+        fcntl.lockf(self._fd, op, offsets[-1] + _seq.size - offsets[0], offsets[0])
+
+    def _remove(self, size_class: _SizeClass, key_hash: bytes):
+        offsets = size_class.slot_offsets(key_hash)
+        self._lock_bucket(offsets, fcntl.LOCK_EX)
+        try:
+            for offset in offsets:
+                if _slot.unpack_from(self._mm, offset)[1] == key_hash:
+                    self._write_slot(offset, _EMPTY_HASH, 0, b"")
+        finally:
+            self._lock_bucket(offsets, fcntl.LOCK_UN)
+
+    def set_value(self, key: str, value: Union[str, bytes], ttl: float=None) -> bool:
+        """Store value according to key. If the bucket is full, its oldest entry is evicted.
+
+        Args:
+            key: str
+            value: value to be stored
+            ttl: time to live (in seconds) of this entry. Capped at (and defaults to) the ttl of the store
+
+        Returns:
+            if the value was stored"""
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) > self.max_item_bytes:
+            return False
+        key_hash = self.hash_key(key)
+        now = time.time()
+        expire_at = now + (self.ttl if ttl is None else min(ttl, self.ttl))
+        with self._lock:
+            for size_class in self._classes:
+                if len(value) > size_class.capacity:
+                    # value may have been stored in a smaller class before
+                    self._remove(size_class, key_hash)
+                    continue
+                offsets = size_class.slot_offsets(key_hash)
+                self._lock_bucket(offsets, fcntl.LOCK_EX)
+                try:
+                    slots = [(offset, *_slot.unpack_from(self._mm, offset)) for offset in offsets]
+                    target = (
+                        next((slot for slot in slots if slot[2] == key_hash), None)
+                        or next((slot for slot in slots if slot[2] == _EMPTY_HASH or slot[3] < now), None)
+                    )
+                    if target is None:
+                        target = min(slots, key=lambda slot: slot[4])
+                        self.evictions += 1
+                        store_events.labels("shared", "evictions").inc()
+                    self._write_slot(target[0], key_hash, expire_at, value)
+                finally:
+                    self._lock_bucket(offsets, fcntl.LOCK_UN)
+                for larger_class in self._classes[self._classes.index(size_class) + 1:]:
+                    self._remove(larger_class, key_hash)
+                return True
+        return False
+
+    def delete(self, key: str):
+        """Remove key, if present"""
+        key_hash = self.hash_key(key)
+        with self._lock:
+            for size_class in self._classes:
+                self._remove(size_class, key_hash)
+
+    def clear(self):
+        """Remove all entries (of all processes)"""
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                for size_class in self._classes:
+                    for offset in range(size_class.offset, size_class.end, size_class.slot_bytes):
+                        if _slot.unpack_from(self._mm, offset)[1] != _EMPTY_HASH:
+                            self._write_slot(offset, _EMPTY_HASH, 0, b"")
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of this store. `entries` and `bytes` are of the segment (i.e. all processes), the others of this process"""
+        entries = 0
+        size = 0
+        now = time.time()
+        for size_class in self._classes:
+            for offset in range(size_class.offset, size_class.end, size_class.slot_bytes):
+                _, slot_hash, expire_at, _, length = _slot.unpack_from(self._mm, offset)
+                if slot_hash != _EMPTY_HASH and expire_at >= now:
+                    entries += 1
+                    size += length
+        return {
+            "entries": entries,
+            "bytes": size,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "retries": self.retries,
+        }
+
+    def close(self):
+        """Unmap the segment. The backing file is kept, for other processes"""
+        self._mm.close()
+        os.close(self._fd)
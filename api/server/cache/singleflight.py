@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, Callable, Awaitable, Optional, Set, TypeVar, Generic, Union
+from .tiered import maybe_await
+
+T = TypeVar("T")
+
+class LeaderGone(Exception):
+    """Leader was cancelled before producing a result"""
+
+class SingleFlight(Generic[T]):
+    """Coalesce concurrent computation of the same key.
+
+    Within one process, only the first caller (leader) computes. Concurrent callers (followers) await the result of the leader.
+
+    Across processes (uvicorn workers, replicas), the leader additionally acquires a short lived lock from the store.
+    If the lock is held by another process, the caller polls `lookup` until the value appears, or the lock is released.
+    If the value is stored only after it is returned (e.g. a streamed response, see `CacheTee`), the lock is held
+    (and refreshed) in the background until then."""
+
+    def __init__(self, lock_ttl: float, wait_timeout: float):
+        """
+        Args:
+            lock_ttl: seconds, after which the cross process lock expires
+            wait_timeout: maximum seconds to wait for another process, before computing anyway
+        """
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._holding: Set[asyncio.Task] = set()
+        self.counters: Dict[str, int] = defaultdict(int)
+        """`leaders`, `followers` (in process), `remote_waits`, `remote_hits` (value computed by another process)"""
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[T]], lookup: Callable[[], Union[Optional[T], Awaitable[Optional[T]]]], store=None, pending: Callable[[T], Optional[Awaitable]]=None) -> T:
+        """Run `compute` once per key, across concurrent callers.
+
+        Args:
+            key: coalescing key
+            compute: coroutine function producing the value (and storing it in `store`)
+            lookup: (coroutine) function returning the value from `store`, or None if it is not (yet) present
+            store: store providing `acquire_lock` and `release_lock`. If not provided, only coalesce within this process
+            pending: function returning an awaitable, which completes once the computed value is stored (or not to be
+                stored), or None if it is stored already. The lock is released once it completes, at most after `wait_timeout`
+
+        Returns:
+            the value produced by the leader"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.counters["followers"] += 1
+            try:
+                return await asyncio.shield(future)
+            except LeaderGone:
+                return await compute()
+
+        future = asyncio.get_running_loop().create_future()
+        # avoid "exception never retrieved" warning, if there are no followers
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        self.counters["leaders"] += 1
+        try:
+            result = await self._run_leader(key, compute, lookup, store, pending)
+        except asyncio.CancelledError:
+            future.set_exception(LeaderGone())
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _run_leader(self, key: str, compute: Callable[[], Awaitable[T]], lookup: Callable[[], Union[Optional[T], Awaitable[Optional[T]]]], store=None, pending: Callable[[T], Optional[Awaitable]]=None) -> T:
+        if store is None:
+            return await compute()
+
+        deadline = time.monotonic() + self.wait_timeout
+        wait = 0.05
+        waited = False
+        while True:
+            token = await maybe_await(store.acquire_lock(key, self.lock_ttl))
+            if token is not None:
+                held = False
+                try:
+                    # another process may have released the lock, after storing the value
+                    value = (await maybe_await(lookup())) if waited else None
+                    if value is not None:
+                        self.counters["remote_hits"] += 1
+                        return value
+                    value = await compute()
+                    until = pending(value) if pending else None
+                    if until is not None:
+                        self._holding.add(asyncio.create_task(self._hold_lock(key, token, store, until)))
+                        held = True
+                    return value
+                finally:
+                    if not held:
+                        await maybe_await(store.release_lock(key, token))
+
+            if not waited:
+                self.counters["remote_waits"] += 1
+                waited = True
+            value = await maybe_await(lookup())
+            if value is not None:
+                self.counters["remote_hits"] += 1
+                return value
+            if time.monotonic() > deadline:
+                return await compute()
+            await asyncio.sleep(wait)
+            wait = min(wait * 2, 1)
+
+    async def _hold_lock(self, key: str, token: str, store, until: Awaitable):
+        """Hold the lock until `until` completes, refreshing it before it expires. Other processes wait for
+        `wait_timeout` at most, so the lock is not held for longer."""
+        task = asyncio.current_task()
+        deadline = time.monotonic() + self.wait_timeout
+        until = asyncio.ensure_future(until)
+        try:
+            while not until.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.wait([until], timeout=min(self.lock_ttl / 2, remaining))
+                if not until.done() and hasattr(store, "refresh_lock"):
+                    await maybe_await(store.refresh_lock(key, token, self.lock_ttl))
+        finally:
+            until.cancel()
+            try:
+                await maybe_await(store.release_lock(key, token))
+            finally:
+                self._holding.discard(task)
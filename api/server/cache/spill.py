@@ -0,0 +1,144 @@
+from hashlib import blake2b
+from pathlib import Path
+from typing import List, Optional
+import asyncio
+import os
+import time
+from uuid import uuid4
+from api.siibra_api_config import CACHE_SPILL_DIR, CACHE_SPILL_MAX_AGE_SEC, CACHE_SPILL_BYTES, CACHE_STORE_BINARY, IS_CI
+from api.common import general_logger
+from api.common.timer import Cron
+from .codec import _codec_executor
+
+SPILL_PREFIX = b"[spill] "
+"""Leading bytes of the pointer stored in redis, in place of a spilled value"""
+
+_enabled = CACHE_SPILL_BYTES > 0 and CACHE_STORE_BINARY and not IS_CI
+
+cron = Cron()
+
+class SpilledFile:
+    """Spilled value, i.e. gzip bytes held in a file on the shared volume. Served to clients as is (see `FileResponse`)."""
+
+    def __init__(self, path: Path, size: int):
+        """
+        Args:
+            path: path of the file
+            size: size of the file in bytes
+        """
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    async def read(self) -> bytes:
+        """Read the gzip bytes"""
+        return await asyncio.get_running_loop().run_in_executor(_codec_executor, self.path.read_bytes)
+
+def get_spill_path(digest: str) -> Path:
+    """Get the path of a spilled value, by its content hash"""
+    return Path(CACHE_SPILL_DIR, digest[:2], f"{digest}.gz")
+
+def is_pointer(stored: bytes) -> bool:
+    return stored.startswith(SPILL_PREFIX)
+
+def _write(value: bytes) -> bytes:
+    digest = blake2b(value, digest_size=16).hexdigest()
+    path = get_spill_path(digest)
+    if path.is_file():
+        # content addressed: identical values share the file. Refresh its age, see `sweep`
+        os.utime(path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid4().hex}")
+        tmp_path.write_bytes(value)
+        os.replace(tmp_path, path)
+    return SPILL_PREFIX + digest.encode("utf-8")
+
+async def spill(value: bytes) -> bytes:
+    """Write gzip bytes to the shared volume (in a thread pool), under their content hash.
+
+    Args:
+        value: gzip bytes
+
+    Returns:
+        pointer, to be stored in place of the value"""
+    return await asyncio.get_running_loop().run_in_executor(_codec_executor, _write, value)
+
+def _open(pointer: bytes) -> Optional[SpilledFile]:
+    path = get_spill_path(pointer[len(SPILL_PREFIX):].decode("utf-8"))
+    try:
+        return SpilledFile(path, path.stat().st_size)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        general_logger.warning(f"Cannot open spilled {path}: {str(e)}")
+        return None
+
+async def open_spilled(pointer: bytes) -> Optional[SpilledFile]:
+    """Get the spilled value a pointer refers to.
+
+    Args:
+        pointer: as returned by `spill`
+
+    Returns:
+        SpilledFile, or None if the file no longer exists (e.g. swept)"""
+    return await asyncio.get_running_loop().run_in_executor(_codec_executor, _open, pointer)
+
+def _unlink(pointers: List[bytes]) -> int:
+    deleted = 0
+    for pointer in pointers:
+        path = get_spill_path(pointer[len(SPILL_PREFIX):].decode("utf-8"))
+        try:
+            path.unlink()
+            deleted += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            general_logger.warning(f"Cannot delete spilled {path}: {str(e)}")
+    return deleted
+
+async def unlink_spilled(pointers: List[bytes]) -> int:
+    """Delete the spilled values pointers refer to (in a thread pool), e.g. once invalidated.
+
+    Args:
+        pointers: as returned by `spill`
+
+    Returns:
+        number of files deleted"""
+    return await asyncio.get_running_loop().run_in_executor(_codec_executor, _unlink, pointers)
+
+@cron.ten_minutely
+def sweep(max_age: float=CACHE_SPILL_MAX_AGE_SEC) -> int:
+    """Delete spilled values not written for longer than `CACHE_SPILL_MAX_AGE_SEC`.
+
+    Pointers to deleted files are treated as misses.
+
+    Args:
+        max_age: seconds
+
+    Returns:
+        number of files deleted"""
+    deleted = 0
+    threshold = time.time() - max_age
+    for path in Path(CACHE_SPILL_DIR).glob("*/*.gz"):
+        try:
+            if path.stat().st_mtime < threshold:
+                path.unlink()
+                deleted += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            general_logger.warning(f"Cannot sweep {path}: {str(e)}")
+    return deleted
+
+def on_startup():
+    """On startup call. If spilling is enabled, sweep spilled values every ten minutes."""
+    if _enabled:
+        cron.start()
+
+def on_terminate():
+    """On terminate call"""
+    if _enabled:
+        cron.stop()
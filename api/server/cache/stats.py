@@ -0,0 +1,38 @@
+"""Metrics of the response cache, exported in the `/metrics` endpoint (see `api.server.metrics.get_live_metrics`).
+
+Metrics are updated where the counted events happen. The server runs several processes (uvicorn workers): if
+`PROMETHEUS_MULTIPROC_DIR` is set, their values are kept in that directory, and aggregated over all processes when
+scraped (see prometheus_client multiprocess mode).
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+UNMATCHED_ROUTE = "(unmatched)"
+"""Route template of requests not matching any route"""
+
+SIZE_BUCKETS = (256, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+"""Upper bounds (bytes) of the buckets of entry size histograms"""
+
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+"""Upper bounds (seconds) of the buckets of latency histograms"""
+
+route_requests = Counter("response_cache_route", "Response cache counters (hit, stale, miss, bypass, negative_hit, set), per route template", ("route", "counter"))
+"""(route template, counter). Counters are `hit`, `stale`, `miss`, `bypass`, `negative_hit` and `set`"""
+
+bypass_requests = Counter("response_cache_bypass", "Requests bypassing the response cache, per route template and reason (e.g. query:bbox=)", ("route", "reason"))
+"""(route template, reason) of requests bypassing the cache. See `middleware_cache_response` for reasons"""
+
+negative_responses = Counter("response_cache_negative", "Negative caching counters (hits, stores, skipped) of error responses", ("counter",))
+"""`hits` (error responses served from cache), `stores` (error responses cached), `skipped` (error responses not cached, e.g. 5xx)"""
+
+tier_lookups = Counter("response_cache_tier", "Response cache counters (hits, misses, promotions), per tier", ("tier", "counter"))
+"""(tier, counter). Counters are `hits`, `misses` and `promotions`, see `CacheTiered`"""
+
+store_events = Counter("response_cache_store", "Events of the in process and shared memory stores (evictions, expirations, retries)", ("store", "event"))
+"""(store, event). Stores are `memory` (in process) and `shared`"""
+
+memory_bytes = Gauge("response_cache_memory_bytes", "Bytes held by the in process stores, of all live processes", multiprocess_mode="livesum")
+
+entry_bytes = Histogram("response_cache_entry_bytes", "Size of cached responses, uncompressed and compressed", ("encoding",), buckets=SIZE_BUCKETS)
+codec_seconds = Histogram("response_cache_codec_seconds", "Time spent (de)compressing cached responses", ("operation", "codec"), buckets=SECONDS_BUCKETS)
+redis_seconds = Histogram("response_cache_redis_seconds", "Latency of redis (response cache) calls, including (de)compression", ("operation",), buckets=SECONDS_BUCKETS)
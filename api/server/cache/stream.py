@@ -0,0 +1,124 @@
+import asyncio
+import zlib
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+from api.siibra_api_config import CACHE_MAX_BODY_BYTES
+from .etag import etag_hash
+from .codec import run_codec
+from .stats import entry_bytes
+
+class CacheWriter:
+    """Incrementally hash and gzip a response body, chunk by chunk.
+
+    Once more than `max_bytes` are fed, the writer overflows: the buffered chunks are dropped, and the body is not to be cached."""
+
+    def __init__(self, max_bytes: int=CACHE_MAX_BODY_BYTES):
+        """
+        Args:
+            max_bytes: maximum size of the (uncompressed) body
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = etag_hash()
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._chunks: List[bytes] = []
+
+    @property
+    def overflowed(self) -> bool:
+        return self._compressor is None
+
+    async def feed(self, chunk: bytes):
+        """Feed the next chunk of the body. Large chunks are compressed in a thread pool, see `run_codec`.
+
+        Args:
+            chunk: bytes"""
+        if self.overflowed:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            self._compressor = None
+            self._hash = None
+            self._chunks = []
+            return
+        self._hash.update(chunk)
+        compressed = await run_codec(self._compressor.compress, chunk)
+        if compressed:
+            self._chunks.append(compressed)
+
+    def finish(self) -> Optional[Tuple[bytes, str]]:
+        """Finish the body.
+
+        Returns:
+            gzip bytes and content hash of the body, or None if the writer overflowed"""
+        if self.overflowed:
+            return None
+        self._chunks.append(self._compressor.flush())
+        compressed = b"".join(self._chunks)
+        entry_bytes.labels("identity").observe(self.size)
+        entry_bytes.labels("gzip").observe(len(compressed))
+        return compressed, self._hash.hexdigest()
+
+class CacheTee:
+    """Forward a response body to the client as it is produced, whilst feeding it into a `CacheWriter`.
+
+    The entry is committed (with `commit`) only if the stream completes, and does not exceed the maximum size.
+
+    The body can only be iterated once. Concurrent requests coalesced with the streamed request (see `SingleFlight`)
+    should `claim` the body, and if they are not the consumer, `wait` for the entry to be committed."""
+
+    def __init__(self, head: List[bytes], body_iterator: AsyncIterator[bytes], commit: Optional[Callable[[bytes, str], Awaitable]]=None, max_bytes: int=CACHE_MAX_BODY_BYTES):
+        """
+        Args:
+            head: chunks already read from body_iterator
+            body_iterator: remainder of the body
+            commit: coroutine function storing gzip bytes and content hash of the complete body. If not provided, the body is passed through
+            max_bytes: maximum size of the (uncompressed) body to be committed
+        """
+        self._head = head
+        self._body_iterator = body_iterator
+        self._commit = commit
+        self.max_bytes = max_bytes
+        self._claimed = False
+        self._done = asyncio.Event()
+
+    def claim(self) -> bool:
+        """Claim the body.
+
+        Returns:
+            True for the first caller only, who is to iterate the body"""
+        claimed, self._claimed = self._claimed, True
+        return not claimed
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for the body to be consumed (and, if possible, committed).
+
+        Args:
+            timeout: seconds
+
+        Returns:
+            if the body was consumed within timeout"""
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def done(self):
+        """Wait for the body to be consumed, and committed (or not to be committed, e.g. if the stream failed)"""
+        await self._done.wait()
+
+    async def __aiter__(self):
+        writer = CacheWriter(self.max_bytes) if self._commit else None
+        try:
+            for chunk in self._head:
+                if writer:
+                    await writer.feed(chunk)
+                yield chunk
+            async for chunk in self._body_iterator:
+                if writer:
+                    await writer.feed(chunk)
+                yield chunk
+            result = writer and writer.finish()
+            if result:
+                await self._commit(*result)
+        finally:
+            self._done.set()
@@ -0,0 +1,55 @@
+from typing import Iterable, List, Optional, Tuple
+import re
+from starlette.requests import Request
+from starlette.routing import BaseRoute
+from starlette.types import Scope
+
+TAG_KEY_PREFIX = "[tag] "
+"""Prefix of keys holding the set of cache keys tagged with a tag"""
+
+TAG_PARAMS = {
+    "atlas_id": "atlas",
+    "parcellation_id": "parcellation",
+    "space_id": "space",
+    "region_id": "region",
+    "map_id": "map",
+    "feature_id": "feature",
+    "type": "feature_type",
+}
+"""Path/query parameter -> kind of atlas concept, which responses depend on"""
+
+_feature_type_re = re.compile(r"^/feature/([A-Za-z]\w*)")
+
+def get_tags(params: Iterable[Tuple[str, str]], path: str="") -> List[str]:
+    """Get the tags of a cached value, i.e. the atlas concepts it depends on, in the form of `<kind>:<id>`
+    (e.g. `parcellation:minds/core/parcellationatlas/v1.0.0/94c1125b-b87e-45e4-901c-00daee7f2579-290`).
+
+    Args:
+        params: (name, value) of path and query parameters
+        path: route path (e.g. `/feature/RegionalConnectivity`), feature routes are tagged with their feature type
+
+    Returns:
+        sorted, deduplicated list of tags"""
+    tags = set()
+    for name, value in params:
+        if name in TAG_PARAMS and isinstance(value, str) and value:
+            tags.add(f"{TAG_PARAMS[name]}:{value}")
+    match = _feature_type_re.match(path)
+    if match:
+        tags.add(f"feature_type:{match.group(1)}")
+    return sorted(tags)
+
+def get_request_tags(request: Request, matched: Optional[Tuple[BaseRoute, Scope]]) -> List[str]:
+    """Get the tags of the response to a request, from the path parameters of the matched route and the query parameters.
+
+    Args:
+        request: Request
+        matched: route and child scope matching the request, as returned by `lookup_handler_fn`
+
+    Returns:
+        list of tags (see `get_tags`)"""
+    if not matched:
+        return []
+    route, child_scope = matched
+    path_params = child_scope.get("path_params", {})
+    return get_tags([*path_params.items(), *request.query_params.multi_items()], getattr(route, "path", ""))
@@ -0,0 +1,254 @@
+from inspect import isawaitable
+from typing import List, Tuple, Union, Optional, Any, Iterable
+from .redis import NO_LOCK
+from .meta import META_KEY_PREFIX, CacheMeta
+from .spill import SpilledFile
+from .stats import tier_lookups
+
+COMPRESSED_KEY_PREFIX = "[gzip] "
+"""Prefix of keys holding gzipped values, in tiers which do not implement `get_compressed`"""
+
+async def maybe_await(value):
+    """Await value, if it is awaitable. Allows sync (in process) and async (network) stores to be chained."""
+    if isawaitable(value):
+        return await value
+    return value
+
+class CacheTiered:
+    """Chain of stores, queried from the first (fastest) to the last (slowest).
+
+    A hit in a lower tier promotes the value into all tiers above it. Values are written through to all tiers.
+    Stores may be sync (in process) or async (network).
+
+    Per tier, the following counters are kept (see `tier_lookups`):
+
+    - `hits`: lookups answered by this tier
+    - `misses`: lookups this tier could not answer
+    - `promotions`: values copied into this tier, after a hit in a lower tier
+
+    Values dropped by a tier for lack of space (they may still be found in lower tiers) are counted by the store, as
+    `evictions` (see `store_events`).
+    """
+
+    def __init__(self, tiers: List[Tuple[str, Any]]):
+        """
+        Args:
+            tiers: list of (name, store) tuples, from the fastest to the slowest
+        """
+        self.tiers = tiers
+
+    @property
+    def is_connected(self):
+        return any(getattr(store, "is_connected", True) for _, store in self.tiers)
+
+    async def get_value(self, key: str) -> Optional[Union[str, bytes]]:
+        """Get stored value according to key, from the fastest tier that has it.
+
+        Args:
+            key: str
+
+        Returns:
+            stored value"""
+        value, _, _ = await self.get_entry(key)
+        return value
+
+    async def get_compressed(self, key: str) -> Optional[bytes]:
+        """Get stored value according to key, as gzip bytes.
+
+        Tiers without `get_compressed` (e.g. in process store) hold the gzip bytes under a separate key.
+
+        Args:
+            key: str
+
+        Returns:
+            gzipped stored value"""
+        value, _, _ = await self.get_entry(key, compressed=True)
+        return value
+
+    async def get_entry(self, key: str, compressed: bool=False, stale_window: float=0) -> Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]:
+        """Get stored value according to key, for how long it has been stale, and its metadata.
+
+        An entry is stale, if it expires within `stale_window` seconds. Stale entries, and spilled entries (see
+        `SpilledFile`), are not promoted.
+
+        Args:
+            key: str
+            compressed: if set, get the value as gzip bytes
+            stale_window: seconds
+
+        Returns:
+            stored value, seconds since the value became stale (None if the value is fresh), metadata (None if absent)"""
+        for idx, (name, store) in enumerate(self.tiers):
+            remaining = None
+            if hasattr(store, "get_entry"):
+                value, remaining, meta = await maybe_await(store.get_entry(key, compressed=compressed))
+            else:
+                value = await maybe_await(store.get_value((COMPRESSED_KEY_PREFIX + key) if compressed else key))
+                meta = value and CacheMeta.loads(await maybe_await(store.get_value(META_KEY_PREFIX + key)))
+            if value is None:
+                tier_lookups.labels(name, "misses").inc()
+                continue
+            tier_lookups.labels(name, "hits").inc()
+
+            return await self._promote(idx, key, value, remaining, meta, compressed, stale_window)
+        return None, None, None
+
+    async def get_entries(self, keys: List[str], compressed: bool=False, stale_window: float=0) -> List[Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]]:
+        """Get several entries (see `get_entry`). Tiers providing `get_entries` (e.g. redis) are asked for all keys
+        they may hold at once, e.g. in a single round trip.
+
+        Args:
+            keys: list of str
+            compressed: if set, get the values as gzip bytes
+            stale_window: seconds
+
+        Returns:
+            entry per key"""
+        entries: List[Tuple[Optional[Union[str, bytes]], Optional[float], Optional[CacheMeta]]] = [(None, None, None)] * len(keys)
+        missing = list(range(len(keys)))
+        for idx, (name, store) in enumerate(self.tiers):
+            if not missing:
+                break
+            if hasattr(store, "get_entries"):
+                found = await maybe_await(store.get_entries([keys[key_idx] for key_idx in missing], compressed=compressed))
+                found = found or [(None, None, None)] * len(missing)
+            elif hasattr(store, "get_entry"):
+                found = [await maybe_await(store.get_entry(keys[key_idx], compressed=compressed)) for key_idx in missing]
+            else:
+                found = []
+                for key_idx in missing:
+                    key = keys[key_idx]
+                    value = await maybe_await(store.get_value((COMPRESSED_KEY_PREFIX + key) if compressed else key))
+                    meta = value and CacheMeta.loads(await maybe_await(store.get_value(META_KEY_PREFIX + key)))
+                    found.append((value, None, meta))
+            still_missing = []
+            for key_idx, (value, remaining, meta) in zip(missing, found):
+                if value is None:
+                    tier_lookups.labels(name, "misses").inc()
+                    still_missing.append(key_idx)
+                    continue
+                tier_lookups.labels(name, "hits").inc()
+                entries[key_idx] = await self._promote(idx, keys[key_idx], value, remaining, meta, compressed, stale_window)
+            missing = still_missing
+        return entries
+
+    async def _promote(self, idx: int, key: str, value, remaining: Optional[float], meta: Optional[CacheMeta], compressed: bool, stale_window: float):
+        """Promote a value found in tier idx into the faster tiers, unless stale or spilled. Returns the entry."""
+        fresh_remaining = None if remaining is None else remaining - stale_window
+        if fresh_remaining is not None and fresh_remaining <= 0:
+            return value, -fresh_remaining, meta
+        if isinstance(value, SpilledFile):
+            return value, None, meta
+
+        for upper_name, upper_store in self.tiers[:idx]:
+            if hasattr(upper_store, "get_entry"):
+                continue
+            upper_key = (COMPRESSED_KEY_PREFIX + key) if compressed else key
+            if await maybe_await(upper_store.set_value(upper_key, value, ttl=fresh_remaining)) is not False:
+                tier_lookups.labels(upper_name, "promotions").inc()
+                if meta:
+                    await maybe_await(upper_store.set_value(META_KEY_PREFIX + key, meta.dumps(), ttl=fresh_remaining))
+        return value, None, meta
+
+    async def get_meta(self, key: str, stale_window: float=0) -> Tuple[Optional[CacheMeta], Optional[float]]:
+        """Get metadata of the stored value according to key, without fetching the value.
+
+        Args:
+            key: str
+            stale_window: seconds (see `get_entry`)
+
+        Returns:
+            metadata (None if absent), seconds since the value became stale (None if the value is fresh)"""
+        for _, store in self.tiers:
+            remaining = None
+            if hasattr(store, "get_meta"):
+                meta, remaining = await maybe_await(store.get_meta(key))
+            else:
+                meta = CacheMeta.loads(await maybe_await(store.get_value(META_KEY_PREFIX + key)))
+            if meta is None:
+                continue
+            fresh_remaining = None if remaining is None else remaining - stale_window
+            if fresh_remaining is not None and fresh_remaining <= 0:
+                return meta, -fresh_remaining
+            return meta, None
+        return None, None
+
+    async def set_value(self, key: str, value: Union[str, bytes], ttl: float=None, stale_window: float=0, meta: CacheMeta=None, compressed: bool=False, tags: Iterable[str]=()):
+        """Write value to all tiers.
+
+        Args:
+            key: str
+            value: value to be stored
+            ttl: seconds for which the value is fresh. If not provided, the value does not expire
+            stale_window: seconds, after ttl, for which the stale value is retained (in tiers supporting `get_entry`)
+            meta: metadata of the value
+            compressed: if set, value is already gzip bytes
+            tags: atlas concepts the value depends on (see `get_tags`), recorded in tiers supporting `invalidate_tags`"""
+        for _, store in self.tiers:
+            if hasattr(store, "get_entry"):
+                kwargs = { "tags": tags } if tags and hasattr(store, "invalidate_tags") else {}
+                await maybe_await(store.set_value(key, value, ttl=(ttl + stale_window) if ttl else None, meta=meta, compressed=compressed, **kwargs))
+                continue
+            stored_key, other_key = (COMPRESSED_KEY_PREFIX + key, key) if compressed else (key, COMPRESSED_KEY_PREFIX + key)
+            await maybe_await(store.set_value(stored_key, value, ttl=ttl))
+            if meta:
+                await maybe_await(store.set_value(META_KEY_PREFIX + key, meta.dumps(), ttl=ttl))
+            if hasattr(store, "delete"):
+                await maybe_await(store.delete(other_key))
+                if not meta:
+                    await maybe_await(store.delete(META_KEY_PREFIX + key))
+
+    async def invalidate_tags(self, tags: Iterable[str]) -> List[str]:
+        """Invalidate values tagged with any of tags.
+
+        Tags are recorded in the tiers supporting `invalidate_tags` (i.e. redis). The keys invalidated there are also
+        removed from the other tiers (of this process). In process tiers of other processes expire on their own.
+
+        Args:
+            tags: tags, e.g. `parcellation:<id>`
+
+        Returns:
+            list of keys invalidated"""
+        tags = list(tags)
+        keys = set()
+        for _, store in self.tiers:
+            if hasattr(store, "invalidate_tags"):
+                keys.update(await maybe_await(store.invalidate_tags(tags)))
+        await self.evict(keys)
+        return sorted(keys)
+
+    async def evict(self, keys: Iterable[str]):
+        """Remove keys (and their compressed values and metadata) from the tiers of this process, e.g. once deleted from
+        redis (see `invalidate_tags`, `purge_prefix`). In process tiers of other processes expire on their own.
+
+        Args:
+            keys: list of str"""
+        keys = list(keys)
+        for _, store in self.tiers:
+            if hasattr(store, "invalidate_tags") or not hasattr(store, "delete"):
+                continue
+            for key in keys:
+                for stored_key in (key, COMPRESSED_KEY_PREFIX + key, META_KEY_PREFIX + key):
+                    await maybe_await(store.delete(stored_key))
+
+    async def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """Acquire lock on the slowest (shared) tier, which supports locking."""
+        for _, store in self.tiers[::-1]:
+            if hasattr(store, "acquire_lock"):
+                return await maybe_await(store.acquire_lock(key, ttl))
+        return NO_LOCK
+
+    async def refresh_lock(self, key: str, token: str, ttl: float) -> bool:
+        """Extend lock acquired with `acquire_lock`"""
+        for _, store in self.tiers[::-1]:
+            if hasattr(store, "acquire_lock"):
+                if not hasattr(store, "refresh_lock"):
+                    return False
+                return await maybe_await(store.refresh_lock(key, token, ttl))
+        return False
+
+    async def release_lock(self, key: str, token: str):
+        """Release lock acquired with `acquire_lock`"""
+        for _, store in self.tiers[::-1]:
+            if hasattr(store, "release_lock"):
+                return await maybe_await(store.release_lock(key, token))
@@ -0,0 +1,94 @@
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Optional, Callable, List
+import json
+from fastapi.encoders import jsonable_encoder
+from api.siibra_api_config import CACHE_DEFAULT_TTL_SEC
+from api.common import general_logger
+from . import get_instance, single_flight
+from .fingerprint import get_handler_fingerprint
+from .tags import get_tags
+
+UNPAGINATED_KEY_PREFIX = "[unpaginated] "
+"""Prefix of keys holding the full (unpaginated) result of a data handler"""
+
+def get_unpaginated_key(name: str, fingerprint: str, args, kwargs) -> str:
+    """Get cache key of the full result of a data handler call.
+
+    Args:
+        name: name of the route handler
+        fingerprint: fingerprint of the route handler and data handler (see `get_handler_fingerprint`)
+        args: positional arguments, with which the data handler is called
+        kwargs: keyword arguments, with which the data handler is called
+
+    Returns:
+        cache key"""
+    arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+    return f"[{fingerprint}] {UNPAGINATED_KEY_PREFIX}{name}{arguments}"
+
+def cache_unpaginated(ttl: Optional[float]=CACHE_DEFAULT_TTL_SEC):
+    """Cache the full result of the data handler (`func`) of a paginated route, so that every page is sliced from
+    the same, once computed, list (including the correct total).
+
+    Should be used directly below `@async_router_decorator`, on async route handlers, e.g.:
+
+    ```python
+    @router.get("", response_model=Page[ParcellationEntityVersionModel])
+    @version(*FASTAPI_VERSION)
+    @async_router_decorator(ROLE, func=all_regions)
+    @cache_unpaginated()
+    async def get_all_regions(parcellation_id: str, find:str=None, func=lambda:[]):
+        return paginate(await func(parcellation_id, find=find))
+    ```
+
+    Args:
+        ttl: seconds for which the full result is cached. If None, it never expires.
+
+    Raises:
+        AssertionError: if the route handler is not async
+    """
+    def outer(fn):
+        assert iscoroutinefunction(fn), f"cache_unpaginated can only be used to decorate async functions"
+        name = fn.__name__
+
+        async def lookup(key: str):
+            try:
+                cached_value = await get_instance().get_value(key)
+                return None if cached_value is None else json.loads(cached_value)
+            except Exception as e:
+                general_logger.warning(f"Reading unpaginated result {key} failed: {str(e)}")
+                return None
+
+        async def store(key: str, result, tags: List[str]):
+            if result is None:
+                return
+            try:
+                await get_instance().set_value(key, json.dumps(jsonable_encoder(result)), ttl=ttl, tags=tags)
+            except Exception as e:
+                general_logger.warning(f"Storing unpaginated result {key} failed: {str(e)}")
+
+        # tagged by the parameters of the route handler, see `get_tags`
+        # func is async, see `async_router_decorator`
+        def wrap_func(func: Callable, tags: List[str]):
+            if func is None:
+                return None
+            fingerprint = get_handler_fingerprint(fn, func)
+            async def cached_func(*args, **kwargs):
+                key = get_unpaginated_key(name, fingerprint, args, kwargs)
+                async def compute():
+                    result = await func(*args, **kwargs)
+                    await store(key, result, tags)
+                    return result
+                cached_result = await lookup(key)
+                if cached_result is not None:
+                    return cached_result
+                return await single_flight.run(key, compute, lambda: lookup(key), store=get_instance())
+            return cached_func
+
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            if "func" in kwargs:
+                kwargs["func"] = wrap_func(kwargs["func"], get_tags(kwargs.items()))
+            return await fn(*args, **kwargs)
+        return inner
+    return outer
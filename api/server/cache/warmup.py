@@ -0,0 +1,330 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit, unquote
+import asyncio
+import gzip
+import re
+import time
+from api.siibra_api_config import (
+    __version__, LOGGER_DIR, IS_CI, CACHE_WARMUP_ON_STARTUP, CACHE_WARMUP_TOP, CACHE_WARMUP_CONCURRENCY,
+    CACHE_WARMUP_WINDOW_SEC, CACHE_WARMUP_TIMEOUT_SEC,
+)
+from api.common import general_logger
+from ..const import cache_header
+from ..util import internal_request
+from ..code_snippet import lookup_handler_fn
+from .fingerprint import get_route_template
+
+WARMUP_CLAIM_KEY = f"warmup {__version__}"
+"""Key of the lock claiming the warmup on startup of this version, see `claim_warmup`"""
+
+WARMUP_HEADER = "x-siibra-api-warmup"
+"""Header of warmup requests. They are not access logged, so as not to count towards popularity."""
+
+ACCESS_LOG_GLOB = "*.access.log*"
+"""Access logs (of all hosts, including rotated logs) in `LOGGER_DIR`"""
+
+WARM_STATUS_CODES = (200, 304)
+"""Status codes of logged requests, which are served from the cache once warm"""
+
+_access_log_line = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\d+) - (\d+)ms - (\w+) - (\S+) (\S+)$")
+
+class AccessLogEntry(NamedTuple):
+    """Request, as logged by `middleware_access_log`"""
+    time: datetime
+    status: int
+    process_time_ms: int
+    hit_cache: str
+    method: str
+    url: str
+
+class TemplateStats(NamedTuple):
+    """Popularity of a route template"""
+    template: str
+    requests: int
+    latency_ms: float
+    """mean latency of cache misses (of all requests, if none missed)"""
+
+    @property
+    def score(self) -> float:
+        return self.requests * self.latency_ms
+
+class WarmupPlan(NamedTuple):
+    urls: List[str]
+    """path and query of the requests to issue, most valuable first"""
+    url_requests: Dict[str, int]
+    """url -> number of logged requests"""
+    templates: List[TemplateStats]
+    """route templates, most valuable first"""
+    requests: int
+    """number of logged requests"""
+    cacheable: int
+    """number of logged requests, which may be served from the cache"""
+
+class WarmupReport(NamedTuple):
+    requests: int
+    """number of logged requests"""
+    cacheable: int
+    """number of logged requests, which may be served from the cache"""
+    urls: int
+    """number of requests planned"""
+    warmed: int
+    """requests computed and cached"""
+    already_warm: int
+    """requests served from the cache"""
+    failed: int
+    """requests failed, or not successful"""
+    skipped: int
+    """requests not issued, due to the timeout"""
+    covered: int
+    """number of logged requests, whose url is now warm"""
+    seconds: float
+
+    @property
+    def coverage(self) -> float:
+        """fraction of logged requests, whose url is now warm"""
+        return self.covered / self.requests if self.requests else 0.0
+
+Fetch = Callable[[str], Awaitable[Tuple[int, Optional[str]]]]
+"""Issue a GET request (path and query), returning its status code and cache status (see `cache_header`)"""
+
+def parse_access_log_line(line: str) -> Optional[AccessLogEntry]:
+    """Parse a line of the access log. Returns None, if the line is not an access log entry."""
+    match = _access_log_line.match(line.strip())
+    if match is None:
+        return None
+    logged_at, status, process_time_ms, hit_cache, method, url = match.groups()
+    return AccessLogEntry(
+        time=datetime.strptime(logged_at, "%Y-%m-%d %H:%M:%S,%f"),
+        status=int(status),
+        process_time_ms=int(process_time_ms),
+        hit_cache=hit_cache,
+        method=method,
+        url=url,
+    )
+
+def get_access_log_paths(log_dir: str=LOGGER_DIR) -> List[Path]:
+    """Get the access logs in log_dir (see `LOGGER_DIR`)"""
+    if not log_dir:
+        return []
+    return sorted(Path(log_dir).glob(ACCESS_LOG_GLOB))
+
+def read_access_logs(paths: Iterable[Path], since: datetime) -> Iterator[AccessLogEntry]:
+    """Read the entries of access logs (plain, or gzipped), logged since.
+
+    Args:
+        paths: paths of access logs
+        since: local time (as logged)
+
+    Yields:
+        AccessLogEntry"""
+    for path in paths:
+        if datetime.fromtimestamp(path.stat().st_mtime) < since:
+            continue
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as fp:
+            for line in fp:
+                entry = parse_access_log_line(line)
+                if entry is not None and entry.time >= since:
+                    yield entry
+
+def _mean(total: int, count: int) -> float:
+    return total / count
+
+def plan_warmup(entries: Iterable[AccessLogEntry], app, top: int, bypass_reason: Callable[[str, str], Optional[str]]=None) -> WarmupPlan:
+    """Rank logged requests by the popularity of their url, and the latency of their route template.
+
+    The value of warming a url is the number of its requests, times the mean latency of cache misses of its route
+    template (i.e. the time saved, had they all been hits). Requests not matching a route, unsuccessful, or bypassing
+    the cache are not planned.
+
+    Args:
+        entries: logged requests
+        app: FastAPI app, to match urls to route templates
+        top: maximum number of urls planned
+        bypass_reason: get the reason to bypass the cache of a url (path, query), see `get_url_bypass_reason`
+
+    Returns:
+        WarmupPlan"""
+    requests = 0
+    url_requests: Dict[str, int] = defaultdict(int)
+    url_templates: Dict[str, str] = {}
+    path_templates: Dict[str, Optional[str]] = {}
+    template_requests: Dict[str, int] = defaultdict(int)
+    # template -> [sum of latency, count] of misses and of all requests
+    miss_latency: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    all_latency: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+
+    for entry in entries:
+        requests += 1
+        if entry.method.upper() != "GET" or entry.status not in WARM_STATUS_CODES:
+            continue
+        split = urlsplit(entry.url)
+        path = unquote(split.path)
+        if bypass_reason is not None and bypass_reason(path, split.query):
+            continue
+        if split.path not in path_templates:
+            matched = lookup_handler_fn(app, {"type": "http", "method": "GET", "path": path, "root_path": ""})
+            path_templates[split.path] = get_route_template(app, matched[0]) if matched else None
+        template = path_templates[split.path]
+        if template is None:
+            continue
+
+        url = split.path + (f"?{split.query}" if split.query else "")
+        url_requests[url] += 1
+        url_templates[url] = template
+        template_requests[template] += 1
+        all_latency[template][0] += entry.process_time_ms
+        all_latency[template][1] += 1
+        if entry.hit_cache == "cache_miss":
+            miss_latency[template][0] += entry.process_time_ms
+            miss_latency[template][1] += 1
+
+    templates = sorted((
+        TemplateStats(
+            template=template,
+            requests=count,
+            latency_ms=_mean(*(miss_latency[template] if miss_latency[template][1] else all_latency[template])),
+        )
+        for template, count in template_requests.items()
+    ), key=lambda stats: stats.score, reverse=True)
+    template_latency = {stats.template: stats.latency_ms for stats in templates}
+
+    urls = sorted(url_requests, key=lambda url: (url_requests[url] * template_latency[url_templates[url]], url_requests[url]), reverse=True)
+    return WarmupPlan(
+        urls=urls[:top],
+        url_requests=dict(url_requests),
+        templates=templates,
+        requests=requests,
+        cacheable=sum(url_requests.values()),
+    )
+
+def in_process_fetch(app) -> Fetch:
+    """Issue requests against app in process (see `internal_request`), traversing all middlewares"""
+    async def fetch(url: str) -> Tuple[int, Optional[str]]:
+        path, _, query = url.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "scheme": "http",
+            "server": ("localhost", 80),
+            "client": ("127.0.0.1", 0),
+            "root_path": "",
+            "path": unquote(path),
+            "raw_path": path.encode("latin-1"),
+            "query_string": query.encode("latin-1"),
+            "headers": [(b"host", b"localhost")],
+        }
+        status_code, headers, _ = await internal_request(app, scope, {"accept-encoding": "gzip", WARMUP_HEADER: "1"})
+        return status_code, dict(headers).get(cache_header.encode("latin-1"), b"").decode("latin-1") or None
+    return fetch
+
+def remote_fetch(base_url: str, timeout: float=None) -> Fetch:
+    """Issue requests against a deployment (e.g. before it is exposed), in a thread pool"""
+    import requests
+
+    async def fetch(url: str) -> Tuple[int, Optional[str]]:
+        resp = await asyncio.get_running_loop().run_in_executor(None, partial(
+            requests.get,
+            base_url.rstrip("/") + url,
+            headers={"accept-encoding": "gzip", WARMUP_HEADER: "1"},
+            timeout=timeout,
+        ))
+        return resp.status_code, resp.headers.get(cache_header)
+    return fetch
+
+async def warm(plan: WarmupPlan, fetch: Fetch, concurrency: int, timeout: float=None) -> WarmupReport:
+    """Issue the planned requests, at most `concurrency` at a time.
+
+    Args:
+        plan: WarmupPlan
+        fetch: issue a request, see `in_process_fetch` and `remote_fetch`
+        concurrency: maximum number of concurrent requests
+        timeout: seconds, after which no further requests are issued. Requests in flight are awaited
+
+    Returns:
+        WarmupReport"""
+    start = time.monotonic()
+    deadline = (start + timeout) if timeout else None
+    counters: Dict[str, int] = defaultdict(int)
+    urls = iter(plan.urls)
+
+    async def worker():
+        # urls are shared, so that each is taken by one worker only
+        for url in urls:
+            if deadline is not None and time.monotonic() > deadline:
+                counters["skipped"] += 1
+                continue
+            try:
+                status_code, cache_status = await fetch(url)
+            except Exception as e:
+                general_logger.warning(f"Warming {url} failed: {str(e)}")
+                counters["failed"] += 1
+                continue
+            if status_code != 200:
+                counters["failed"] += 1
+                continue
+            counters["already_warm" if cache_status in ("hit", "stale") else "warmed"] += 1
+            counters["covered"] += plan.url_requests[url]
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    return WarmupReport(
+        requests=plan.requests,
+        cacheable=plan.cacheable,
+        urls=len(plan.urls),
+        warmed=counters["warmed"],
+        already_warm=counters["already_warm"],
+        failed=counters["failed"],
+        skipped=counters["skipped"],
+        covered=counters["covered"],
+        seconds=time.monotonic() - start,
+    )
+
+def format_report(report: WarmupReport) -> str:
+    """Summarize report, e.g. for logging"""
+    cacheable = f"{report.cacheable / report.requests:.1%}" if report.requests else "n/a"
+    return (
+        f"Warmed {report.warmed} urls ({report.already_warm} already warm, {report.failed} failed, {report.skipped} skipped) in {report.seconds:.1f}s. "
+        f"{report.coverage:.1%} of {report.requests} logged requests are now warm ({cacheable} may be cached)"
+    )
+
+async def claim_warmup(store, ttl: float=CACHE_WARMUP_WINDOW_SEC) -> bool:
+    """Claim the warmup on startup, so that one process (uvicorn worker, of any replica) warms the cache of a deployment.
+
+    The claim is held in redis (see `acquire_lock`) for ttl seconds, and not released once warm: processes (re)starting
+    meanwhile find the shared tiers warm. If redis is not available, each process warms its own in process store.
+
+    Args:
+        store: cache store, e.g. `CacheTiered`
+        ttl: seconds
+
+    Returns:
+        if this process is to warm the cache"""
+    return (await store.acquire_lock(WARMUP_CLAIM_KEY, ttl)) is not None
+
+async def on_startup(app, store, bypass_reason: Callable[[str, str], Optional[str]]=None):
+    """On startup call. If `CACHE_WARMUP_ON_STARTUP` is set, warm the cache with the requests logged (in `LOGGER_DIR`)
+    within the last `CACHE_WARMUP_WINDOW_SEC` seconds, before serving traffic. Only the process claiming the warmup
+    (see `claim_warmup`) issues requests, the others start without delay.
+
+    Args:
+        app: FastAPI app
+        store: cache store, holding the claim
+        bypass_reason: see `plan_warmup`"""
+    if not CACHE_WARMUP_ON_STARTUP or IS_CI:
+        return
+    paths = get_access_log_paths()
+    if not paths:
+        general_logger.warning("Cache warmup enabled, but no access logs found (is LOGGER_DIR set?)")
+        return
+    if not await claim_warmup(store):
+        general_logger.info(f"Cache warmup of {__version__} claimed by another process, skipping")
+        return
+    since = datetime.now() - timedelta(seconds=CACHE_WARMUP_WINDOW_SEC)
+    plan = plan_warmup(read_access_logs(paths, since), app, CACHE_WARMUP_TOP, bypass_reason)
+    report = await warm(plan, in_process_fetch(app), CACHE_WARMUP_CONCURRENCY, CACHE_WARMUP_TIMEOUT_SEC)
+    general_logger.info(format_report(report))
@@ -5,9 +5,11 @@ from fastapi_versioning import version
 from api.server import FASTAPI_VERSION
 from api.siibra_api_config import ROLE
 from api.models.core.parcellation import SiibraParcellationModel
-from api.common import router_decorator
+from api.common import async_router_decorator
 from api.common.data_handlers.core.parcellation import all_parcellations, single_parcellation
 from api.server.util import SapiCustomRoute
+from api.server.cache.policy import cache_policy, ONE_WEEK_SEC
+from api.server.cache.unpaginated import cache_unpaginated
 
 TAGS = ["parcellation"]
 """HTTP parcellation routes tags"""
@@ -17,19 +19,22 @@ router = APIRouter(route_class=SapiCustomRoute, tags=TAGS)
 
 @router.get("", response_model=Page[SiibraParcellationModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=all_parcellations)
-def get_all_parcellations(func):
+@cache_policy(ttl=ONE_WEEK_SEC)
+@async_router_decorator(ROLE, func=all_parcellations)
+@cache_unpaginated()
+async def get_all_parcellations(func):
     """HTTP get all parcellations"""
     if func is None:
         raise HTTPException(500, f"func: None passed")
-    return paginate(func())
+    return paginate(await func())
 
 @router.get("/{parcellation_id:lazy_path}", response_model=SiibraParcellationModel)
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=single_parcellation)
-def get_single_parcellation(parcellation_id: str, *, func):
+@cache_policy(ttl=ONE_WEEK_SEC)
+@async_router_decorator(ROLE, func=single_parcellation)
+async def get_single_parcellation(parcellation_id: str, *, func):
     """HTTP get a single parcellation"""
     if func is None:
         raise HTTPException(500, f"func: None passsed")
-    return func(parcellation_id)
+    return await func(parcellation_id)
 
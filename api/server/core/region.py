@@ -7,10 +7,11 @@ from functools import partial
 from api.server import FASTAPI_VERSION
 from api.siibra_api_config import ROLE
 from api.models.core.region import ParcellationEntityVersionModel, RegionRelationAsmtModel
-from api.common import router_decorator
+from api.common import async_router_decorator
 from api.common.data_handlers.core.region import all_regions, single_region, get_related_regions
 from api.common.data_handlers.features.types import get_all_all_features
 from api.server.util import SapiCustomRoute
+from api.server.cache.unpaginated import cache_unpaginated
 from api.server.features import FeatureIdResponseModel
 
 TAGS = ["region"]
@@ -21,31 +22,34 @@ router = APIRouter(route_class=SapiCustomRoute, tags=TAGS)
 
 @router.get("", response_model=Page[ParcellationEntityVersionModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=all_regions)
-def get_all_regions(parcellation_id: str, find:str=None, func=lambda:[]):
+@async_router_decorator(ROLE, func=all_regions)
+@cache_unpaginated()
+async def get_all_regions(parcellation_id: str, find:str=None, func=lambda:[]):
     """HTTP get all regions"""
-    return paginate(func(parcellation_id, find=find))
+    return paginate(await func(parcellation_id, find=find))
 
 @router.get("/{region_id:lazy_path}/features", response_model=Page[FeatureIdResponseModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=partial(get_all_all_features, space=None))
-def get_all_features_region(parcellation_id: str, region_id: str, func=lambda:[]):
+@async_router_decorator(ROLE, func=partial(get_all_all_features, space=None))
+@cache_unpaginated()
+async def get_all_features_region(parcellation_id: str, region_id: str, func=lambda:[]):
     """HTTP get all features of a single region"""
     return paginate(
-        func(parcellation_id=parcellation_id, region_id=region_id)
+        await func(parcellation_id=parcellation_id, region_id=region_id)
     )
 @router.get("/{region_id:lazy_path}/related", response_model=Page[RegionRelationAsmtModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=get_related_regions)
-def get_related_region(parcellation_id: str, region_id: str, func=lambda:[]):
+@async_router_decorator(ROLE, func=get_related_regions)
+@cache_unpaginated()
+async def get_related_region(parcellation_id: str, region_id: str, func=lambda:[]):
     """HTTP get_related_regions of the specified region"""
     return paginate(
-        func(parcellation_id=parcellation_id, region_id=region_id)
+        await func(parcellation_id=parcellation_id, region_id=region_id)
     )
     
 @router.get("/{region_id:lazy_path}", response_model=ParcellationEntityVersionModel)
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=single_region)
-def get_single_regions(parcellation_id: str, region_id: str, space_id: Optional[str]=None, func=lambda:None):
+@async_router_decorator(ROLE, func=single_region)
+async def get_single_regions(parcellation_id: str, region_id: str, space_id: Optional[str]=None, func=lambda:None):
     """HTTP get a single region"""
-    return func(parcellation_id, region_id, space_id)
+    return await func(parcellation_id, region_id, space_id)
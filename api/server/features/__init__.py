@@ -11,7 +11,7 @@ import re
 
 from api.server import FASTAPI_VERSION
 from api.siibra_api_config import ROLE
-from api.common import router_decorator, async_router_decorator
+from api.common import async_router_decorator
 from api.common.data_handlers.features.types import (
     all_feature_types, all_features, single_feature, get_single_feature_from_id, get_single_feature_plot_from_id,
     get_single_feature_download_zip_path,
@@ -32,6 +32,7 @@ from api.models.features.dataset.ebrains import (
 )
 from api.common.exceptions import NotFound
 from api.server.util import SapiCustomRoute
+from api.server.cache.unpaginated import cache_unpaginated
 from new_api.data_handlers.features import find_spatial_features
 from .util import wrap_feature_category
 from typing import List, Dict
@@ -109,10 +110,11 @@ def retrieve_routes(request: Request, feature_name: str) -> Dict:
 
 @router.get("/_types", response_model=Page[FeatureMetaModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=all_feature_types)
-def get_all_feature_types(request: Request, func):
+@async_router_decorator(ROLE, func=all_feature_types)
+@cache_unpaginated()
+async def get_all_feature_types(request: Request, func):
     """Get meta info of all feature types"""
-    all_types = func()
+    all_types = await func()
     all_types = sorted(all_types, key=lambda obj: obj['name'])
     all_types = [{
         **retrieve_routes(request, item['name']),
@@ -129,6 +131,7 @@ RegionalConnectivityModels = SiibraRegionalConnectivityModel
 @version(*FASTAPI_VERSION)
 @wrap_feature_category("RegionalConnectivity")
 @async_router_decorator(ROLE, func=partial(all_features, space_id=None, region_id=None))
+@cache_unpaginated()
 async def get_all_connectivity_features(parcellation_id: str, type: Optional[str]=None, func=lambda:[]):
     """Get all connectivity features"""
     type = str(type) if type else None
@@ -157,6 +160,7 @@ CortialProfileModels = SiibraCorticalProfileModel
 @version(*FASTAPI_VERSION)
 @wrap_feature_category("CorticalProfile")
 @async_router_decorator(ROLE, func=partial(all_features, space_id=None))
+@cache_unpaginated()
 async def get_all_corticalprofile_features(parcellation_id: str, region_id: str, type: Optional[str]=None, func=lambda:[]):
     """Get all CorticalProfile features"""
     type = str(type) if type else None
@@ -182,6 +186,7 @@ TabularModels = Union[SiibraCorticalProfileModel, SiibraReceptorDensityFp, Siibr
 @version(*FASTAPI_VERSION)
 @wrap_feature_category("Tabular")
 @async_router_decorator(ROLE, func=partial(all_features, space_id=None))
+@cache_unpaginated()
 async def get_all_tabular(parcellation_id: str, region_id: str, type: Optional[str]=None, func=lambda: []):
     """Get all tabular features"""
     type = str(type) if type else None
@@ -230,6 +235,7 @@ async def get_all_voi(space_id: str, bbox: Optional[str]=None, type: Optional[st
 @version(*FASTAPI_VERSION)
 @wrap_feature_category("GeneExpressions")
 @async_router_decorator(ROLE, func=partial(all_features, space_id=None, type="GeneExpressions"))
+@cache_unpaginated()
 async def get_all_gene(parcellation_id: str, region_id: str, gene: str, func=lambda: []):
     """Get all GeneExpressions features"""
     return paginate(
@@ -250,6 +256,7 @@ async def get_single_gene(parcellation_id: str, region_id: str, feature_id: str,
 @version(*FASTAPI_VERSION)
 @wrap_feature_category("EbrainsDataFeature")
 @async_router_decorator(ROLE, func=partial(all_features, space_id=None, type="EbrainsDataFeature"))
+@cache_unpaginated()
 async def get_all_ebrains_df(parcellation_id: str, region_id: str, func=lambda: []):
     """Get all EbrainsDataFeatures"""
     return paginate(
@@ -9,6 +9,8 @@ from functools import wraps
 from api.siibra_api_config import ROLE, CELERY_CONFIG, NAME_SPACE, MONITOR_FIRSTLVL_DIR
 from api.common.timer import Cron
 from api.common import general_logger
+from api.common.lanes import router as lane_router
+from new_api.common.lanes import router as v3_lane_router
 
 def is_server(fn: Callable):
     @wraps(fn)
@@ -28,6 +30,23 @@ def has_metric_dir(fn: Callable):
 
 cron = Cron()
 
+if ROLE == "server":
+    from prometheus_client import Counter
+    # tasks of api and of new_api
+    lane_router.lane_counter = v3_lane_router.lane_counter = Counter("task_lane", "Tasks routed into each lane (critical, fast, medium, slow), see TASK_LANES", ("lane",))
+
+def get_live_metrics() -> bytes:
+    """Get the metrics updated where the counted events happen (e.g. `api.server.cache.stats`), in the text format.
+
+    If `PROMETHEUS_MULTIPROC_DIR` is set, they are aggregated over all processes (uvicorn workers) of the server.
+    Otherwise, they are of this process."""
+    from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, multiprocess
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
 class Singleton:
     """Timer singleton"""
     cached_metrics=None
@@ -220,6 +239,10 @@ def on_startup():
 def on_terminate():
     """On terminate"""
     cron.stop()
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        # live gauges (e.g. tasks in flight) of this process are no longer exported
+        multiprocess.mark_process_dead(os.getpid())
 
 
 def prom_metrics_resp():
@@ -235,4 +258,4 @@ def prom_metrics_resp():
     if Singleton.cached_metrics is None:
         raise HTTPException(404, 'Not yet populated. Please wait ...')
     
-    return PlainTextResponse(Singleton.cached_metrics, status_code=200)
+    return PlainTextResponse(Singleton.cached_metrics + get_live_metrics(), status_code=200)
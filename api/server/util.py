@@ -1,4 +1,7 @@
 from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Scope, Message
+from typing import Dict, List, Tuple
+import asyncio
 
 class SapiCustomRoute(APIRoute):
     """SapiCustomRoute, custom route class. This is so that `func` param is not interpreted to be a part of swagger-api."""
@@ -95,3 +98,68 @@ def add_lazy_path():
         regex = ".*?"
 
     CONVERTOR_TYPES["lazy_path"] = LazyPathConverter()
+
+
+_forwarded_scope_keys = (
+    "type",
+    "asgi",
+    "http_version",
+    "scheme",
+    "server",
+    "client",
+    "root_path",
+    "path",
+    "raw_path",
+    "query_string",
+)
+
+async def internal_request(app: ASGIApp, scope: Scope, headers: Dict[str, str]=None) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """Issue a GET request against app, in process. The request traverses all middlewares, as if it came from the network.
+
+    Args:
+        app: ASGI app (usually `request.app`)
+        scope: scope of the request to be replicated
+        headers: headers to be added to (or replace those of) the original request
+    
+    Returns:
+        status code, response headers, response body
+    """
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    new_scope = {
+        key: scope[key]
+        for key in _forwarded_scope_keys
+        if key in scope
+    }
+    new_scope["method"] = "GET"
+    new_scope["headers"] = [
+        *[(key, value) for key, value in scope.get("headers", []) if key.decode("latin-1").lower() not in headers],
+        *[(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+    ]
+
+    # the (empty) request body is received once. Afterwards, receive blocks until the response is complete, as
+    # streamed responses listen for the client to disconnect whilst sending
+    request_received = False
+    response_complete = asyncio.Event()
+    async def receive() -> Message:
+        nonlocal request_received
+        if not request_received:
+            request_received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+    
+    status_code = 500
+    response_headers: List[Tuple[bytes, bytes]] = []
+    body: List[bytes] = []
+    async def send(message: Message):
+        nonlocal status_code, response_headers
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+            response_headers = message.get("headers", [])
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    await app(new_scope, receive, send)
+    return status_code, response_headers, b"".join(body)
@@ -10,8 +10,10 @@ from api.models.volumes.volume import MapType
 from api.siibra_api_config import ROLE
 from api.server import FASTAPI_VERSION, cache_header
 from api.server.util import SapiCustomRoute
+from api.server.cache.policy import cache_policy, ONE_WEEK_SEC
+from api.server.cache.unpaginated import cache_unpaginated
 from api.models.volumes.parcellationmap import MapModel
-from api.common import router_decorator, get_filename, logger, NotFound
+from api.common import async_router_decorator, get_filename, logger, NotFound
 from api.common.data_handlers.core.misc import (
     get_filtered_maps,
     get_single_map,
@@ -25,19 +27,22 @@ router = APIRouter(route_class=SapiCustomRoute, tags=TAGS)
 
 @router.get("", response_model=Page[MapModel])
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=get_filtered_maps)
-def filter_map(parcellation_id: str=None, space_id: str=None, map_type: Union[MapType, None]=None, *, func):
+@cache_policy(ttl=ONE_WEEK_SEC)
+@async_router_decorator(ROLE, func=get_filtered_maps)
+@cache_unpaginated()
+async def filter_map(parcellation_id: str=None, space_id: str=None, map_type: Union[MapType, None]=None, *, func):
     """Get a list of maps according to specification"""
     if func is None:
         raise HTTPException(500, f"func: None passsed")
-    return paginate(func(parcellation_id, space_id, map_type))
+    return paginate(await func(parcellation_id, space_id, map_type))
 
 
 @router.get("/{map_id:lazy_path}", response_model=MapModel)
 @version(*FASTAPI_VERSION)
-@router_decorator(ROLE, func=get_single_map)
-def single_map(map_id: str, *, func):
+@cache_policy(ttl=ONE_WEEK_SEC)
+@async_router_decorator(ROLE, func=get_single_map)
+async def single_map(map_id: str, *, func):
     """Get a list of maps according to specification"""
     if func is None:
         raise HTTPException(500, f"func: None passsed")
-    return func(map_id)
+    return await func(map_id)
@@ -50,6 +50,24 @@ ROLE = os.environ.get("SIIBRA_API_ROLE", "all")
 CELERY_CHANNEL = os.environ.get("SIIBRA_API_CELERY_CHANNEL", f"siibra-api-{__version__}")
 """CELERY_CHANNEL"""
 
+TASK_MAX_IN_FLIGHT = int(os.getenv("SIIBRA_API_TASK_MAX_IN_FLIGHT", 128))
+"""TASK_MAX_IN_FLIGHT. Maximum number of tasks awaited at a time by the route handlers (see `async_router_decorator`), per server process. Further requests wait for a slot."""
+
+TASK_DEDUP = os.getenv("SIIBRA_API_TASK_DEDUP", "1") != "0"
+"""TASK_DEDUP. Set to "0" to dispatch every task, rather than attaching to an identical task (same name and arguments) in flight, dispatched by any server process or replica."""
+
+TASK_LANES = os.getenv("SIIBRA_API_TASK_LANES", "0") != "0"
+"""TASK_LANES. Set to "1" to route tasks into lanes (queues suffixed `-critical`, `-fast`, `-medium` and `-slow`), by the recorded duration of their data handler. See `api.common.lanes`. Workers started with `-Q` must then listen on the lane queues."""
+
+TASK_LANE_FAST_SEC = float(os.getenv("SIIBRA_API_TASK_LANE_FAST_SEC", 0.1))
+"""TASK_LANE_FAST_SEC. Data handlers taking (on average) less than this many seconds are routed into the fast lane."""
+
+TASK_LANE_SLOW_SEC = float(os.getenv("SIIBRA_API_TASK_LANE_SLOW_SEC", 5))
+"""TASK_LANE_SLOW_SEC. Data handlers taking (on average) at least this many seconds are routed into the slow lane."""
+
+TASK_LANE_CRITICAL = [name.strip() for name in os.getenv("SIIBRA_API_TASK_LANE_CRITICAL", "all_regions,single_region").split(",") if name.strip()]
+"""TASK_LANE_CRITICAL. Comma separated data handlers (e.g. `all_regions`, or fully qualified task names) pinned to the critical lane, regardless of their duration."""
+
 REDIS_HOST = os.getenv("SIIBRA_API_REDIS_HOST") or os.getenv("SIIBRA_REDIS_SERVICE_HOST") or os.getenv("REDIS_SERVICE_HOST") or os.getenv("REDIS_HOST") or "localhost"
 """REDIS_HOST"""
 
@@ -59,6 +77,97 @@ REDIS_PORT = os.getenv("SIIBRA_API_REDIS_PORT") or os.getenv("SIIBRA_REDIS_SERVI
 REDIS_PASSWORD = os.getenv("SIIBRA_API_REDIS_PASSWORD")
 """REDIS_PASSWORD"""
 
+REDIS_POOL_SIZE = int(os.getenv("SIIBRA_API_REDIS_POOL_SIZE", 32))
+"""REDIS_POOL_SIZE. Maximum number of connections to redis (response cache), per process."""
+
+REDIS_TIMEOUT_SEC = float(os.getenv("SIIBRA_API_REDIS_TIMEOUT_SEC", 2))
+"""REDIS_TIMEOUT_SEC. Timeout of connecting to, and waiting for a reply from redis (response cache). On timeout, the lookup is treated as a miss."""
+
+REDIS_RETRY_SEC = float(os.getenv("SIIBRA_API_REDIS_RETRY_SEC", 5))
+"""REDIS_RETRY_SEC. After a failed redis (response cache) call, redis is bypassed for this many seconds."""
+
+CACHE_NODES = [
+    node if "://" in node else f"redis://{node}"
+    for node in (node.strip() for node in os.getenv("SIIBRA_API_CACHE_NODES", "").split(","))
+    if node
+]
+"""CACHE_NODES. Comma separated redis nodes (host:port, or redis urls e.g. redis://:password@host:port/db) of the response cache, separate from the celery broker. Keys are spread across nodes by consistent hashing. If not set, the response cache uses REDIS_HOST."""
+
+CACHE_NODE_VNODES = int(os.getenv("SIIBRA_API_CACHE_NODE_VNODES", 160))
+"""CACHE_NODE_VNODES. Number of virtual nodes per response cache node, on the consistent hash ring."""
+
+MEMORY_CACHE_SIZE_BYTES = int(os.getenv("SIIBRA_API_MEMORY_CACHE_SIZE_BYTES", 64 * 1024 * 1024))
+"""MEMORY_CACHE_SIZE_BYTES. Size of the in process response cache, in front of redis. Set to 0 to disable."""
+
+MEMORY_CACHE_TTL_SEC = float(os.getenv("SIIBRA_API_MEMORY_CACHE_TTL_SEC", 60))
+"""MEMORY_CACHE_TTL_SEC. Time to live of entries in the in process response cache."""
+
+SHARED_CACHE_SIZE_BYTES = int(os.getenv("SIIBRA_API_SHARED_CACHE_SIZE_BYTES", 0))
+"""SHARED_CACHE_SIZE_BYTES. Size of the response cache shared by all processes (e.g. uvicorn workers) on a host, between the in process cache and redis. Set to 0 (default) to disable."""
+
+SHARED_CACHE_PATH = os.getenv("SIIBRA_API_SHARED_CACHE_PATH", f"/dev/shm/siibra-api-cache-{NAME_SPACE}")
+"""SHARED_CACHE_PATH. Path of the file backing the shared response cache. Should be on a memory backed file system (e.g. /dev/shm)."""
+
+SHARED_CACHE_TTL_SEC = float(os.getenv("SIIBRA_API_SHARED_CACHE_TTL_SEC", 5 * 60))
+"""SHARED_CACHE_TTL_SEC. Time to live of entries in the shared response cache."""
+
+CACHE_STORE_BINARY = os.getenv("SIIBRA_API_CACHE_STORE_BINARY", "1") != "0"
+"""CACHE_STORE_BINARY. If set, store raw gzip bytes in redis. Otherwise, gzip then b64 encode (legacy). Entries in either format can be read."""
+
+CACHE_LOCK_TTL_SEC = float(os.getenv("SIIBRA_API_CACHE_LOCK_TTL_SEC", 60))
+"""CACHE_LOCK_TTL_SEC. Expiry of the lock held (across processes) whilst a response is computed on cache miss."""
+
+CACHE_LOCK_WAIT_SEC = float(os.getenv("SIIBRA_API_CACHE_LOCK_WAIT_SEC", 120))
+"""CACHE_LOCK_WAIT_SEC. Maximum time to wait for another process to compute a response, before computing it anyway."""
+
+CACHE_DEFAULT_TTL_SEC = float(os.getenv("SIIBRA_API_CACHE_DEFAULT_TTL_SEC", 24 * 60 * 60)) or None
+"""CACHE_DEFAULT_TTL_SEC. Seconds for which a cached response is fresh, unless a route declares otherwise. Set to 0 for no expiry."""
+
+CACHE_DEFAULT_SWR_SEC = float(os.getenv("SIIBRA_API_CACHE_DEFAULT_SWR_SEC", 60 * 60))
+"""CACHE_DEFAULT_SWR_SEC. Seconds after expiry, during which the stale response is served, whilst it is recomputed in the background."""
+
+CACHE_DEFAULT_SIE_SEC = float(os.getenv("SIIBRA_API_CACHE_DEFAULT_SIE_SEC", 24 * 60 * 60))
+"""CACHE_DEFAULT_SIE_SEC. Seconds after expiry, during which the stale response is served, if recomputing fails."""
+
+CACHE_NEGATIVE_TTL_SEC = float(os.getenv("SIIBRA_API_CACHE_NEGATIVE_TTL_SEC", 5 * 60))
+"""CACHE_NEGATIVE_TTL_SEC. Seconds for which deterministic error responses (400, 404) are cached, unless a route declares otherwise. Set to 0 to disable."""
+
+CACHE_SALT = os.getenv("SIIBRA_API_CACHE_SALT", "")
+"""CACHE_SALT. Part of the fingerprint of all cache keys. Change to invalidate all cached responses, e.g. if a change is not captured by the route fingerprints."""
+
+CACHE_ZSTD_MAX_BYTES = int(os.getenv("SIIBRA_API_CACHE_ZSTD_MAX_BYTES", 0))
+"""CACHE_ZSTD_MAX_BYTES. Cached responses up to this size are compressed with zstd (if zstandard is installed), larger ones with gzip. Defaults to 0, i.e. always gzip (served to clients as is): zstd is opt-in, and no dictionary is shipped. Set (e.g. to 65536) along with a trained dictionary (see CACHE_ZSTD_DICT)."""
+
+CACHE_ZSTD_DICT = os.getenv("SIIBRA_API_CACHE_ZSTD_DICT")
+"""CACHE_ZSTD_DICT. Path of the zstd dictionary. If not set, `api/server/cache/responses.zdict` is used, if present (none is shipped, see `python -m api.server.cache train-dictionary`)."""
+
+CACHE_MAX_BODY_BYTES = int(os.getenv("SIIBRA_API_CACHE_MAX_BODY_BYTES", 32 * 1024 * 1024))
+"""CACHE_MAX_BODY_BYTES. Responses with a larger (uncompressed) body are passed through to the client, without being cached."""
+
+CACHE_WARMUP_ON_STARTUP = os.getenv("SIIBRA_API_CACHE_WARMUP_ON_STARTUP", "0") != "0"
+"""CACHE_WARMUP_ON_STARTUP. If set, warm the response cache with the most popular requests (from the access logs in LOGGER_DIR) on startup, before serving traffic. Only one process per deployment (the first to claim it in redis) warms the cache."""
+
+CACHE_WARMUP_TOP = int(os.getenv("SIIBRA_API_CACHE_WARMUP_TOP", 500))
+"""CACHE_WARMUP_TOP. Number of requests issued when warming the response cache."""
+
+CACHE_WARMUP_CONCURRENCY = int(os.getenv("SIIBRA_API_CACHE_WARMUP_CONCURRENCY", 8))
+"""CACHE_WARMUP_CONCURRENCY. Maximum number of concurrent requests when warming the response cache."""
+
+CACHE_WARMUP_WINDOW_SEC = float(os.getenv("SIIBRA_API_CACHE_WARMUP_WINDOW_SEC", 24 * 60 * 60))
+"""CACHE_WARMUP_WINDOW_SEC. Requests logged within this many seconds are considered when warming the response cache."""
+
+CACHE_WARMUP_TIMEOUT_SEC = float(os.getenv("SIIBRA_API_CACHE_WARMUP_TIMEOUT_SEC", 5 * 60))
+"""CACHE_WARMUP_TIMEOUT_SEC. No further requests are issued after this many seconds of warming the response cache on startup."""
+
+BATCH_MAX_REQUESTS = int(os.getenv("SIIBRA_API_BATCH_MAX_REQUESTS", 100))
+"""BATCH_MAX_REQUESTS. Maximum number of sub-requests of a batch request (`POST /batch`)."""
+
+BATCH_CONCURRENCY = int(os.getenv("SIIBRA_API_BATCH_CONCURRENCY", 16))
+"""BATCH_CONCURRENCY. Maximum number of concurrent sub-requests, which are not served from the response cache, per batch request."""
+
+ADMIN_TOKEN = os.getenv("SIIBRA_API_ADMIN_TOKEN")
+"""ADMIN_TOKEN. Bearer token authorizing requests to the admin endpoints (`/admin`). If not set, admin endpoints are disabled."""
+
 QUEUE_PREFIX = f"{__version__}.{NAME_SPACE}"
 """QUEUE_PREFIX"""
 
@@ -73,6 +182,19 @@ _queues = [
     # "vocabularies",
 ]
 
+# see new_api.common.lane_router.LANES
+_lanes = [
+    "critical",
+    "fast",
+    "medium",
+    "slow",
+]
+
+_task_routes = {
+    f'api.common.data_handlers.{_queue}.*': f'{QUEUE_PREFIX}.{_queue}'
+    for _queue in _queues
+}
+
 class CELERY_CONFIG:
     """CELERY_CONFIG"""
     broker_url=os.getenv("SIIBRA_API_CELERY_BROKER", f"redis://{(':' + REDIS_PASSWORD + '@') if REDIS_PASSWORD else ''}{REDIS_HOST}:{REDIS_PORT}")
@@ -92,10 +214,11 @@ class CELERY_CONFIG:
     include=['api.common.data_handlers', 'api.serialization']
 
     # source of truth on all queues
-    task_routes={
-        f'api.common.data_handlers.{_queue}.*': f'{QUEUE_PREFIX}.{_queue}'
-        for _queue in _queues
-    }
+    # if TASK_LANES is set, tasks are routed into the lanes of their queue (see api.common.lanes.route_task)
+    task_routes=(
+        'api.common.lanes.route_task',
+        _task_routes,
+    )
 
     # define task_queues explicitly, so that if -Q is not defined, the worker
     # will pick up all tasks
@@ -103,8 +226,13 @@ class CELERY_CONFIG:
         'celery': {}, # default queue
         **{
             route: {}
-            for route in task_routes.values()
-        }
+            for route in _task_routes.values()
+        },
+        **{
+            f'{route}-{lane}': {}
+            for route in _task_routes.values()
+            for lane in (_lanes if TASK_LANES else [])
+        },
     }
 
 LOGGER_DIR = os.environ.get("SIIBRA_API_LOG_DIR")
@@ -115,6 +243,15 @@ IS_CI = os.getenv("CI") is not None
 import tempfile
 SIIBRA_API_SHARED_DIR = os.getenv("SIIBRA_API_SHARED_DIR") or os.getenv("SIIBRA_CACHEDIR") or tempfile.gettempdir()
 
+CACHE_SPILL_BYTES = int(os.getenv("SIIBRA_API_CACHE_SPILL_BYTES", 1024 * 1024))
+"""CACHE_SPILL_BYTES. Cached responses larger than this (gzip compressed) are written to CACHE_SPILL_DIR, with only a pointer held in redis. Set to 0 to disable."""
+
+CACHE_SPILL_DIR = os.getenv("SIIBRA_API_CACHE_SPILL_DIR") or os.path.join(SIIBRA_API_SHARED_DIR, "response-cache")
+"""CACHE_SPILL_DIR. Directory of spilled cached responses. Must be shared by all servers using the same redis."""
+
+CACHE_SPILL_MAX_AGE_SEC = float(os.getenv("SIIBRA_API_CACHE_SPILL_MAX_AGE_SEC", 9 * 24 * 60 * 60))
+"""CACHE_SPILL_MAX_AGE_SEC. Spilled cached responses not written for longer than this are deleted. Should exceed the longest time to live (including stale window) of cached responses."""
+
 import re
 
 SIIBRA_API_REMAP_PROVIDERS: Dict[str, str] = {}
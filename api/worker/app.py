@@ -6,5 +6,9 @@ if ROLE == "worker" or ROLE == "server":
     from celery import Celery
     app = Celery(CELERY_CHANNEL)
     app.config_from_object(CELERY_CONFIG)
+
+    if ROLE == "worker":
+        from api.common.lanes import record_durations
+        record_durations(app)
 else:
     raise RuntimeError(f"worker.app should not be initialized, as ROLE is not set as worker, but as: '{ROLE}'")
@@ -0,0 +1,211 @@
+"""Cost aware routing of celery tasks into lanes.
+
+Workers record the duration of each task (i.e. data handler) as an exponentially weighted moving average, in the
+result backend. If lanes are enabled, the server routes each task into a lane of its queue, by the recorded duration
+of its data handler: `fast`, `medium` or `slow`. Data handlers pinned by operators are routed into the `critical` lane.
+
+Each lane is a queue of its own (e.g. `{QUEUE_PREFIX}.volumes-slow`), so that slow tasks never queue ahead of fast
+ones, and workers can be dedicated to lanes (e.g. `-Q {QUEUE_PREFIX}.core-critical`).
+
+This module takes its configuration as parameters (see `make_router`). `api.common.lanes` and `new_api.common.lanes`
+bind it to the config of their package, i.e. their own queues and recorded durations.
+"""
+
+from collections import defaultdict
+from logging import Logger
+from typing import Dict, List, Optional
+import threading
+import time
+
+LANES = ("critical", "fast", "medium", "slow")
+"""Lanes, most critical first"""
+
+UNKNOWN_LANE = "medium"
+"""Lane of data handlers, whose duration is not (yet) recorded"""
+
+EWMA_ALPHA = 0.2
+"""Weight of the latest duration in the moving average"""
+
+DURATIONS_REFRESH_SEC = 60
+"""Interval of reading the recorded durations, when routing"""
+
+def get_durations_key(queue_prefix: str) -> str:
+    """Get the key of the hash holding task name -> average duration (seconds), in the result backend"""
+    return f"siibra-api-task-durations-{queue_prefix}"
+
+def get_lane_queue(queue: str, lane: str) -> str:
+    """Get the queue of a lane of queue, e.g. `{QUEUE_PREFIX}.volumes-slow`"""
+    return f"{queue}-{lane}"
+
+def classify(task_name: str, durations: Dict[str, float], critical: List[str], fast_sec: float, slow_sec: float) -> str:
+    """Classify a task into a lane.
+
+    Args:
+        task_name: name of the celery task, e.g. `api.common.data_handlers.core.region.all_regions`
+        durations: task name -> average duration (seconds)
+        critical: data handlers pinned to the critical lane, by name or by task name
+        fast_sec: durations below are fast
+        slow_sec: durations at or above are slow
+
+    Returns:
+        lane, one of `LANES`"""
+    if task_name in critical or task_name.rsplit(".", 1)[-1] in critical:
+        return "critical"
+    duration = durations.get(task_name)
+    if duration is None:
+        return UNKNOWN_LANE
+    if duration < fast_sec:
+        return "fast"
+    if duration >= slow_sec:
+        return "slow"
+    return "medium"
+
+def is_redis_url(url) -> bool:
+    """Whether url (e.g. of the result backend) is a redis url"""
+    return isinstance(url, str) and url.startswith(("redis://", "rediss://"))
+
+# update the moving average of a task atomically, as it is updated by all workers
+_update_average_script = """
+local duration = tonumber(ARGV[2])
+local average = tonumber(redis.call("hget", KEYS[1], ARGV[1]))
+if average then
+    duration = average + tonumber(ARGV[3]) * (duration - average)
+end
+redis.call("hset", KEYS[1], ARGV[1], tostring(duration))
+return tostring(duration)
+"""
+
+class _Durations:
+    """Recorded durations, as read from the result backend (at most every `DURATIONS_REFRESH_SEC` seconds).
+
+    The router runs on the event loop of the server (see `api.common.decorators.async_router_decorator`), so the
+    durations are read in a background thread, and tasks are routed by the last read meanwhile."""
+
+    def __init__(self, key: str, redis_timeout: float, logger: Logger):
+        self.key = key
+        self.redis_timeout = redis_timeout
+        self.logger = logger
+        self.durations: Dict[str, float] = {}
+        self._client = None
+        self._read_at = None
+        self._reading = False
+
+    def get(self, url: str) -> Dict[str, float]:
+        if not is_redis_url(url) or self._reading:
+            return self.durations
+        if self._read_at is not None and time.monotonic() - self._read_at < DURATIONS_REFRESH_SEC:
+            return self.durations
+        # also on failure, so as not to retry on every task
+        self._read_at = time.monotonic()
+        self._reading = True
+        threading.Thread(target=self._read, args=(url,), name="task-durations", daemon=True).start()
+        return self.durations
+
+    def _read(self, url: str):
+        try:
+            if self._client is None:
+                import redis
+                self._client = redis.Redis.from_url(url, socket_timeout=self.redis_timeout, socket_connect_timeout=self.redis_timeout)
+            self.durations = {
+                name.decode("utf-8"): float(duration)
+                for name, duration in self._client.hgetall(self.key).items()
+            }
+        except Exception as e:
+            self.logger.warning(f"Cannot read task durations, routing by the last read: {str(e)}")
+        finally:
+            self._reading = False
+
+class LaneRouter:
+    """Router of the tasks of a package into lanes, and recorder of their durations. See `make_router`."""
+
+    def __init__(self, queue_prefix: str, lanes_enabled: bool, critical: List[str], fast_sec: float, slow_sec: float, redis_timeout: float, logger: Logger):
+        self.lanes_enabled = lanes_enabled
+        self.critical = critical
+        self.fast_sec = fast_sec
+        self.slow_sec = slow_sec
+        self.redis_timeout = redis_timeout
+        self.logger = logger
+        self.durations_key = get_durations_key(queue_prefix)
+        self.lane_counters: Dict[str, int] = defaultdict(int)
+        """lane -> number of tasks routed into it"""
+        self.lane_counter = None
+        """counter labelled by lane (e.g. a prometheus_client `Counter`), incremented per routed task. Set by the server, to export it"""
+        self._durations = _Durations(self.durations_key, redis_timeout, logger)
+        self._map_routes = {}
+
+    def _get_queue(self, app, task_name: str) -> Optional[str]:
+        """Get the queue of a task, by the (mapping) task_routes of app"""
+        from celery.app.routes import MapRoute
+        # keyed by app, as the apps of api and new_api may share their name (see `CELERY_CHANNEL`)
+        if id(app) not in self._map_routes:
+            self._map_routes[id(app)] = [MapRoute(route) for route in app.conf.task_routes if isinstance(route, dict)]
+        for map_route in self._map_routes[id(app)]:
+            route = map_route(task_name)
+            if route:
+                return route.get("queue")
+        return None
+
+    def route_task(self, name, args, kwargs, options, task=None, **kw):
+        """Celery router (see `task_routes`), routing tasks into the lane of their queue, if lanes are enabled.
+
+        Returns:
+            route, or None to fall through to the next router"""
+        if not self.lanes_enabled or task is None or options.get("queue"):
+            return None
+        queue = self._get_queue(task.app, name)
+        if queue is None:
+            return None
+        lane = classify(name, self._durations.get(task.app.conf.result_backend), self.critical, self.fast_sec, self.slow_sec)
+        self.lane_counters[lane] += 1
+        if self.lane_counter is not None:
+            self.lane_counter.labels(lane).inc()
+        return {"queue": get_lane_queue(queue, lane)}
+
+    def record_durations(self, app):
+        """Record the duration of the (successful) tasks run by this worker, as moving average shared by all workers (see `durations_key`).
+
+        Args:
+            app: celery app of the worker"""
+        from celery import states
+        from celery.signals import task_prerun, task_postrun
+        started: Dict[str, float] = {}
+        clients = []
+
+        def on_prerun(task_id=None, task=None, **kwargs):
+            started[task_id] = time.monotonic()
+
+        def on_postrun(task_id=None, task=None, state=None, **kwargs):
+            start = started.pop(task_id, None)
+            # failed (e.g. invalid arguments) or revoked tasks do not tell the cost of their data handler
+            if start is None or task is None or state != states.SUCCESS:
+                return
+            duration = time.monotonic() - start
+            try:
+                if not clients:
+                    import redis
+                    clients.append(redis.Redis.from_url(app.conf.result_backend, socket_timeout=self.redis_timeout, socket_connect_timeout=self.redis_timeout))
+                clients[0].eval(_update_average_script, 1, self.durations_key, task.name, duration, EWMA_ALPHA)
+            except Exception as e:
+                self.logger.warning(f"Cannot record duration of {task.name}: {str(e)}")
+
+        if not is_redis_url(app.conf.result_backend):
+            return
+
+        task_prerun.connect(on_prerun, weak=False)
+        task_postrun.connect(on_postrun, weak=False)
+
+def make_router(queue_prefix: str, lanes_enabled: bool, critical: List[str], fast_sec: float, slow_sec: float, redis_timeout: float, logger: Logger) -> LaneRouter:
+    """Make the lane router of a package.
+
+    Args:
+        queue_prefix: prefix of the queues of the package, also keying its recorded durations (see `get_durations_key`)
+        lanes_enabled: route tasks into lanes (see `TASK_LANES`). Durations are recorded regardless.
+        critical: data handlers pinned to the critical lane, by name or by task name
+        fast_sec: data handlers taking (on average) less than this many seconds are routed into the fast lane
+        slow_sec: data handlers taking (on average) at least this many seconds are routed into the slow lane
+        redis_timeout: timeout (seconds) of reading and recording durations, in the result backend
+        logger: logger of the package
+
+    Returns:
+        router"""
+    return LaneRouter(queue_prefix, lanes_enabled, critical, fast_sec, slow_sec, redis_timeout, logger)
@@ -0,0 +1,15 @@
+"""Lanes of the tasks of `new_api`, with their own queues and recorded durations. See `new_api.common.lane_router`."""
+
+from .logger import logger
+from .lane_router import LANES, make_router
+from new_api.siibra_api_config import (
+    QUEUE_PREFIX, REDIS_TIMEOUT_SEC, TASK_LANES, TASK_LANE_FAST_SEC, TASK_LANE_SLOW_SEC, TASK_LANE_CRITICAL,
+)
+
+router = make_router(QUEUE_PREFIX, TASK_LANES, TASK_LANE_CRITICAL, TASK_LANE_FAST_SEC, TASK_LANE_SLOW_SEC, REDIS_TIMEOUT_SEC, logger)
+"""Lane router of `new_api`"""
+
+route_task = router.route_task
+record_durations = router.record_durations
+lane_counters = router.lane_counters
+DURATIONS_KEY = router.durations_key
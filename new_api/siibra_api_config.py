@@ -72,6 +72,33 @@ _queues = [
     "compounds",
 ]
 
+TASK_LANES = os.getenv("SIIBRA_API_TASK_LANES", "0") != "0"
+"""TASK_LANES. See `api.siibra_api_config.TASK_LANES`"""
+
+TASK_LANE_FAST_SEC = float(os.getenv("SIIBRA_API_TASK_LANE_FAST_SEC", 0.1))
+"""TASK_LANE_FAST_SEC. See `api.siibra_api_config.TASK_LANE_FAST_SEC`"""
+
+TASK_LANE_SLOW_SEC = float(os.getenv("SIIBRA_API_TASK_LANE_SLOW_SEC", 5))
+"""TASK_LANE_SLOW_SEC. See `api.siibra_api_config.TASK_LANE_SLOW_SEC`"""
+
+TASK_LANE_CRITICAL = [name.strip() for name in os.getenv("SIIBRA_API_TASK_LANE_CRITICAL", "all_regions,single_region").split(",") if name.strip()]
+"""TASK_LANE_CRITICAL. See `api.siibra_api_config.TASK_LANE_CRITICAL`"""
+
+REDIS_TIMEOUT_SEC = float(os.getenv("SIIBRA_API_REDIS_TIMEOUT_SEC", 2))
+"""REDIS_TIMEOUT_SEC. See `api.siibra_api_config.REDIS_TIMEOUT_SEC`"""
+
+# see new_api.common.lane_router.LANES
+_lanes = [
+    "critical",
+    "fast",
+    "medium",
+    "slow",
+]
+
+_task_routes = {
+    f'new_api.*': f'{QUEUE_PREFIX}.v3'
+}
+
 class CELERY_CONFIG:
     """CELERY_CONFIG"""
     broker_url=os.getenv("SIIBRA_API_CELERY_BROKER", f"redis://{(':' + REDIS_PASSWORD + '@') if REDIS_PASSWORD else ''}{REDIS_HOST}:{REDIS_PORT}")
@@ -91,9 +118,11 @@ class CELERY_CONFIG:
     include=['new_api.data_handlers', 'new_api.v3.serialization']
 
     # source of truth on all queues
-    task_routes={
-        f'new_api.*': f'{QUEUE_PREFIX}.v3'
-    }
+    # if TASK_LANES is set, tasks are routed into the lanes of their queue (see new_api.common.lanes.route_task)
+    task_routes=(
+        'new_api.common.lanes.route_task',
+        _task_routes,
+    )
 
     # define task_queues explicitly, so that if -Q is not defined, the worker
     # will pick up all tasks
@@ -101,8 +130,13 @@ class CELERY_CONFIG:
         'celery': {}, # default queue
         **{
             route: {}
-            for route in task_routes.values()
-        }
+            for route in _task_routes.values()
+        },
+        **{
+            f'{route}-{lane}': {}
+            for route in _task_routes.values()
+            for lane in (_lanes if TASK_LANES else [])
+        },
     }
 
 LOGGER_DIR = os.environ.get("SIIBRA_API_LOG_DIR")
@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+import threading
+from types import SimpleNamespace
+
+import pytest
+from api.common.decorators import async_router_decorator, router_decorator
+from api.common.exceptions import FaultyRoleException
+from api.common.results import DispatchLimiter, dispatch_limiter
+
+app = SimpleNamespace(conf=SimpleNamespace(result_backend="rpc://"))
+
+class FakeTask:
+    """Task completing immediately, awaited by polling (the result backend is not redis)"""
+    name = "sum"
+    app = app
+
+    def __init__(self):
+        self.calls = []
+        self.threads = set()
+    def apply_async(self, args, kwargs):
+        self.calls.append((list(args), kwargs))
+        self.threads.add(threading.get_ident())
+        return SimpleNamespace(id="task", app=app, status="SUCCESS", get=lambda: sum(args))
+
+def test_async_router_decorator_server():
+    task = FakeTask()
+    dispatched = dispatch_limiter.counters["dispatched"]
+
+    @async_router_decorator("server", func=task)
+    async def get_sum_paginated(a: int, b: int, *, func):
+        return [await func(a, b)]
+
+    assert list(inspect.signature(get_sum_paginated).parameters) == ["a", "b", "func"]
+    assert asyncio.run(get_sum_paginated(1, 2)) == [3]
+    assert task.calls == [([1, 2], {})]
+    # dispatched from the event loop, not from a worker thread
+    assert task.threads == {threading.get_ident()}
+    assert dispatch_limiter.counters["dispatched"] == dispatched + 1
+
+def test_async_router_decorator_all():
+    threads = set()
+    def data_handler(a: int, b: int):
+        threads.add(threading.get_ident())
+        return a + b
+
+    @async_router_decorator("all", func=data_handler)
+    async def get_sum(a: int, b: int, *, func):
+        return await func(a, b)
+
+    assert asyncio.run(get_sum(1, 2)) == 3
+    # computed in a worker thread, not blocking the event loop
+    assert threading.get_ident() not in threads
+
+def test_router_decorator_server():
+    task = FakeTask()
+
+    # sync route handlers would block a worker thread, whilst awaiting the task
+    with pytest.raises(FaultyRoleException):
+        @router_decorator("server", func=task)
+        def get_sum_sync(a: int, b: int, *, func):
+            return func(a, b)
+
+    @router_decorator("server", func=task, queue_as_async=True)
+    def queue_sum(a: int, b: int, *, func):
+        return func(a, b)
+
+    assert queue_sum(1, 2) == "task"
+    assert task.calls == [([1, 2], {})]
+
+def test_dispatch_limiter():
+    limiter = DispatchLimiter(1)
+    in_flight = []
+
+    async def run(fail: bool):
+        async with limiter.slot():
+            in_flight.append(limiter.in_flight)
+            await asyncio.sleep(0.01)
+            if fail:
+                raise ValueError
+
+    async def main():
+        return await asyncio.gather(run(False), run(True), run(False), return_exceptions=True)
+
+    asyncio.run(main())
+    assert in_flight == [1, 1, 1]
+    assert (limiter.in_flight, limiter.waiting) == (0, 0)
+    assert dict(limiter.counters) == {"dispatched": 3, "queued": 2, "succeeded": 2, "failed": 1}
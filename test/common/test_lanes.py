@@ -0,0 +1,99 @@
+import pytest
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+import logging
+
+from api.common.lanes import LANES, DURATIONS_KEY, router
+from api.siibra_api_config import _lanes
+from new_api.common.lane_router import classify, make_router, _Durations
+from new_api.common import lanes as new_api_lanes
+
+logger = logging.getLogger(__name__)
+
+durations = {
+    "api.common.data_handlers.core.space.all_spaces": 0.02,
+    "api.common.data_handlers.core.region.all_regions": 8.,
+    "api.common.data_handlers.features.types.all_features": 1.,
+    "api.common.data_handlers.volumes.parcellationmap.get_parcellation_labelled_map": 30.,
+}
+
+def test_lanes():
+    assert tuple(_lanes) == LANES
+
+@pytest.mark.parametrize("task_name,lane", [
+    ("api.common.data_handlers.core.space.all_spaces", "fast"),
+    ("api.common.data_handlers.features.types.all_features", "medium"),
+    ("api.common.data_handlers.volumes.parcellationmap.get_parcellation_labelled_map", "slow"),
+    # pinned, regardless of duration
+    ("api.common.data_handlers.core.region.all_regions", "critical"),
+    ("api.common.data_handlers.core.region.single_region", "critical"),
+    # not yet recorded
+    ("api.common.data_handlers.core.atlas.all_atlases", "medium"),
+])
+def test_classify(task_name, lane):
+    assert classify(task_name, durations, ["all_regions", "single_region"], 0.1, 5) == lane
+
+def test_route_task():
+    app = SimpleNamespace(conf=SimpleNamespace(
+        result_backend="rpc://",
+        task_routes=("api.common.lanes.route_task", {"api.common.data_handlers.core.*": "prefix.core"}),
+    ))
+    task = SimpleNamespace(app=app)
+    name = "api.common.data_handlers.core.atlas.all_atlases"
+
+    disabled = make_router("prefix", False, [], 0.1, 5, 1, logger)
+    assert disabled.route_task(name, [], {}, {}, task=task) is None
+
+    enabled = make_router("prefix", True, [], 0.1, 5, 1, logger)
+    assert enabled.route_task(name, [], {}, {}, task=task) == {"queue": "prefix.core-medium"}
+    assert enabled.lane_counters == {"medium": 1}
+    # explicit queue, or not routed
+    assert enabled.route_task(name, [], {}, {"queue": "other"}, task=task) is None
+    assert enabled.route_task("api.serialization.foo", [], {}, {}, task=task) is None
+
+def test_packages_bound():
+    """api and new_api route by their own config"""
+    assert router is not new_api_lanes.router
+    assert new_api_lanes.route_task == new_api_lanes.router.route_task
+
+def test_durations_read_in_background():
+    reading = threading.Event()
+    client = SimpleNamespace(hgetall=lambda key: reading.wait(5) and {b"task": b"0.5"})
+    durations = _Durations("key", 1, logger)
+    durations._client = client
+
+    # routed by the last read (none yet), whilst reading
+    assert durations.get("redis://localhost:6379") == {}
+    assert durations.get("redis://localhost:6379") == {}
+    reading.set()
+    for thread in threading.enumerate():
+        if thread.name == "task-durations":
+            thread.join(5)
+    assert durations.durations == {"task": 0.5}
+
+def test_record_durations():
+    from celery.signals import task_prerun, task_postrun
+    calls = []
+    client = SimpleNamespace(eval=lambda *args: calls.append(args))
+    app = SimpleNamespace(conf=SimpleNamespace(result_backend="redis://localhost:6379"))
+    class Task:
+        name = "lanes-test-task"
+    task = Task()
+
+    with patch("redis.Redis.from_url", return_value=client):
+        router.record_durations(app)
+        for task_id, state in (("succeeded", "SUCCESS"), ("failed", "FAILURE")):
+            task_prerun.send(sender=task, task_id=task_id, task=task)
+            task_postrun.send(sender=task, task_id=task_id, task=task, state=state)
+
+    # one atomic update, of succeeded tasks only
+    assert len(calls) == 1
+    assert calls[0][1:4] == (1, DURATIONS_KEY, "lanes-test-task")
+
+def test_new_api_lanes_independent():
+    """new_api (e.g. its worker) does not import api"""
+    code = "import sys, new_api.common.lanes; sys.exit(any(name == 'api' or name.startswith('api.') for name in sys.modules))"
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0
@@ -0,0 +1,203 @@
+import pytest
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+from celery import Celery
+
+from api.common.results import ResultListener, get_inflight_key, _extend_script
+from api.common.decorators import dispatch_task
+
+backend = Celery("test", backend="redis://localhost:6379").backend
+
+class DictPubSub:
+    def __init__(self, r: "DictRedis"):
+        self.r = r
+        self.channels = set()
+        self.messages = asyncio.Queue()
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+    async def reset(self):
+        self.channels.clear()
+
+class DictRedis:
+    def __init__(self):
+        self.store = {}
+        self.pttls = {}
+        self.pubsubs = []
+    def pubsub(self, **kwargs):
+        pubsub = DictPubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+    async def get(self, key):
+        return self.store.get(key)
+    async def set(self, key, value, nx=False, px=None):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value.encode("utf-8")
+        self.pttls[key] = px
+        return True
+    async def eval(self, script, numkeys, key, token, *args):
+        if self.store.get(key) != token.encode("utf-8"):
+            return 0
+        if script == _extend_script:
+            # compare and expire
+            self.pttls[key] = args[0]
+            return 1
+        # compare and delete
+        self.store.pop(key)
+        return 1
+    def store_published(self, key, value, publish=True):
+        # as stored by the redis result backend, see `RedisBackend._set`
+        self.store[key] = value
+        if publish:
+            for pubsub in self.pubsubs:
+                if key in pubsub.channels:
+                    pubsub.messages.put_nowait({"type": "message", "channel": key, "data": value})
+
+def store_result(r: DictRedis, task_id: str, status: str, result, publish=True):
+    if isinstance(result, Exception):
+        result = backend.prepare_exception(result)
+    payload = backend.encode({"status": status, "result": result, "task_id": task_id, "traceback": None, "children": []})
+    r.store_published(backend.get_key_for_task(task_id), payload, publish=publish)
+
+@pytest.fixture
+def listener():
+    async def create():
+        listener = ResultListener(backend, "redis://localhost:6379")
+        r = DictRedis()
+        listener._client = r
+        listener._pubsub = r.pubsub()
+        return listener
+    return create
+
+def run_waiting(listener, task_id, complete, timeout=5):
+    """Wait for task_id, whilst completing it"""
+    async def run():
+        _listener = await listener()
+        waiting = asyncio.create_task(_listener.wait(task_id, timeout))
+        await asyncio.sleep(0.01)
+        complete(_listener._client)
+        meta = await waiting
+        assert not _listener._pubsub.channels
+        _listener._listener.cancel()
+        return meta
+    return asyncio.run(run())
+
+def test_notified(listener):
+    def complete(r):
+        store_result(r, "task", "STARTED", None)
+        store_result(r, "task", "SUCCESS", {"foo": "bar"})
+    meta = run_waiting(listener, "task", complete)
+    assert (meta["status"], meta["result"]) == ("SUCCESS", {"foo": "bar"})
+
+def test_failure(listener):
+    meta = run_waiting(listener, "task", lambda r: store_result(r, "task", "FAILURE", ValueError("invalid")))
+    assert meta["status"] == "FAILURE"
+    assert isinstance(meta["result"], ValueError)
+
+def test_completed_before_subscribing(listener):
+    async def run():
+        _listener = await listener()
+        store_result(_listener._client, "task", "SUCCESS", 1)
+        return await _listener.wait("task", 5)
+    assert asyncio.run(run())["result"] == 1
+
+def test_missed_notification(listener):
+    with patch("api.common.results.RESULT_RECHECK_SEC", 0.05):
+        meta = run_waiting(listener, "task", lambda r: store_result(r, "task", "SUCCESS", 1, publish=False))
+    assert meta["result"] == 1
+
+def test_timeout(listener):
+    with patch("api.common.results.RESULT_RECHECK_SEC", 0.05):
+        with pytest.raises(TimeoutError):
+            run_waiting(listener, "task", lambda r: store_result(r, "task", "STARTED", None), timeout=0.2)
+
+def test_claim(listener):
+    async def run():
+        _listener = await listener()
+        key = get_inflight_key("task", [1], {"foo": "bar"})
+        assert key == get_inflight_key("task", (1,), {"foo": "bar"})
+        assert key != get_inflight_key("task", [2], {"foo": "bar"})
+
+        assert await _listener.claim(key, "first", 60) is None
+        assert await _listener.claim(key, "second", 60) == "first"
+        await _listener.release(key, "second")
+        assert await _listener.claim(key, "third", 60) == "first"
+        await _listener.release(key, "first")
+        assert await _listener.claim(key, "third", 60) is None
+
+        assert not await _listener.extend(key, "first", 600)
+        assert await _listener.extend(key, "third", 600)
+        assert _listener._client.pttls[key] == 600000
+        assert await _listener.get_claim(key) == "third"
+    asyncio.run(run())
+
+def test_dispatch_deduplicated(listener):
+    async def run():
+        _listener = await listener()
+        r = _listener._client
+        dispatched = []
+
+        def complete(task_id):
+            store_result(r, task_id, "SUCCESS", len(dispatched))
+
+        def apply_async(args, kwargs, task_id=None):
+            dispatched.append(task_id)
+            asyncio.get_running_loop().call_later(0.05, complete, task_id)
+            return SimpleNamespace(id=task_id, app=task.app)
+
+        task = SimpleNamespace(name="task", app=None, apply_async=apply_async)
+        task.AsyncResult = lambda task_id: SimpleNamespace(id=task_id, app=task.app)
+
+        with patch("api.common.results.get_listener", lambda app: _listener):
+            # attached callers are notified, too (rather than rechecking)
+            results = await asyncio.wait_for(asyncio.gather(*[dispatch_task(task, [1], {}) for _ in range(3)]), 2)
+            assert results == [1, 1, 1]
+            assert len(dispatched) == 1
+            # released once completed
+            assert get_inflight_key("task", [1], {}) not in r.store
+
+            await dispatch_task(task, [1], {})
+            assert len(dispatched) == 2
+        _listener._listener.cancel()
+    asyncio.run(run())
+
+def test_dispatch_claim(listener):
+    async def run():
+        _listener = await listener()
+        r = _listener._client
+        key = get_inflight_key("task", [1], {})
+        dispatched = []
+        revoked = []
+
+        def apply_async(args, kwargs, task_id=None):
+            dispatched.append(task_id)
+            # claimed with a short ttl, extended once dispatched
+            assert r.pttls[key] == 100
+            asyncio.get_running_loop().call_later(0.05, store_result, r, task_id, "SUCCESS", 1)
+            return SimpleNamespace(id=task_id, app=task.app)
+
+        task = SimpleNamespace(name="task", app=None, apply_async=apply_async)
+        task.AsyncResult = lambda task_id: SimpleNamespace(id=task_id, app=task.app, revoke=lambda: revoked.append(task_id))
+
+        with patch("api.common.results.get_listener", lambda app: _listener), \
+                patch("api.common.decorators.TASK_CLAIM_SEC", 0.1):
+            # claimant died before dispatching: its claim expires, attached callers dispatch anew
+            await _listener.claim(key, "dead", 0.1)
+            async def expire():
+                await asyncio.sleep(0.05)
+                r.store.pop(key)
+            asyncio.create_task(expire())
+            assert await asyncio.wait_for(dispatch_task(task, [1], {}), 2) == 1
+            assert len(dispatched) == 1
+            # attached callers never revoke
+            assert revoked == []
+        _listener._listener.cancel()
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+import pytest
+import asyncio
+import json
+from unittest.mock import patch
+
+from api.server.cache.codec import (
+    GzipCodec, ZstdCodec, CodecError, GZIP_MAGIC, ZSTD_MAGIC,
+    gzip_codec, get_codec, select_codec, compress, decompress, sample_redis,
+)
+from api.server.cache.redis import CacheGzipRedis
+from test.server.cache.test_redis import DictRedis
+from api.siibra_api_config import CACHE_ZSTD_MAX_BYTES
+
+run = asyncio.run
+
+samples = [
+    json.dumps({
+        "@id": f"https://openminds.ebrains.eu/instances/parcellationEntityVersion/{i}",
+        "@type": "https://openminds.ebrains.eu/sands/ParcellationEntityVersion",
+        "name": f"Area {i}",
+    }).encode("utf-8")
+    for i in range(200)
+]
+
+def test_gzip():
+    codec = GzipCodec()
+    compressed = codec.compress(samples[0], level=codec.level(len(samples[0])))
+    assert compressed.startswith(GZIP_MAGIC)
+    assert get_codec(compressed) is gzip_codec
+    assert codec.decompress(compressed) == samples[0]
+
+def test_zstd_dictionary():
+    zstandard = pytest.importorskip("zstandard")
+    dictionary = zstandard.train_dictionary(1024, samples)
+    codec = ZstdCodec(dictionary.as_bytes())
+    compressed = codec.compress(samples[0], level=codec.level(len(samples[0])))
+    assert compressed.startswith(ZSTD_MAGIC)
+    assert codec.decompress(compressed) == samples[0]
+
+    # frames compressed with a dictionary, or without, coexist
+    assert codec.decompress(ZstdCodec().compress(samples[0], level=3)) == samples[0]
+
+    with pytest.raises(CodecError):
+        ZstdCodec().decompress(compressed)
+
+@pytest.mark.parametrize("size", [10, CACHE_ZSTD_MAX_BYTES + 1])
+def test_select_codec(size):
+    value = b"x" * size
+    codec = select_codec(size)
+    if size > CACHE_ZSTD_MAX_BYTES:
+        assert codec is gzip_codec
+    compressed = run(compress(value))
+    assert get_codec(compressed) is codec
+    assert run(decompress(compressed)) == value
+
+def test_unknown_codec():
+    with pytest.raises(CodecError):
+        run(decompress(b'{"foo": "bar"}'))
+
+def test_sample_redis():
+    r = DictRedis()
+    store = CacheGzipRedis()
+    task_meta = b'{"status": "SUCCESS", "result": 1}'
+    r.store.update({
+        "[abc] /v3_0/spaces": gzip_codec.compress(samples[0], level=6),
+        "[meta] [abc] /v3_0/spaces": b"{}",
+        "celery-task-meta-foo": task_meta,
+        "_kombu.binding.celery": {b"foo"},
+    })
+    async def noop():
+        pass
+    with patch.object(CacheGzipRedis, "_r", r), patch("api.server.cache.get_redis_nodes", lambda: [store]), patch("api.server.cache.on_startup"), patch("api.server.cache.terminate", noop):
+        assert run(sample_redis(10)) == [samples[0]]
+    # keys of celery are neither read, nor rewritten
+    assert r.store["celery-task-meta-foo"] == task_meta
@@ -0,0 +1,21 @@
+import pytest
+
+from api.server.cache.etag import compute_etag, etag_header, etag_matches
+
+etag = compute_etag(b'{"foo": "bar"}')
+
+def test_compute_etag():
+    assert compute_etag('{"foo": "bar"}') == etag
+    assert compute_etag(b'{"foo": "baz"}') != etag
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    (None, False),
+    ('"other"', False),
+    (etag_header(etag), True),
+    (etag_header(etag, compressed=True), True),
+    (f'W/{etag_header(etag)}', True),
+    (f'"other", {etag_header(etag)}', True),
+])
+def test_etag_matches(if_none_match, matches):
+    assert etag_matches(if_none_match, etag) == matches
+    assert etag_matches(if_none_match, etag_header(etag, compressed=True)) == matches
@@ -0,0 +1,43 @@
+import pytest
+from unittest.mock import patch
+
+from api.server.cache.fingerprint import get_handler_fingerprint, get_global_inputs, diff_manifests, _code, _module_dependencies
+
+def handler(atlas_id: str):
+    return atlas_id
+
+def other_handler(atlas_id: str):
+    return atlas_id.upper()
+
+def test_handler_fingerprint():
+    assert get_handler_fingerprint(handler) == get_handler_fingerprint(handler)
+    assert get_handler_fingerprint(handler) != get_handler_fingerprint(other_handler)
+    assert get_handler_fingerprint(handler) != get_handler_fingerprint(handler, other_handler)
+
+@pytest.mark.parametrize("name", ["siibra", "configuration", "serialization", "format", "salt"])
+def test_global_inputs(name):
+    fingerprint = get_handler_fingerprint(handler)
+    with patch.dict(get_global_inputs(), {name: "changed"}):
+        get_handler_fingerprint.cache_clear()
+        assert get_handler_fingerprint(handler) != fingerprint
+    get_handler_fingerprint.cache_clear()
+
+def test_code():
+    source = 'def foo(a):\n    """doc"""\n    return a\n'
+    # docstrings, comments and formatting are not part of the fingerprint
+    assert _code(source) == _code('def foo(a):\n    # comment\n    return (a)\n')
+    assert _code(source) != _code('def foo(a):\n    return a + 1\n')
+
+def test_module_dependencies():
+    """helpers of data handlers, imported from other modules, are part of the fingerprint"""
+    import new_api.data_handlers.maps
+    assert _module_dependencies("new_api.data_handlers.maps") == ["new_api.data_handlers.data"]
+
+def test_diff_manifests():
+    old = {"GET /a": "1", "GET /b": "2", "GET /c": "3"}
+    new = {"GET /a": "1", "GET /b": "4", "GET /d": "5"}
+    assert diff_manifests(old, new) == [
+        ("changed", "GET /b"),
+        ("removed", "GET /c"),
+        ("added", "GET /d"),
+    ]
@@ -0,0 +1,79 @@
+import pytest
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+from api.siibra_api_config import __version__
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.meta import CacheMeta
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.introspect import get_key_group, sample_keys, summarize, purge_prefix, escape_glob
+from test.server.cache.test_redis import DictRedis
+
+run = asyncio.run
+
+routes = {"abc": "GET /v3_0/parcellations/{parcellation_id:lazy_path}"}
+
+@pytest.mark.parametrize("key, group", [
+    ("[abc] /v3_0/parcellations/foo", routes["abc"]),
+    ("[def] /v3_0/parcellations/foo", "[def] (unknown route)"),
+    (f"[{__version__}] /v3_0/nonexistent", f"[{__version__}] (unmatched)"),
+    ("[abc] [unpaginated] get_all_regions[[\"foo\"], {}]", "[unpaginated] get_all_regions"),
+    ("[meta] [abc] /v3_0/parcellations/foo", "[meta]"),
+    ("[tag] parcellation:foo", "[tag]"),
+    ("foo", "(other)"),
+])
+def test_get_key_group(key, group):
+    assert get_key_group(key, routes) == group
+
+@pytest.fixture
+def cache():
+    _r = DictRedis()
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), patch("api.server.cache.redis._is_ci", False):
+        yield CacheGzipRedis()
+
+def test_sample_and_summarize(cache):
+    value = json.dumps({"foo": "bar" * 100})
+    run(cache.set_value("[abc] /v3_0/parcellations/foo", value, meta=CacheMeta(created=time.time() - 10)))
+    run(cache.set_value("[abc] /v3_0/parcellations/bar", "{}", meta=CacheMeta(created=time.time() - 2 * 24 * 60 * 60)))
+    run(cache.set_value("[def] /v3_0/spaces/baz", "{}", tags=["space:baz"]))
+    # keys of celery, sharing the redis
+    run(cache._r.set("celery-task-meta-foo", "{}"))
+
+    sample = run(sample_keys(cache, routes, 10))
+    # metadata is accounted for with its value
+    assert len(sample.keys) == 4
+    assert "celery-task-meta-foo" not in [info.key for info in sample.keys]
+    assert sample.scanned == sample.dbsize == 7
+    assert sample.hotness == "idletime"
+
+    report = summarize(sample, top=1)
+    assert report["scale"] == 1
+    assert report["routes"][routes["abc"]]["keys"] == 2
+    assert report["routes"]["[def] (unknown route)"]["keys"] == 1
+    assert report["routes"]["[tag]"]["keys"] == 1
+    assert report["ages"] == {"1h": 1, "1w": 1, "unknown": 1}
+    assert [info["key"] for info in report["largest"]] == ["[abc] /v3_0/parcellations/foo"]
+
+    assert len(run(sample_keys(cache, routes, 2)).keys) == 2
+
+def test_purge_prefix(cache):
+    for key in ("[abc] /v3_0/parcellations/foo", "[def] /v3_0/parcellations?page=1", "[abc] /v3_0/spaces/foo", "[abc] /v3_0/parcellations*"):
+        run(cache.set_value(key, "{}", meta=CacheMeta(), tags=["parcellation:foo"]))
+
+    memory = CacheLruMemory(1024 * 1024, 60)
+    tiered = CacheTiered([("memory", memory), ("redis", cache)])
+    assert run(tiered.get_value("[abc] /v3_0/parcellations/foo")) is not None
+
+    keys = run(purge_prefix(cache, "/v3_0/parcellations"))
+    assert sorted(keys) == ["[abc] /v3_0/parcellations*", "[abc] /v3_0/parcellations/foo", "[def] /v3_0/parcellations?page=1"]
+    assert sorted(cache._r.store) == ["[abc] /v3_0/spaces/foo", "[meta] [abc] /v3_0/spaces/foo", "[tag] parcellation:foo"]
+
+    # promoted values are evicted from the in process tiers, too
+    run(tiered.evict(keys))
+    assert run(tiered.get_value("[abc] /v3_0/parcellations/foo")) is None
+
+def test_escape_glob():
+    assert escape_glob("/foo[1]*?") == "/foo\\[1\\]\\*\\?"
@@ -0,0 +1,74 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi_pagination import Page, add_pagination, paginate
+from starlette.requests import Request as StarletteRequest
+
+from api.server.util import add_lazy_path
+from api.server.code_snippet import lookup_handler_fn
+from api.server.cache.key import get_cache_key
+from api.server.cache.policy import cache_policy, get_policy
+from api.server.cache.fingerprint import get_route_fingerprint
+from api.siibra_api_config import __version__
+
+add_lazy_path()
+
+app = FastAPI()
+
+@app.get("/atlases/{atlas_id:lazy_path}")
+@cache_policy(ignore_params=["callback"], param_aliases={"space": "space_id"})
+def get_atlas(atlas_id: str, space_id: str=None, detail: bool=False, page: int=1):
+    pass
+
+@app.get("/features/{feature_id:lazy_path}")
+def get_feature(feature_id: str, request: Request):
+    pass
+
+@app.get("/regions", response_model=Page[str])
+def get_regions(find: str=None):
+    return paginate([])
+
+add_pagination(app)
+
+def build_key(path: str, query: str):
+    scope = {
+        "type": "http",
+        "app": app,
+        "method": "GET",
+        "path": path,
+        "query_string": query.encode("latin-1"),
+        "headers": [],
+    }
+    matched = lookup_handler_fn(app, scope)
+    return get_cache_key(StarletteRequest(scope), matched, get_policy(matched))
+
+@pytest.mark.parametrize("path1, query1, path2, query2", [
+    ("/atlases/foo/bar", "space_id=a&detail=true", "/atlases/foo/bar", "detail=true&space_id=a"),
+    ("/atlases/foo bar", "", "/atlases/foo bar", "page=1&detail=false"),
+    ("/atlases/foo", "detail=true", "/atlases/foo", "detail=True"),
+    ("/atlases/foo", "space_id=a%2Fb", "/atlases/foo", "space=a/b"),
+    ("/atlases/foo", "callback=x&cachebuster=123", "/atlases/foo", ""),
+    ("/nonexistent", "b=1&a=2", "/nonexistent", "a=2&b=1"),
+    # the pagination dependency reads the request, but only declared parameters are kept
+    ("/regions", "page=1&size=50&cachebuster=123", "/regions", ""),
+])
+def test_equivalent_keys(path1, query1, path2, query2):
+    assert build_key(path1, query1) == build_key(path2, query2)
+
+@pytest.mark.parametrize("path1, query1, path2, query2", [
+    ("/atlases/foo", "space_id=a", "/atlases/foo", "space_id=b"),
+    ("/atlases/foo", "page=2", "/atlases/foo", ""),
+    ("/atlases/foo?bar", "", "/atlases/foo", "bar"),
+    ("/regions", "page=2", "/regions", ""),
+    ("/regions", "size=10", "/regions", "find=foo&size=10"),
+    # handler reads request directly: all query parameters are kept
+    ("/features/foo", "bar=1", "/features/foo", ""),
+])
+def test_distinct_keys(path1, query1, path2, query2):
+    assert build_key(path1, query1) != build_key(path2, query2)
+
+def test_key_prefix():
+    matched = lookup_handler_fn(app, {"type": "http", "app": app, "method": "GET", "path": "/atlases/foo"})
+    assert build_key("/atlases/foo", "").startswith(f"[{get_route_fingerprint(matched[0])}] ")
+
+    # not matching any route
+    assert build_key("/nonexistent", "").startswith(f"[{__version__}] ")
@@ -0,0 +1,168 @@
+import pytest
+import asyncio
+from prometheus_client import REGISTRY
+from unittest.mock import patch
+
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.meta import META_KEY_PREFIX, CacheMeta
+
+run = asyncio.run
+
+def get_tier_count(tier: str, counter: str):
+    return REGISTRY.get_sample_value("response_cache_tier_total", {"tier": tier, "counter": counter}) or 0
+
+class DictStore:
+    def __init__(self):
+        self.store = {}
+        self.ttls = {}
+        self.metas = {}
+    async def get_entry(self, key, compressed=False):
+        return self.store.get(key), self.ttls.get(key), self.metas.get(key)
+    async def get_meta(self, key):
+        return self.metas.get(key), self.ttls.get(key)
+    async def set_value(self, key, value, ttl=None, meta=None, compressed=False):
+        self.store[key] = value
+        self.ttls[key] = ttl
+        self.metas[key] = meta
+
+def test_lru_evicts_by_bytes():
+    cache = CacheLruMemory(max_bytes=10, ttl=60, max_item_bytes=10)
+    cache.set_value("a", b"aaaa")
+    cache.set_value("b", b"bbbb")
+
+    # touch a, so b becomes the least recently used
+    assert cache.get_value("a") == b"aaaa"
+    cache.set_value("c", b"cccc")
+
+    assert cache.get_value("b") is None
+    assert cache.get_value("a") == b"aaaa"
+    assert cache.get_value("c") == b"cccc"
+    assert cache.size == 8
+    assert cache.stats()["evictions"] == 1
+
+@pytest.mark.parametrize("value, stored", [
+    ("foo", b"foo"),
+    (b"foo", b"foo"),
+    (b"x" * 3, None),
+])
+def test_lru_max_item_bytes(value, stored):
+    cache = CacheLruMemory(max_bytes=10, ttl=60, max_item_bytes=3 if stored else 2)
+    cache.set_value("key", value)
+    assert cache.get_value("key") == stored
+
+def test_lru_ttl():
+    cache = CacheLruMemory(max_bytes=100, ttl=60)
+    with patch("api.server.cache.memory.time.monotonic", return_value=100.):
+        cache.set_value("key", b"foo")
+        cache.set_value("short", b"bar", ttl=1)
+    with patch("api.server.cache.memory.time.monotonic", return_value=120.):
+        assert cache.get_value("key") == b"foo"
+        assert cache.get_value("short") is None
+    with patch("api.server.cache.memory.time.monotonic", return_value=200.):
+        assert cache.get_value("key") is None
+    assert cache.size == 0
+    assert cache.stats()["expirations"] == 2
+
+def test_tiered_promotion():
+    memory = CacheLruMemory(max_bytes=100, ttl=60)
+    redis = DictStore()
+    redis.store["key"] = "value"
+    # tiers named after the test, as counters are of the process
+    cache = CacheTiered([("promotion-memory", memory), ("promotion-redis", redis)])
+
+    assert run(cache.get_value("key")) == "value"
+    assert memory.get_value("key") == b"value"
+    assert run(cache.get_value("key")) == b"value"
+    assert run(cache.get_value("missing")) is None
+
+    assert get_tier_count("promotion-memory", "hits") == 1
+    assert get_tier_count("promotion-memory", "misses") == 2
+    assert get_tier_count("promotion-memory", "promotions") == 1
+    assert get_tier_count("promotion-redis", "hits") == 1
+    assert get_tier_count("promotion-redis", "misses") == 1
+
+def test_tiered_write_through():
+    memory = CacheLruMemory(max_bytes=100, ttl=60)
+    redis = DictStore()
+    cache = CacheTiered([("memory", memory), ("redis", redis)])
+    run(cache.set_value("key", "value"))
+    assert memory.get_value("key") == b"value"
+    assert redis.store["key"] == "value"
+
+@pytest.mark.parametrize("remaining, stale_window, staleness, promoted", [
+    (None, 0, None, True),
+    (100, 10, None, True),
+    (100, 100, 0, False),
+    (20, 30, 10, False),
+])
+def test_tiered_staleness(remaining, stale_window, staleness, promoted):
+    memory = CacheLruMemory(max_bytes=100, ttl=60)
+    redis = DictStore()
+    redis.store["key"] = "value"
+    redis.ttls["key"] = remaining
+    cache = CacheTiered([("memory", memory), ("redis", redis)])
+
+    assert run(cache.get_entry("key", stale_window=stale_window)) == ("value", staleness, None)
+    assert (memory.get_value("key") is not None) == promoted
+
+def test_tiered_set_ttl():
+    memory = CacheLruMemory(max_bytes=100, ttl=60)
+    redis = DictStore()
+    cache = CacheTiered([("memory", memory), ("redis", redis)])
+    run(cache.set_value("key", "value", ttl=100, stale_window=50))
+    assert redis.ttls["key"] == 150
+
+def test_tiered_meta():
+    memory = CacheLruMemory(max_bytes=1000, ttl=60)
+    redis = DictStore()
+    cache = CacheTiered([("memory", memory), ("redis", redis)])
+    meta = CacheMeta(status_code=200, content_type="application/json", etag="abc", created=1.0)
+    run(cache.set_value("key", "value", ttl=100, stale_window=50, meta=meta))
+    assert run(cache.get_meta("key")) == (meta, None)
+
+    memory.clear()
+    assert run(cache.get_meta("key")) == (meta, None)
+    assert run(cache.get_meta("key", stale_window=200)) == (meta, 50)
+
+    # promoted along with the value
+    assert run(cache.get_entry("key")) == ("value", None, meta)
+    assert CacheMeta.loads(memory.get_value(META_KEY_PREFIX + "key")) == meta
+
+def test_tiered_set_compressed():
+    memory = CacheLruMemory(max_bytes=1000, ttl=60)
+    redis = DictStore()
+    cache = CacheTiered([("memory", memory), ("redis", redis)])
+    run(cache.set_value("key", b"\x1f\x8bvalue", compressed=True))
+    assert redis.store["key"] == b"\x1f\x8bvalue"
+    assert memory.get_value("key") is None
+    assert run(cache.get_entry("key", compressed=True))[0] == b"\x1f\x8bvalue"
+
+class BulkDictStore(DictStore):
+    def __init__(self):
+        super().__init__()
+        self.bulk_calls = []
+    async def get_entries(self, keys, compressed=False):
+        self.bulk_calls.append(keys)
+        return [await self.get_entry(key) for key in keys]
+
+def test_tiered_get_entries():
+    memory = CacheLruMemory(max_bytes=1000, ttl=60)
+    redis = BulkDictStore()
+    cache = CacheTiered([("entries-memory", memory), ("entries-redis", redis)])
+    memory.set_value("a", b"a")
+    redis.store.update({"b": "b", "c": "c"})
+    redis.ttls["c"] = 5
+
+    assert run(cache.get_entries(["a", "b", "c", "missing"], stale_window=10)) == [
+        (b"a", None, None),
+        ("b", None, None),
+        ("c", 5, None),
+        (None, None, None),
+    ]
+    # memory hits are not looked up in redis, the others are looked up at once
+    assert redis.bulk_calls == [["b", "c", "missing"]]
+    # stale entries are not promoted
+    assert memory.get_value("b") == b"b"
+    assert memory.get_value("c") is None
+    assert get_tier_count("entries-redis", "hits") == 2
@@ -0,0 +1,239 @@
+import pytest
+import asyncio
+import base64
+import gzip
+import json
+import re
+from unittest.mock import patch
+from redis.exceptions import ResponseError
+
+from api.server.cache.redis import CacheGzipRedis, NO_LOCK, OFFLOAD_BYTES, _tag_script, _refresh_lock_script
+from api.server.cache.meta import CacheMeta
+from api.server.cache.codec import get_codec, decompress
+from api.server.api import get_cached_status_code
+
+run = asyncio.run
+
+class DictRedis:
+    def __init__(self):
+        self.store = {}
+        self.pttls = {}
+    async def get(self, key):
+        if isinstance(self.store.get(key), set):
+            raise ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return self.store.get(key)
+    async def mget(self, keys):
+        return [None if isinstance(self.store.get(key), set) else self.store.get(key) for key in keys]
+    async def pttl(self, key):
+        return self.pttls.get(key, -1)
+    async def set(self, key, value, px=None, keepttl=False, nx=False):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value if isinstance(value, bytes) else value.encode("utf-8")
+        if px:
+            self.pttls[key] = px
+        elif not keepttl:
+            self.pttls.pop(key, None)
+        return True
+    async def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key, None)
+            self.pttls.pop(key, None)
+    async def sadd(self, key, *members):
+        self.store.setdefault(key, set()).update(member.encode("utf-8") for member in members)
+    async def sunion(self, *keys):
+        return set().union(*[self.store.get(key, set()) for key in keys])
+    async def unlink(self, *keys):
+        count = len([key for key in keys if key in self.store])
+        await self.delete(*keys)
+        return count
+    async def dbsize(self):
+        return len(self.store)
+    async def memory_usage(self, key):
+        return len(self.store[key]) if key in self.store else None
+    async def object(self, subcommand, key):
+        if subcommand == "freq":
+            raise ResponseError("An LFU maxmemory policy is not selected")
+        return 0 if key in self.store else None
+    async def scan_iter(self, match=None, count=None):
+        # glob, with backslash escapes
+        pattern = re.compile("".join(
+            ".*" if token == "*" else "." if token == "?" else re.escape(token[-1])
+            for token in re.findall(r"\\.|.", match or "*", re.DOTALL)
+        ), re.DOTALL)
+        for key in list(self.store):
+            if pattern.fullmatch(key):
+                yield key.encode("utf-8")
+    async def scan(self, cursor=0, match=None, count=None):
+        # a single call visits the whole keyspace
+        return 0, [key async for key in self.scan_iter(match=match, count=count)]
+    async def eval(self, script, numkeys, key, *args):
+        if script == _tag_script:
+            member, px = args
+            pttl = self.pttls.get(key, -1) if key in self.store else -2
+            await self.sadd(key, member)
+            if not px:
+                self.pttls.pop(key, None)
+            elif pttl == -2 or 0 <= pttl < px:
+                self.pttls[key] = px
+            return
+        if script == _refresh_lock_script:
+            # compare and expire
+            if self.store.get(key) != args[0].encode("utf-8"):
+                return 0
+            self.pttls[key] = args[1]
+            return 1
+        # compare and delete
+        if self.store.get(key) == args[0].encode("utf-8"):
+            await self.delete(key)
+    def pipeline(self, transaction=True):
+        return DictPipeline(self)
+
+class DictPipeline:
+    def __init__(self, r):
+        self.r = r
+        self.calls = []
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+    async def execute(self, raise_on_error=True):
+        results = []
+        for name, args, kwargs in self.calls:
+            try:
+                results.append(await getattr(self.r, name)(*args, **kwargs))
+            except ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+value = json.dumps({"foo": "bar"})
+
+@pytest.fixture
+def cache():
+    _r = DictRedis()
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), patch("api.server.cache.redis._is_ci", False):
+        yield CacheGzipRedis()
+
+@pytest.mark.parametrize("stored", [
+    gzip.compress(value.encode("utf-8")),
+    CacheGzipRedis.encode(value).encode("utf-8"),
+    value.encode("utf-8"),
+])
+def test_read_legacy_and_binary(cache, stored):
+    cache._r.store["key"] = stored
+    assert run(cache.get_value("key")) == value
+    compressed = run(cache.get_compressed("key"))
+    # values stored with codecs other than gzip are returned decompressed
+    assert (gzip.decompress(compressed) if compressed.startswith(b"\x1f\x8b") else compressed) == value.encode("utf-8")
+
+    # legacy entries are migrated to compressed bytes
+    assert get_codec(cache._r.store["key"]) is not None
+
+def test_store_binary(cache):
+    run(cache.set_value("key", value))
+    assert run(decompress(cache._r.store["key"])) == value.encode("utf-8")
+
+@pytest.mark.parametrize("store_binary", [True, False])
+def test_store_compressed(cache, store_binary):
+    with patch("api.server.cache.redis._store_binary", store_binary):
+        run(cache.set_value("key", gzip.compress(value.encode("utf-8")), compressed=True))
+    assert run(cache.get_value("key")) == value
+
+def test_store_legacy(cache):
+    with patch("api.server.cache.redis._store_binary", False):
+        run(cache.set_value("key", value))
+    assert CacheGzipRedis.decode(cache._r.store["key"]) == value
+    assert base64.b64decode(cache._r.store["key"]).startswith(b"\x1f\x8b")
+
+@pytest.mark.parametrize("content, status_code", [
+    (value, 200),
+    (json.dumps({"error": True, "status_code": 404, "message": "x" * 1000}), 404),
+    (json.dumps({"error": True, "status_code": 503, "message": ""}), 503),
+])
+def test_status_code_from_peek(content, status_code):
+    compressed = gzip.compress(content.encode("utf-8"))
+    head = CacheGzipRedis.peek(compressed)
+    assert len(head) <= 64
+    assert get_cached_status_code(head) == status_code
+
+def test_ttl(cache):
+    run(cache.set_value("key", value, ttl=10))
+    assert run(cache.get_entry("key")) == (value, 10, None)
+
+    # migration keeps ttl
+    cache._r.store["key"] = CacheGzipRedis.encode(value).encode("utf-8")
+    assert run(cache.get_entry("key", compressed=True))[1] == 10
+    assert cache._r.store["key"].startswith(b"\x1f\x8b")
+
+    run(cache.set_value("key", value))
+    assert run(cache.get_entry("key")) == (value, None, None)
+
+def test_meta(cache):
+    meta = CacheMeta(status_code=200, content_type="text/plain", etag="abc", created=1.0)
+    run(cache.set_value("key", value, ttl=10, meta=meta))
+    assert run(cache.get_entry("key")) == (value, 10, meta)
+    assert run(cache.get_meta("key")) == (meta, 10)
+
+    run(cache.set_value("key", value))
+    assert run(cache.get_meta("key")) == (None, None)
+
+@pytest.mark.parametrize("stored", [None, b"", b"not json", b'{"unknown": 1}'])
+def test_meta_malformed(stored):
+    assert CacheMeta.loads(stored) is None
+
+def test_unavailable(cache):
+    async def fail(*args, **kwargs):
+        raise ConnectionError("connection refused")
+    cache._r.get = fail
+    assert run(cache.get_value("key")) is None
+    assert not cache.is_connected
+    assert run(cache.acquire_lock("key", 1)) == NO_LOCK
+
+@pytest.mark.parametrize("size", [10, OFFLOAD_BYTES * 2])
+def test_large_value(cache, size):
+    large_value = json.dumps({"foo": "x" * size})
+    run(cache.set_value("key", large_value))
+    assert run(cache.get_value("key")) == large_value
+
+def test_lock(cache):
+    token = run(cache.acquire_lock("key", 1))
+    assert token
+    assert run(cache.acquire_lock("key", 1)) is None
+
+    run(cache.release_lock("key", "other token"))
+    assert run(cache.acquire_lock("key", 1)) is None
+
+    assert not run(cache.refresh_lock("key", "other token", 5))
+    assert run(cache.refresh_lock("key", token, 5))
+    assert cache._r.pttls["[lock] key"] == 5000
+
+    run(cache.release_lock("key", token))
+    assert run(cache.acquire_lock("key", 1))
+
+def test_invalidate_tags(cache):
+    run(cache.set_value("a", value, meta=CacheMeta(), tags=["parcellation:foo", "space:bar"]))
+    run(cache.set_value("b", value, tags=["parcellation:foo"]))
+    run(cache.set_value("c", value, tags=["space:bar"]))
+    run(cache.set_value("d", value))
+
+    assert run(cache.invalidate_tags(["parcellation:foo"])) == ["a", "b"]
+    assert sorted(cache._r.store) == ["[tag] space:bar", "c", "d"]
+
+    # dangling keys (invalidated, or expired) are ignored
+    assert run(cache.invalidate_tags(["space:bar", "region:baz"])) == ["a", "c"]
+    assert sorted(cache._r.store) == ["d"]
+
+def test_tag_expiry(cache):
+    run(cache.set_value("a", value, ttl=10, tags=["space:bar"]))
+    run(cache.set_value("b", value, ttl=60, tags=["space:bar"]))
+    run(cache.set_value("c", value, ttl=30, tags=["space:bar"]))
+    # extended to the longest ttl, never shortened
+    assert cache._r.pttls["[tag] space:bar"] == 60000
+
+    # keys without ttl make the set persistent
+    run(cache.set_value("d", value, tags=["space:bar"]))
+    run(cache.set_value("e", value, ttl=10, tags=["space:bar"]))
+    assert "[tag] space:bar" not in cache._r.pttls
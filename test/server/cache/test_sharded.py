@@ -0,0 +1,86 @@
+import pytest
+import asyncio
+import shutil
+import socket
+import subprocess
+import time
+from unittest.mock import patch
+
+from api.server.cache.sharded import HashRing, CacheShardedRedis
+from api.server.cache.redis import CacheGzipRedis
+from test.server.cache.test_redis import DictRedis
+
+run = asyncio.run
+
+keys = [f"[abc] /v3_0/regions/{idx}" for idx in range(3000)]
+
+def test_ring_spread_and_stability():
+    ring = HashRing(["a:6379", "b:6379", "c:6379"], 160)
+    owners = [ring.get_node(key) for key in keys]
+    for node_idx in range(3):
+        assert 700 < owners.count(node_idx) < 1300
+
+    # removing a node only moves its own keys
+    smaller_ring = HashRing(["a:6379", "b:6379"], 160)
+    assert all(smaller_ring.get_node(key) == owner for key, owner in zip(keys, owners) if owner != 2)
+
+@pytest.fixture
+def sharded():
+    store = CacheShardedRedis(["redis://a:6379", "redis://:secret@b:6379/1", "redis://c"], 160)
+    with patch("api.server.cache.redis._is_ci", False):
+        for node in store.nodes:
+            node._r = DictRedis()
+        yield store
+
+def test_node_names(sharded):
+    # without credentials
+    assert [node.name for node in sharded.nodes] == ["a:6379", "b:6379/1", "c:6379"]
+
+def test_sharded(sharded):
+    for key in keys[:30]:
+        run(sharded.set_value(key, "{}", tags=["parcellation:foo"]))
+    assert all(key in sharded.get_node(key)._r.store for key in keys[:30])
+    assert len([node for node in sharded.nodes if node._r.store]) == 3
+
+    # unavailable node: its keys are misses, other nodes keep serving
+    down = sharded.get_node(keys[0])
+    down.mark_unavailable(ConnectionError("down"))
+    assert run(sharded.get_value(keys[0])) is None
+    assert all(run(sharded.get_value(key)) == "{}" for key in keys[:30] if sharded.get_node(key) is not down)
+    down._retry_at = 0
+
+    assert run(sharded.invalidate_tags(["parcellation:foo"])) == sorted(keys[:30])
+
+@pytest.mark.skipif(shutil.which("redis-server") is None, reason="redis-server is not installed")
+def test_sharded_redis_server(tmp_path):
+    processes = []
+    ports = []
+    for _ in range(3):
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            ports.append(sock.getsockname()[1])
+        processes.append(subprocess.Popen(["redis-server", "--port", str(ports[-1]), "--save", "", "--dir", str(tmp_path)], stdout=subprocess.DEVNULL))
+    time.sleep(0.5)
+
+    store = CacheShardedRedis([f"redis://localhost:{port}" for port in ports], 160)
+
+    async def main():
+        store.on_startup()
+        try:
+            for key in keys[:30]:
+                await store.set_value(key, "{}")
+            assert all([await store.get_value(key) == "{}" for key in keys[:30]])
+
+            processes[0].terminate()
+            processes[0].wait()
+            values = [await store.get_value(key) for key in keys[:30]]
+            assert all((value is None) == (store.get_node(key) is store.nodes[0]) for key, value in zip(keys[:30], values))
+        finally:
+            await store.terminate()
+
+    try:
+        with patch("api.server.cache.redis._is_ci", False):
+            run(main())
+    finally:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,65 @@
+import pytest
+import multiprocessing
+import time
+from unittest.mock import patch
+
+from api.server.cache.shared import CacheSharedMemory, SIZE_CLASSES, WAYS
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "segment")
+
+def test_shared_between_instances(path):
+    writer = CacheSharedMemory(path, 1024 * 1024, 60)
+    reader = CacheSharedMemory(path, 1024 * 1024, 60)
+    assert writer.set_value("foo", "bar")
+    assert reader.get_value("foo") == b"bar"
+
+    # moved to a larger size class
+    large = b"x" * (SIZE_CLASSES[0] + 1)
+    assert writer.set_value("foo", large)
+    assert reader.get_value("foo") == large
+    assert reader.stats()["entries"] == 1
+
+    reader.delete("foo")
+    assert writer.get_value("foo") is None
+    assert not writer.set_value("foo", b"x" * (SIZE_CLASSES[-1] + 1))
+
+def _write(path, key, value):
+    CacheSharedMemory(path, 1024 * 1024, 60).set_value(key, value)
+
+def test_shared_between_processes(path):
+    store = CacheSharedMemory(path, 1024 * 1024, 60)
+    process = multiprocessing.get_context("fork").Process(target=_write, args=(path, "foo", b"bar"))
+    process.start()
+    process.join()
+    assert store.get_value("foo") == b"bar"
+
+def test_shared_bounded(path):
+    store = CacheSharedMemory(path, 1024 * 1024, 60)
+    size_class = store._classes[0]
+    for idx in range(size_class.buckets * WAYS * 2):
+        assert store.set_value(f"key{idx}", b"x" * 10)
+    stats = store.stats()
+    assert stats["entries"] <= size_class.buckets * WAYS
+    assert stats["evictions"] > 0
+
+def test_shared_ttl(path):
+    store = CacheSharedMemory(path, 1024 * 1024, 60)
+    store.set_value("foo", "bar", ttl=120)
+    with patch("api.server.cache.shared.time.time", return_value=time.time() + 61):
+        assert store.get_value("foo") is None
+
+def test_shared_reinitialized_on_layout_change(path):
+    CacheSharedMemory(path, 1024 * 1024, 60).set_value("foo", "bar")
+    assert CacheSharedMemory(path, 1024 * 1024, 60).get_value("foo") == b"bar"
+    assert CacheSharedMemory(path, 2 * 1024 * 1024, 60).get_value("foo") is None
+
+def test_shared_torn_read(path):
+    store = CacheSharedMemory(path, 1024 * 1024, 60)
+    store.set_value("foo", "bar")
+    offset = next(offset for offset in store._classes[0].slot_offsets(store.hash_key("foo")) if store._read_slot(store._classes[0], offset, store.hash_key("foo"))[2])
+    # writer in progress
+    store._mm[offset] += 1
+    assert store.get_value("foo") is None
+    assert store.stats()["retries"] > 0
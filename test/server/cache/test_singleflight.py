@@ -0,0 +1,124 @@
+import asyncio
+import pytest
+
+from api.server.cache.singleflight import SingleFlight
+from api.server.cache.redis import NO_LOCK
+
+class LockStore:
+    def __init__(self, locked=False):
+        self.locked = locked
+        self.value = None
+    def acquire_lock(self, key, ttl):
+        if self.locked:
+            return None
+        self.locked = True
+        return "token"
+    def release_lock(self, key, token):
+        assert token == "token"
+        self.locked = False
+
+def test_coalesce_in_process():
+    single_flight = SingleFlight(lock_ttl=1, wait_timeout=1)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*[
+            single_flight.run("key", compute, lambda: None)
+            for _ in range(10)
+        ])
+
+    assert asyncio.run(main()) == ["result"] * 10
+    assert len(calls) == 1
+    assert single_flight.counters["leaders"] == 1
+    assert single_flight.counters["followers"] == 9
+
+def test_leader_exception_propagates():
+    single_flight = SingleFlight(lock_ttl=1, wait_timeout=1)
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("foo")
+
+    async def main():
+        return await asyncio.gather(*[
+            single_flight.run("key", compute, lambda: None)
+            for _ in range(3)
+        ], return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+def test_wait_for_remote_leader():
+    single_flight = SingleFlight(lock_ttl=1, wait_timeout=5)
+    store = LockStore(locked=True)
+
+    async def compute():
+        raise AssertionError("should not be called")
+
+    async def remote_leader():
+        await asyncio.sleep(0.1)
+        store.value = "remote result"
+        store.locked = False
+
+    async def main():
+        result, _ = await asyncio.gather(
+            single_flight.run("key", compute, lambda: store.value, store=store),
+            remote_leader(),
+        )
+        return result
+
+    assert asyncio.run(main()) == "remote result"
+    assert single_flight.counters["remote_hits"] == 1
+
+@pytest.mark.parametrize("store", [
+    LockStore(locked=True),
+    LockStore(locked=False),
+])
+def test_compute_after_lock_released_or_timeout(store):
+    single_flight = SingleFlight(lock_ttl=1, wait_timeout=0.1)
+
+    async def compute():
+        return "result"
+
+    assert asyncio.run(single_flight.run("key", compute, lambda: None, store=store)) == "result"
+
+def test_no_lock_available():
+    class NoLockStore(LockStore):
+        def acquire_lock(self, key, ttl):
+            return NO_LOCK
+        def release_lock(self, key, token):
+            assert token == NO_LOCK
+
+    single_flight = SingleFlight(lock_ttl=1, wait_timeout=1)
+
+    async def compute():
+        return "result"
+
+    assert asyncio.run(single_flight.run("key", compute, lambda: None, store=NoLockStore())) == "result"
+
+def test_lock_held_until_pending():
+    single_flight = SingleFlight(lock_ttl=0.02, wait_timeout=5)
+    refreshed = []
+    class RefreshStore(LockStore):
+        def refresh_lock(self, key, token, ttl):
+            refreshed.append(ttl)
+            return True
+    store = RefreshStore()
+
+    async def main():
+        committed = asyncio.Event()
+        result = await single_flight.run("key", lambda: asyncio.sleep(0, "streamed"), lambda: None, store=store, pending=lambda value: committed.wait())
+        # returned, but not yet committed
+        await asyncio.sleep(0.05)
+        assert store.locked
+        committed.set()
+        await asyncio.sleep(0.01)
+        return result
+
+    assert asyncio.run(main()) == "streamed"
+    assert not store.locked
+    assert refreshed
@@ -0,0 +1,93 @@
+import pytest
+import asyncio
+import gzip
+import json
+import os
+import time
+from unittest.mock import patch
+
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.spill import SpilledFile, SPILL_PREFIX, sweep
+from api.server.cache.introspect import purge_prefix
+from .test_redis import DictRedis
+
+run = asyncio.run
+
+# larger than CACHE_ZSTD_MAX_BYTES, i.e. gzip compressed
+value = json.dumps({"foo": os.urandom(48 * 1024).hex()})
+
+@pytest.fixture
+def cache(tmp_path):
+    _r = DictRedis()
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), \
+            patch("api.server.cache.redis._is_ci", False), patch("api.server.cache.redis._spill_bytes", 1024), \
+            patch("api.server.cache.spill.CACHE_SPILL_DIR", str(tmp_path)):
+        yield CacheGzipRedis()
+
+def spilled_files(tmp_path):
+    return list(tmp_path.glob("*/*.gz"))
+
+def test_spill(cache, tmp_path):
+    run(cache.set_value("key", value, ttl=60))
+    assert cache._r.store["key"].startswith(SPILL_PREFIX)
+    assert len(spilled_files(tmp_path)) == 1
+    assert run(cache.get_value("key")) == value
+
+    # served from the file, as is
+    compressed = run(cache.get_compressed("key"))
+    assert isinstance(compressed, SpilledFile)
+    assert gzip.decompress(run(compressed.read())) == value.encode("utf-8")
+
+    # small values are kept in redis
+    run(cache.set_value("small", "{}"))
+    assert not cache._r.store["small"].startswith(SPILL_PREFIX)
+
+    # identical values share the file
+    run(cache.set_value("other", gzip.compress(value.encode("utf-8")), compressed=True))
+    assert cache._r.store["other"].startswith(SPILL_PREFIX)
+    assert len(spilled_files(tmp_path)) == len(set(path.name for path in spilled_files(tmp_path)))
+
+def test_not_promoted(cache):
+    memory = CacheLruMemory(1024 * 1024, 60)
+    tiered = CacheTiered([("memory", memory), ("redis", cache)])
+    run(cache.set_value("key", value))
+    assert isinstance(run(tiered.get_compressed("key")), SpilledFile)
+    assert run(tiered.get_value("key")) == value
+    assert memory.get_value("key") == value.encode("utf-8")
+    assert memory.get_value("[gzip] key") is None
+
+def test_missing_file(cache, tmp_path):
+    run(cache.set_value("key", value))
+    for path in spilled_files(tmp_path):
+        path.unlink()
+    assert run(cache.get_value("key")) is None
+    assert run(cache.get_compressed("key")) is None
+    assert cache.is_connected
+
+def test_sweep(cache, tmp_path):
+    run(cache.set_value("old", value))
+    run(cache.set_value("new", json.dumps({"bar": os.urandom(48 * 1024).hex()})))
+    old_path, = [path for path in spilled_files(tmp_path) if cache._r.store["old"].endswith(path.stem.encode("utf-8"))]
+    os.utime(old_path, (time.time() - 120, time.time() - 120))
+
+    assert sweep(60) == 1
+    assert run(cache.get_value("old")) is None
+    assert run(cache.get_value("new")) is not None
+
+    # rewriting a value refreshes its file
+    run(cache.set_value("new", run(cache.get_value("new"))))
+    assert sweep(60) == 0
+
+def test_invalidate_tags(cache, tmp_path):
+    run(cache.set_value("key", value, tags=["space:bar"]))
+    assert len(spilled_files(tmp_path)) == 1
+    assert run(cache.invalidate_tags(["space:bar"])) == ["key"]
+    assert spilled_files(tmp_path) == []
+
+def test_purge_prefix(cache, tmp_path):
+    run(cache.set_value("[abc] /v3_0/spaces/foo", value))
+    assert len(spilled_files(tmp_path)) == 1
+    assert run(purge_prefix(cache, "/v3_0/spaces")) == ["[abc] /v3_0/spaces/foo"]
+    assert spilled_files(tmp_path) == []
@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+
+def test_live_metrics_multiprocess(tmp_path):
+    """Counters of all processes (e.g. uvicorn workers) are exported, summed"""
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "SIIBRA_API_ROLE": "server"}
+    count = "from api.server.cache.stats import route_requests; route_requests.labels('/foo', 'hit').inc()"
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", count], env=env, check=True)
+
+    export = "from api.server.metrics import get_live_metrics; print(get_live_metrics().decode())"
+    output = subprocess.run([sys.executable, "-c", export], env=env, check=True, capture_output=True, text=True).stdout
+    assert 'response_cache_route_total{counter="hit",route="/foo"} 2.0' in output
@@ -0,0 +1,63 @@
+import pytest
+import asyncio
+import gzip
+
+from api.server.cache.stream import CacheWriter, CacheTee
+from api.server.cache.etag import compute_etag
+from api.server.cache.redis import OFFLOAD_BYTES
+
+run = asyncio.run
+
+chunks = [b"foo", b"x" * OFFLOAD_BYTES * 2, b"bar"]
+body = b"".join(chunks)
+
+async def iterate(iterable):
+    return [chunk async for chunk in iterable]
+
+async def body_iterator(fail=False):
+    for chunk in chunks[1:]:
+        yield chunk
+    if fail:
+        raise RuntimeError("failed")
+
+@pytest.mark.parametrize("max_bytes, expect_overflow", [
+    (len(body), False),
+    (len(body) - 1, True),
+])
+def test_writer(max_bytes, expect_overflow):
+    writer = CacheWriter(max_bytes)
+    for chunk in chunks:
+        run(writer.feed(chunk))
+    assert writer.overflowed == expect_overflow
+    result = writer.finish()
+    if expect_overflow:
+        assert result is None
+    else:
+        compressed, etag = result
+        assert gzip.decompress(compressed) == body
+        assert etag == compute_etag(body)
+
+def test_tee_commits_on_completion():
+    committed = []
+    async def commit(compressed, etag):
+        committed.append((gzip.decompress(compressed), etag))
+
+    tee = CacheTee(chunks[:1], body_iterator(), commit)
+    assert tee.claim()
+    assert not tee.claim()
+    assert run(iterate(tee)) == chunks
+    assert committed == [(body, compute_etag(body))]
+
+def test_tee_discards_failed_stream():
+    committed = []
+    async def commit(compressed, etag):
+        committed.append(etag)
+
+    tee = CacheTee(chunks[:1], body_iterator(fail=True), commit)
+    with pytest.raises(RuntimeError):
+        run(iterate(tee))
+    assert committed == []
+
+def test_tee_passthrough():
+    tee = CacheTee(chunks[:1], body_iterator(), max_bytes=1)
+    assert run(iterate(tee)) == chunks
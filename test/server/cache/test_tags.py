@@ -0,0 +1,12 @@
+import pytest
+from api.server.cache.tags import get_tags
+
+@pytest.mark.parametrize("params, path, expected", [
+    ([("parcellation_id", "foo"), ("region_id", "hoc1 left")], "/regions/{region_id:lazy_path}", ["parcellation:foo", "region:hoc1 left"]),
+    ([("parcellation_id", "foo"), ("type", "StreamlineCounts"), ("page", "1")], "/feature/RegionalConnectivity", ["feature_type:RegionalConnectivity", "feature_type:StreamlineCounts", "parcellation:foo"]),
+    ([("space_id", "bar"), ("space_id", "bar"), ("find", "")], "/spaces/{space_id:lazy_path}", ["space:bar"]),
+    ([("feature_id", "baz")], "/feature/{feature_id:lazy_path}", ["feature:baz"]),
+    ([("func", lambda: []), ("parcellation_id", None)], "", []),
+])
+def test_get_tags(params, path, expected):
+    assert get_tags(params, path) == expected
@@ -0,0 +1,43 @@
+import pytest
+import asyncio
+from unittest.mock import patch
+
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.unpaginated import cache_unpaginated
+
+@pytest.fixture
+def cache():
+    cache = CacheTiered([("memory", CacheLruMemory(max_bytes=10000, ttl=60))])
+    with patch("api.server.cache.unpaginated.get_instance", lambda: cache):
+        yield cache
+
+def test_async_handler(cache):
+    calls = []
+    async def data_handler(parcellation_id):
+        calls.append(parcellation_id)
+        await asyncio.sleep(0.01)
+        return [1, 2, 3]
+
+    @cache_unpaginated()
+    async def get_all(parcellation_id: str, func=lambda: []):
+        return len(await func(parcellation_id))
+
+    async def main():
+        return await asyncio.gather(*[get_all("parc", func=data_handler) for _ in range(5)])
+
+    assert asyncio.run(main()) == [3] * 5
+    assert asyncio.run(main()) == [3] * 5
+    assert calls == ["parc"]
+
+def test_sync_handler():
+    with pytest.raises(AssertionError):
+        @cache_unpaginated()
+        def get_all(func=lambda: []):
+            return func()
+
+def test_func_not_provided(cache):
+    @cache_unpaginated()
+    async def get_all(func=lambda: [1]):
+        return func()
+    assert asyncio.run(get_all()) == [1]
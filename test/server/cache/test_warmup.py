@@ -0,0 +1,120 @@
+import pytest
+import asyncio
+from datetime import datetime, timedelta
+from fastapi import FastAPI
+from unittest.mock import patch
+
+from api.server.cache.warmup import parse_access_log_line, read_access_logs, plan_warmup, warm, in_process_fetch, claim_warmup, WARMUP_HEADER
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from .test_redis import DictRedis
+
+app = FastAPI()
+
+@app.get("/parcellations/{parcellation_id}")
+def get_parcellation(parcellation_id: str):
+    return parcellation_id
+
+@app.get("/features")
+def get_features():
+    return []
+
+@app.middleware("http")
+async def add_cache_header(request, call_next):
+    response = await call_next(request)
+    response.headers["x-fastapi-cache"] = "hit" if request.headers.get(WARMUP_HEADER) else "miss"
+    return response
+
+def log_line(url: str, ms: int, hit_cache: str="cache_miss", status: int=200, method: str="GET", at: datetime=None):
+    return f"{(at or datetime.now()):%Y-%m-%d %H:%M:%S},123 - {status} - {ms}ms - {hit_cache} - {method} http://localhost:5000{url}"
+
+def bypass_reason(path: str, query: str):
+    return "query:bbox=" if "bbox=" in query else None
+
+def test_parse_access_log_line():
+    entry = parse_access_log_line("2024-01-02 03:04:05,678 - 200 - 35ms - cache_hit - GET http://localhost/features?page=1")
+    assert entry.time == datetime(2024, 1, 2, 3, 4, 5, 678000)
+    assert (entry.status, entry.process_time_ms, entry.hit_cache, entry.method, entry.url) == (200, 35, "cache_hit", "GET", "http://localhost/features?page=1")
+    assert parse_access_log_line("[api.common.logger.info:INFO]  started") is None
+
+def test_read_access_logs(tmp_path):
+    path = tmp_path / "host.access.log"
+    path.write_text("\n".join([
+        log_line("/features", 10, at=datetime.now() - timedelta(days=2)),
+        log_line("/features", 20),
+        "not an entry",
+    ]))
+    entries = list(read_access_logs([path], datetime.now() - timedelta(days=1)))
+    assert [entry.process_time_ms for entry in entries] == [20]
+
+@pytest.fixture
+def entries():
+    lines = [
+        # popular, but fast once cached
+        *[log_line("/features", 50, "cache_hit") for _ in range(20)],
+        log_line("/features", 100),
+        # less popular, but slow
+        *[log_line("/parcellations/foo", 5000, "cache_hit") for _ in range(3)],
+        log_line("/parcellations/foo", 5000),
+        log_line("/parcellations/bar?x=1", 5000),
+        # not planned
+        log_line("/parcellations/baz", 10, status=500),
+        log_line("/features", 10, method="POST"),
+        log_line("/unknown", 10),
+        log_line("/features?bbox=1", 10),
+    ]
+    return [parse_access_log_line(line) for line in lines]
+
+def test_plan_warmup(entries):
+    plan = plan_warmup(entries, app, 10, bypass_reason)
+    assert plan.requests == len(entries)
+    assert plan.cacheable == 26
+    assert [stats.template for stats in plan.templates] == ["/parcellations/{parcellation_id}", "/features"]
+    # latency of misses
+    assert plan.templates[1].latency_ms == 100
+    assert plan.urls == ["/parcellations/foo", "/parcellations/bar?x=1", "/features"]
+
+    assert plan_warmup(entries, app, 1).urls == ["/parcellations/foo"]
+
+def test_warm(entries):
+    plan = plan_warmup(entries, app, 10, bypass_reason)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fetch(url):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if url == "/features":
+            return 200, "hit"
+        if url == "/parcellations/bar?x=1":
+            raise ConnectionError("connection refused")
+        return 200, None
+
+    report = asyncio.run(warm(plan, fetch, 2))
+    assert max_in_flight == 2
+    assert (report.warmed, report.already_warm, report.failed, report.skipped) == (1, 1, 1, 0)
+    assert report.covered == 4 + 21
+    assert report.coverage == pytest.approx(25 / len(entries))
+
+    report = asyncio.run(warm(plan, fetch, 1, timeout=0.001))
+    assert report.skipped == 2
+
+def test_in_process_fetch():
+    # responses of http middlewares are streamed
+    fetch = in_process_fetch(app)
+    assert asyncio.run(asyncio.wait_for(fetch("/parcellations/foo?x=1"), 5)) == (200, "hit")
+
+def test_claim_warmup():
+    _r = DictRedis()
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), patch("api.server.cache.redis._is_ci", False):
+        # processes of all replicas share redis: only the first warms it
+        stores = [CacheTiered([("memory", CacheLruMemory(1024 * 1024, 60)), ("redis", CacheGzipRedis())]) for _ in range(2)]
+        assert [asyncio.run(claim_warmup(store, 60)) for store in stores] == [True, False]
+
+    # without redis, each process warms its own store
+    store = CacheTiered([("memory", CacheLruMemory(1024 * 1024, 60))])
+    assert [asyncio.run(claim_warmup(store, 60)) for _ in range(2)] == [True, True]
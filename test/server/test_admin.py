@@ -0,0 +1,35 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+from api.server.admin import router
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from test.server.cache.test_redis import DictRedis
+
+app = FastAPI()
+app.include_router(router, prefix="/admin")
+
+@pytest.fixture
+def client():
+    _r = DictRedis()
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), patch("api.server.cache.redis._is_ci", False):
+        cache = CacheGzipRedis()
+        tiered = CacheTiered([("memory", CacheLruMemory(1024 * 1024, 60)), ("redis", cache)])
+        with patch("api.server.admin.get_cache_nodes", return_value=[cache]), patch("api.server.admin.get_cache_instance", return_value=tiered):
+            yield TestClient(app)
+
+@pytest.mark.parametrize("admin_token, authorization, status_code", [
+    (None, "Bearer token", 404),
+    ("token", None, 404),
+    ("token", "Bearer wrong", 404),
+    ("token", "Basic token", 404),
+    ("token", "Bearer token", 200),
+])
+def test_verify_admin_token(client, admin_token, authorization, status_code):
+    headers = {"authorization": authorization} if authorization else {}
+    with patch("api.server.admin.ADMIN_TOKEN", admin_token):
+        assert client.post("/admin/cache/purge?prefix=/v3_0/spaces", headers=headers).status_code == status_code
+        assert client.get("/admin/cache/stats", headers=headers).status_code == status_code
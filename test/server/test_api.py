@@ -0,0 +1,202 @@
+import asyncio
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from httpx import AsyncClient, ASGITransport
+from unittest.mock import patch
+
+from api.server.api import middleware_cache_response, _background_tasks
+from api.server.const import cache_header
+from api.server.cache.redis import CacheGzipRedis
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.meta import CacheMeta, META_KEY_PREFIX
+from api.server.cache.policy import cache_policy
+from test.server.cache.test_redis import DictRedis
+
+# stale window is 60 seconds: stale while revalidate for 30 seconds, stale if error for 60 seconds
+TTL, SWR, SIE = 60, 30, 60
+
+app = FastAPI()
+state = {"computed": 0, "fail": False, "bypassed": 0}
+
+@app.get("/items/{item_id}")
+@cache_policy(ttl=TTL, stale_while_revalidate=SWR, stale_if_error=SIE, negative_ttl=10)
+async def get_item(item_id: str):
+    if state["fail"]:
+        return JSONResponse({"detail": "unavailable"}, status_code=503)
+    if item_id == "missing":
+        raise HTTPException(404, f"{item_id} not found")
+    if item_id == "invalid":
+        raise HTTPException(400, f"{item_id} is invalid")
+    state["computed"] += 1
+    return {"id": item_id, "computed": state["computed"]}
+
+@app.get("/uncached/{item_id}")
+@cache_policy(negative_ttl=0)
+async def get_uncached(item_id: str):
+    raise HTTPException(404, f"{item_id} not found")
+
+@app.get("/stream")
+async def get_stream():
+    state["computed"] += 1
+    async def chunks():
+        await asyncio.sleep(0.1)
+        yield b"["
+        yield b"1,"
+        await asyncio.sleep(0.1)
+        yield b"2]"
+    return StreamingResponse(chunks(), media_type="application/json")
+
+@app.middleware("http")
+async def count_bypassed(request, call_next):
+    if request.headers.get("x-bypass-fastapi-cache"):
+        state["bypassed"] += 1
+    return await call_next(request)
+
+app.middleware("http")(middleware_cache_response)
+
+@pytest.fixture
+def redis():
+    _r = DictRedis()
+    state.update(computed=0, fail=False, bypassed=0)
+    with patch.object(CacheGzipRedis, "_r", _r), patch.object(CacheGzipRedis, "_retry_at", 0), patch("api.server.cache.redis._is_ci", False):
+        store = CacheTiered([("redis", CacheGzipRedis())])
+        with patch("api.server.api.get_cache_instance", return_value=store):
+            yield _r
+
+def run(*requests):
+    """Issue requests (path, headers) concurrently, and await refreshes scheduled meanwhile"""
+    async def issue():
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://localhost") as client:
+            responses = await asyncio.gather(*[client.get(path, headers=headers) for path, headers in requests])
+            await asyncio.gather(*_background_tasks)
+            return responses
+    return asyncio.run(issue())
+
+def get(path: str, **headers):
+    response, = run((path, headers))
+    return response
+
+def get_key(redis: DictRedis, path: str) -> str:
+    key, = [key for key in redis.store if key.endswith(f"] {path}") and not key.startswith(("[meta] ", "[lock] ", "[tag] "))]
+    return key
+
+def age(redis: DictRedis, key: str, staleness: float):
+    """Let the entry of key be stale for staleness seconds"""
+    redis.pttls[key] = redis.pttls[META_KEY_PREFIX + key] = int((max(SWR, SIE) - staleness) * 1000)
+
+def test_hit(redis):
+    response = get("/items/foo")
+    assert response.status_code == 200
+    assert cache_header not in response.headers
+    key = get_key(redis, "/items/foo")
+    assert redis.pttls[key] == (TTL + max(SWR, SIE)) * 1000
+    assert CacheMeta.loads(redis.store[META_KEY_PREFIX + key]).etag is not None
+
+    response = get("/items/foo")
+    assert (response.status_code, response.headers[cache_header]) == (200, "hit")
+    assert response.json() == {"id": "foo", "computed": 1}
+    assert response.headers["etag"]
+
+def test_stale_while_revalidate(redis):
+    get("/items/foo")
+    key = get_key(redis, "/items/foo")
+    age(redis, key, SWR - 10)
+
+    # served stale, whilst the same request is replayed bypassing cache read
+    response = get("/items/foo")
+    assert (response.status_code, response.headers[cache_header]) == (200, "stale")
+    assert response.json() == {"id": "foo", "computed": 1}
+    assert state["bypassed"] == 1
+    assert redis.pttls[key] == (TTL + max(SWR, SIE)) * 1000
+
+    response = get("/items/foo")
+    assert (response.status_code, response.headers[cache_header]) == (200, "hit")
+    assert response.json() == {"id": "foo", "computed": 2}
+
+def test_stale_if_error(redis):
+    get("/items/foo")
+    key = get_key(redis, "/items/foo")
+    age(redis, key, SIE - 10)
+
+    # too stale to be served whilst revalidating, recomputing fails
+    state["fail"] = True
+    response = get("/items/foo")
+    assert (response.status_code, response.headers[cache_header]) == (200, "stale")
+    assert response.json() == {"id": "foo", "computed": 1}
+    assert state["bypassed"] == 0
+
+    # recomputing succeeds
+    state["fail"] = False
+    response = get("/items/foo")
+    assert response.status_code == 200
+    assert cache_header not in response.headers
+    assert response.json() == {"id": "foo", "computed": 2}
+
+def test_server_error_not_cached(redis):
+    state["fail"] = True
+    assert get("/items/foo").status_code == 503
+    assert [key for key in redis.store if not key.startswith("[lock] ")] == []
+
+def test_if_none_match(redis):
+    etag = get("/items/foo").headers["etag"]
+    key = get_key(redis, "/items/foo")
+
+    # answered from metadata, without fetching the value
+    get_stored = redis.get
+    async def get_meta_only(stored_key):
+        assert stored_key != key
+        return await get_stored(stored_key)
+    with patch.object(redis, "get", get_meta_only):
+        response = get("/items/foo", **{"if-none-match": etag})
+    assert (response.status_code, response.headers[cache_header]) == (304, "hit")
+    assert response.content == b""
+
+    # revalidated in the background, if stale
+    age(redis, key, SWR - 10)
+    response = get("/items/foo", **{"if-none-match": etag})
+    assert (response.status_code, response.headers[cache_header]) == (304, "stale")
+    assert state["bypassed"] == 1
+
+    response = get("/items/foo", **{"if-none-match": '"other"'})
+    assert (response.status_code, response.headers[cache_header]) == (200, "hit")
+
+@pytest.mark.parametrize("path, status_code", [
+    ("/items/missing", 404),
+    ("/items/invalid", 400),
+])
+def test_negative_ttl(redis, path, status_code):
+    response = get(path)
+    assert response.status_code == status_code
+    assert cache_header not in response.headers
+    key = get_key(redis, path)
+    assert redis.pttls[key] == 10 * 1000
+    assert CacheMeta.loads(redis.store[META_KEY_PREFIX + key]).status_code == status_code
+
+    response = get(path)
+    assert (response.status_code, response.headers[cache_header]) == (status_code, "hit")
+    assert response.json()["status_code"] == status_code
+    assert "etag" not in response.headers
+
+def test_negative_ttl_disabled(redis):
+    assert get("/uncached/foo").status_code == 404
+    assert [key for key in redis.store if not key.startswith("[lock] ")] == []
+
+def test_streamed(redis):
+    # one request is coalesced with the other, whose body is streamed
+    first, second = sorted(run(("/stream", {}), ("/stream", {})), key=lambda response: cache_header in response.headers)
+    assert state["computed"] == 1
+    assert (first.status_code, first.content) == (200, b"[1,2]")
+    assert cache_header not in first.headers
+    assert "etag" not in first.headers
+    assert (second.status_code, second.content, second.headers[cache_header]) == (200, b"[1,2]", "hit")
+
+    # committed once the stream completed, with its etag
+    key = get_key(redis, "/stream")
+    meta = CacheMeta.loads(redis.store[META_KEY_PREFIX + key])
+    assert (meta.status_code, meta.content_type) == (200, "application/json")
+    assert second.headers["etag"].strip('"').startswith(meta.etag)
+
+    response = get("/stream", **{"if-none-match": second.headers["etag"]})
+    assert (response.status_code, response.headers[cache_header]) == (304, "hit")
+    assert state["computed"] == 1
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import pytest
+from fastapi import FastAPI, Header, Request
+from typing import Optional
+from unittest.mock import patch
+
+from api.server.batch import stream_batch, get_sub_scope, get_cache_lookup
+from api.server.cache.memory import CacheLruMemory
+from api.server.cache.tiered import CacheTiered
+from api.server.cache.meta import CacheMeta
+
+app = FastAPI()
+api = FastAPI()
+
+@api.get("/regions/{region_id}")
+async def get_region(region_id: str):
+    await asyncio.sleep(0.05 if region_id == "slow" else 0)
+    return {"name": region_id}
+
+@api.get("/private")
+async def get_private(authorization: Optional[str]=Header(None)):
+    return {"authorized": authorization is not None}
+
+@app.get("/admin/cache/stats")
+async def get_stats():
+    return {}
+
+app.mount("/v3_0", api)
+
+def bypass_reason(path: str, query: str):
+    return "query:bbox=" if "bbox=" in query else None
+
+scope = {
+    "type": "http",
+    "app": app,
+    "method": "POST",
+    "scheme": "http",
+    "server": ("localhost", 80),
+    "root_path": "",
+    "path": "/batch",
+    "headers": [(b"host", b"localhost"), (b"content-type", b"application/json"), (b"authorization", b"Bearer token")],
+}
+
+def test_get_sub_scope():
+    sub_scope = get_sub_scope(app, scope, "/v3_0/regions/hOc1%20left?bbox=1")
+    assert (sub_scope["method"], sub_scope["path"], sub_scope["query_string"]) == ("GET", "/v3_0/regions/hOc1 left", b"bbox=1")
+    assert sub_scope["headers"] == [(b"host", b"localhost")]
+    assert get_cache_lookup(app, sub_scope, bypass_reason) is None
+    assert get_cache_lookup(app, get_sub_scope(app, scope, "/v3_0/regions/hOc1")) is not None
+
+    # credentials are forwarded only to routes declaring them
+    assert (b"authorization", b"Bearer token") in get_sub_scope(app, scope, "/v3_0/private")["headers"]
+
+    for url in ("/admin/cache/stats", "/batch", "/metrics", "/v3_0", "/v3_0x/regions/hOc1", "regions"):
+        with pytest.raises(ValueError):
+            get_sub_scope(app, scope, url)
+
+def test_stream_batch():
+    cache = CacheTiered([("memory", CacheLruMemory(max_bytes=1000, ttl=60))])
+    key, _, _ = get_cache_lookup(app, get_sub_scope(app, scope, "/v3_0/regions/cached"))
+    asyncio.run(cache.set_value(key, b'{"name": "from cache"}', meta=CacheMeta()))
+
+    async def run():
+        return [json.loads(line) async for line in stream_batch(Request(scope), ["/v3_0/regions/slow", "/v3_0/regions/cached", "/v3_0/regions/fast", "/admin/cache/stats"], bypass_reason)]
+
+    with patch("api.server.batch.get_cache_instance", lambda: cache):
+        items = asyncio.run(asyncio.wait_for(run(), 5))
+
+    # invalid and cached first, then as they complete
+    assert [item["index"] for item in items] == [3, 1, 2, 0]
+    assert items[0]["status"] == 400
+    assert (items[1]["status"], items[1]["cache"], items[1]["body"]) == (200, "hit", {"name": "from cache"})
+    assert (items[3]["url"], items[3]["status"], items[3]["body"]) == ("/v3_0/regions/slow", 200, {"name": "slow"})